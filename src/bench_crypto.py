@@ -0,0 +1,74 @@
+"""
+Benchmark script comparing the Fernet and raw AES-256-GCM file formats,
+and AES-256-GCM with several threads encrypting chunks in parallel
+"""
+import os
+import tempfile
+import time
+
+from env_crypto import EnvCrypto, CIPHER_FERNET, CIPHER_AES_GCM
+
+# Thread counts compared for the chunked AES-256-GCM format
+WORKER_COUNTS = [1, 2, 4]
+
+# (description, number of variables, size of each value in bytes)
+PAYLOADS = [
+    ("small config", 20, 32),
+    ("1 MB of certificates", 8, 128 * 1024),
+    ("16 MB lookup tables", 16, 1024 * 1024),
+]
+
+def make_env_file(path, count, value_size):
+    """Write a plain .env file with random printable values"""
+    with open(path, 'w') as f:
+        for i in range(count):
+            value = os.urandom(value_size // 2).hex()
+            f.write(f"VAR_{i}={value}\n")
+
+def time_call(func, repeat):
+    """Return the best time of several calls"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench_payload(description, count, value_size):
+    """Benchmark one payload with both ciphers"""
+    print(f"\n{description} ({count} variables of {value_size} bytes)")
+    print(f"{'format':<18}{'file size':>8}{'overhead':>10}{'encrypt MB/s':>14}{'decrypt MB/s':>14}")
+
+    plain_size = os.path.getsize('.env')
+    repeat = 5 if plain_size < 4 * 1024 * 1024 else 2
+
+    runs = [(CIPHER_FERNET, 1)] + [(CIPHER_AES_GCM, workers) for workers in WORKER_COUNTS]
+    for cipher, workers in runs:
+        crypto = EnvCrypto()  # Random key, so the KDF is not part of the measurement
+        crypto.write_cipher = cipher
+        crypto.workers = workers
+
+        encrypt_time = time_call(lambda: crypto.encrypt_env_file('.env', '.env.enc'), repeat)
+        decrypt_time = time_call(lambda: crypto.decrypt_env_file('.env.enc'), repeat)
+        file_size = os.path.getsize('.env.enc')
+
+        label = cipher if workers == 1 else f"{cipher} x{workers}"
+        megabytes = plain_size / (1024 * 1024)
+        print(f"{label:<18}{file_size:>8}{(file_size / plain_size - 1) * 100:>9.1f}%"
+              f"{megabytes / encrypt_time:>14.1f}{megabytes / decrypt_time:>14.1f}")
+
+def main():
+    # encrypt_env_file writes .env.key to the current directory, so work in a scratch one
+    original_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        try:
+            for description, count, value_size in PAYLOADS:
+                make_env_file('.env', count, value_size)
+                bench_payload(description, count, value_size)
+        finally:
+            os.chdir(original_dir)
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,7 @@ Utility to change the encryption password for .env.enc
 """
 import os
 import getpass
-from env_crypto import EnvCrypto
+from env_crypto import EnvCrypto, atomic_write
 
 def change_password(env_file='.env.enc', key_file='.env.key'):
     """
@@ -24,9 +24,8 @@ def change_password(env_file='.env.enc', key_file='.env.key'):
     # Create crypto instance with current password
     crypto = EnvCrypto(current_password)
     
-    # Try to decrypt the file to verify the password
-    content = crypto.decrypt_env_file(env_file)
-    if not content:
+    # Verify the password against the file header
+    if not crypto.verify_password(env_file):
         print("Error: Failed to decrypt with current password.")
         return False
     
@@ -42,21 +41,16 @@ def change_password(env_file='.env.enc', key_file='.env.key'):
         print("Error: Password cannot be empty.")
         return False
     
-    # Get current values and key order
-    env_dict, key_order = crypto.get_env_values(env_file)
-    
-    # Create a new crypto instance with the new password
-    new_crypto = EnvCrypto(new_password)
-    
-    # Re-encrypt with the new password
-    if not new_crypto.set_env_values(env_dict, key_order, env_file):
-        print("Error: Failed to re-encrypt with new password.")
+    # Re-wrap the data key with the new password (only the header is rewritten)
+    if not crypto.change_file_password(new_password, env_file):
+        print("Error: Failed to change the password.")
         return False
     
-    # Update the key file if it exists
+    # Update the key file if it exists (the data key only changes when
+    # a file without envelope encryption is upgraded)
     if os.path.exists(key_file):
-        with open(key_file, 'wb') as f:
-            f.write(new_crypto.key)
+        with atomic_write(key_file) as f:
+            f.write(crypto.key)
         print(f"Updated key file: {key_file}")
     
     print("Password changed successfully.")
@@ -4,8 +4,12 @@ This would be compiled into config.exe
 """
 import sys
 import os
+import json
 import argparse
-from env_crypto import EnvCrypto
+import contextlib
+import key_agent
+import config_server
+from env_crypto import EnvCrypto, agent_key_id, read_kdf_params, validate_key, LAYOUT_BLOB, LAYOUT_RECORDS
 
 def get_password():
     """Get password from user input"""
@@ -21,7 +25,8 @@ def init_config(args):
         print("Error: .env.enc already exists. Use --force to overwrite.")
         return False
     
-    success = crypto.encrypt_env_file()
+    layout = LAYOUT_RECORDS if args.indexed else LAYOUT_BLOB
+    success = crypto.encrypt_env_file(layout=layout)
     if success:
         print("Successfully created encrypted config file (.env.enc)")
         print("Key file created (.env.key) - keep this secure!")
@@ -38,7 +43,7 @@ def view_config(args):
     if args.key_file and os.path.exists(args.key_file):
         crypto.load_key_from_file(args.key_file)
     
-    env_values = crypto.get_env_values()
+    env_values, _ = crypto.get_env_values()
     if not env_values:
         print("Failed to decrypt configuration")
         return False
@@ -67,13 +72,13 @@ def get_config_value(args):
     if args.key_file and os.path.exists(args.key_file):
         crypto.load_key_from_file(args.key_file)
     
-    env_values = crypto.get_env_values()
-    if not env_values:
+    # Only the index and the record of this key are decrypted
+    value = crypto.get_env_value(args.key)
+    if not crypto.password_valid:
         print("Failed to decrypt configuration")
         return False
     
-    if args.key in env_values:
-        value = env_values[args.key]
+    if value is not None:
         # Mask sensitive values if not showing secrets
         if not args.show_secrets and any(secret in args.key.lower() for secret in ['password', 'secret', 'key', 'token']):
             value = '*' * 8
@@ -99,6 +104,125 @@ def set_config_value(args):
         print(f"Failed to set {args.key}")
         return False
 
+BATCH_OPS = ('get', 'set', 'delete')
+
+def parse_batch_line(line):
+    """
+    Parse one operation of a batch script
+    
+    Lines are either JSON objects ({"op": "set", "key": "A", "value": "1"})
+    or words ("set A 1", "get A", "delete A"); the value of a word line is
+    everything after the key.
+    
+    Args:
+        line (str): The script line
+        
+    Returns:
+        tuple: (op, key, value or None)
+        
+    Raises:
+        ValueError: If the line is not a valid operation
+    """
+    if line.startswith('{'):
+        entry = json.loads(line)
+        if not isinstance(entry, dict):
+            raise ValueError("operation must be a JSON object")
+        op, key, value = entry.get('op'), entry.get('key'), entry.get('value')
+    else:
+        parts = line.split(None, 2)
+        op = parts[0].lower()
+        key = parts[1] if len(parts) > 1 else None
+        value = parts[2] if len(parts) > 2 else None
+    
+    if op == 'del':
+        op = 'delete'
+    if op not in BATCH_OPS:
+        raise ValueError(f"unknown operation {op!r}")
+    if not isinstance(key, str) or not key or any(c.isspace() for c in key):
+        raise ValueError("missing or invalid key")
+    validate_key(key)
+    if op == 'set':
+        if value is None:
+            raise ValueError("set needs a value")
+        value = str(value)
+        if '\n' in value:
+            raise ValueError("values cannot contain line breaks")
+    return op, key, value
+
+def run_batch(crypto, lines, env_file='.env.enc'):
+    """
+    Apply a batch of operations with a single write
+    
+    Operations see the effect of earlier ones. If any line is invalid,
+    nothing is written.
+    
+    Args:
+        crypto (EnvCrypto): Unlocked crypto instance
+        lines (iterable): Script lines; blank lines and # comments are skipped
+        env_file (str): Path to the encrypted .env file
+        
+    Returns:
+        tuple: (list of per-operation result dicts, summary dict)
+    """
+    operations = []
+    for number, raw_line in enumerate(lines, 1):
+        line = raw_line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            operations.append((number,) + parse_batch_line(line))
+        except ValueError as e:
+            return [], {'committed': False, 'line': number, 'error': str(e)}
+    
+    def apply(tx):
+        results = []
+        for number, op, key, value in operations:
+            result = {'line': number, 'op': op, 'key': key, 'ok': True}
+            if op == 'get':
+                result['value'] = tx.get(key)
+            elif op == 'set':
+                tx.set(key, value)
+            else:
+                result['deleted'] = tx.delete(key)
+            results.append(result)
+        changes = sum(1 for key in tx.values.keys() | tx.original.keys()
+                      if tx.values.get(key) != tx.original.get(key))
+        return results, changes
+    
+    # Replayed from the start if another writer changes the file in the meantime
+    try:
+        results, changes = crypto.run_transaction(apply, env_file)
+    except ValueError as e:
+        return [], {'committed': False, 'error': str(e)}
+    except Exception as e:
+        return [], {'committed': False, 'error': f"failed to write the encrypted file: {e}"}
+    return results, {'committed': True, 'changes': changes}
+
+def batch_config(args):
+    """Run a script of get/set/delete operations with a single write"""
+    password = args.password or get_password()
+    crypto = EnvCrypto(password)
+    
+    if args.key_file and os.path.exists(args.key_file):
+        crypto.load_key_from_file(args.key_file)
+    
+    if not os.path.exists('.env.enc'):
+        print(json.dumps({'committed': False, 'error': ".env.enc does not exist"}))
+        return False
+    
+    # Keep stdout machine-readable: messages from the crypto layer go to stderr
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.file and args.file != '-':
+            with open(args.file, 'r', encoding='utf-8') as f:
+                results, summary = run_batch(crypto, f.readlines())
+        else:
+            results, summary = run_batch(crypto, sys.stdin.readlines())
+    
+    for result in results:
+        print(json.dumps(result))
+    print(json.dumps(summary))
+    return summary['committed']
+
 def export_config(args):
     """Export encrypted config to a plain .env file"""
     password = args.password or get_password()
@@ -112,7 +236,7 @@ def export_config(args):
         print(f"Error: {output_file} already exists. Use --force to overwrite.")
         return False
     
-    success = crypto.decrypt_env_file(output_file=output_file)
+    success = crypto.decrypt_env_file(output_file=output_file, workers=args.workers)
     if success:
         print(f"Successfully exported config to {output_file}")
         return True
@@ -134,7 +258,8 @@ def import_config(args):
         print("Error: .env.enc already exists. Use --force to overwrite.")
         return False
     
-    success = crypto.encrypt_env_file(input_file=input_file)
+    layout = LAYOUT_RECORDS if args.indexed else LAYOUT_BLOB
+    success = crypto.encrypt_env_file(input_file=input_file, layout=layout, workers=args.workers)
     if success:
         print(f"Successfully imported {input_file} to encrypted config")
         return True
@@ -142,6 +267,68 @@ def import_config(args):
         print(f"Failed to import {input_file}")
         return False
 
+def migrate_config(args):
+    """Rewrite the encrypted config in the current file format"""
+    password = args.password or get_password()
+    crypto = EnvCrypto(password)
+    
+    if args.key_file and os.path.exists(args.key_file):
+        crypto.load_key_from_file(args.key_file)
+    
+    if crypto.migrate_env_file():
+        print("Successfully migrated .env.enc to the current format")
+        return True
+    else:
+        print("Failed to migrate configuration")
+        return False
+
+def agent_command(args):
+    """Run or control the local key agent"""
+    if args.action == 'start':
+        return key_agent.run_agent(idle_ttl=args.ttl)
+    
+    if args.action == 'status':
+        status = key_agent.status()
+        if status:
+            print(f"Key agent running on {key_agent.get_socket_path()}: {status}")
+            return True
+        print("Key agent is not running")
+        return False
+    
+    if args.action == 'forget':
+        if not os.path.exists(args.env_file):
+            print(f"Error: {args.env_file} does not exist")
+            return False
+        kdf_params = read_kdf_params(args.env_file)
+        if not kdf_params:
+            print(f"Error: {args.env_file} is not password protected")
+            return False
+        password = args.password or get_password()
+        success = key_agent.forget_key(agent_key_id(password, *kdf_params))
+    elif args.action == 'lock':
+        success = key_agent.lock()
+    else:
+        success = key_agent.stop()
+    
+    if success:
+        print(f"Key agent: {args.action} done")
+        return True
+    else:
+        print("Key agent is not running")
+        return False
+
+def serve_config(args):
+    """Run the config server in the foreground"""
+    if not os.path.exists('.env.enc'):
+        print("Error: .env.enc does not exist")
+        return False
+    
+    if args.key_file:
+        password = args.password
+    else:
+        password = args.password or get_password()
+    return config_server.run_server(password=password, key_file=args.key_file, idle_ttl=args.ttl)
+
 def main():
     parser = argparse.ArgumentParser(description="Manage encrypted environment configuration")
     subparsers = parser.add_subparsers(dest='command', help='Command to execute')
@@ -150,6 +337,8 @@ def main():
     init_parser = subparsers.add_parser('init', help='Initialize a new encrypted config')
     init_parser.add_argument('--force', action='store_true', help='Overwrite existing files')
     init_parser.add_argument('--password', help='Encryption password (will prompt if not provided)')
+    init_parser.add_argument('--indexed', action='store_true',
+                             help='Store one record per variable for fast single-key lookups (drops comments)')
     
     # View command
     view_parser = subparsers.add_parser('view', help='View all configuration values')
@@ -177,12 +366,47 @@ def main():
     export_parser.add_argument('--key-file', help='Path to key file')
     export_parser.add_argument('--password', help='Decryption password (will prompt if not provided)')
     export_parser.add_argument('--force', action='store_true', help='Overwrite existing files')
+    export_parser.add_argument('--workers', type=int, default=1,
+                               help='Threads decrypting large files in parallel (default: 1)')
     
     # Import command
     import_parser = subparsers.add_parser('import', help='Import from plain .env file')
     import_parser.add_argument('--input', help='Input file path (default: .env)')
     import_parser.add_argument('--password', help='Encryption password (will prompt if not provided)')
     import_parser.add_argument('--force', action='store_true', help='Overwrite existing files')
+    import_parser.add_argument('--indexed', action='store_true',
+                               help='Store one record per variable for fast single-key lookups (drops comments)')
+    import_parser.add_argument('--workers', type=int, default=1,
+                               help='Threads encrypting large files in parallel (default: 1)')
+    
+    # Migrate command
+    migrate_parser = subparsers.add_parser('migrate', help='Rewrite .env.enc in the current file format')
+    migrate_parser.add_argument('--key-file', help='Path to key file')
+    migrate_parser.add_argument('--password', help='Encryption password (will prompt if not provided)')
+    
+    # Agent command
+    agent_parser = subparsers.add_parser('agent', help='Run or control the local key agent')
+    agent_parser.add_argument('action', choices=['start', 'stop', 'status', 'lock', 'forget'],
+                              help='start: run the agent in the foreground, lock: wipe all keys, '
+                                   'forget: wipe the key of one password')
+    agent_parser.add_argument('--ttl', type=int, default=key_agent.DEFAULT_IDLE_TTL,
+                              help=f'Idle seconds before a key is forgotten (default: {key_agent.DEFAULT_IDLE_TTL})')
+    agent_parser.add_argument('--password', help='Password whose key should be forgotten (forget only)')
+    agent_parser.add_argument('--env-file', default='.env.enc',
+                              help='Encrypted file the forgotten key belongs to (forget only, default: .env.enc)')
+    
+    # Batch command
+    batch_parser = subparsers.add_parser('batch', help='Apply many get/set/delete operations with a single write')
+    batch_parser.add_argument('--file', help='Script with one operation per line, JSON or words (default: stdin)')
+    batch_parser.add_argument('--key-file', help='Path to key file')
+    batch_parser.add_argument('--password', help='Encryption password (will prompt if not provided)')
+    
+    # Serve command
+    serve_parser = subparsers.add_parser('serve', help='Answer get/set/list requests over a local socket')
+    serve_parser.add_argument('--key-file', help='Path to key file')
+    serve_parser.add_argument('--password', help='Decryption password (will prompt if not provided)')
+    serve_parser.add_argument('--ttl', type=int, default=config_server.DEFAULT_IDLE_TTL,
+                              help=f'Idle seconds before the server locks (default: {config_server.DEFAULT_IDLE_TTL})')
     
     args = parser.parse_args()
     
@@ -198,6 +422,15 @@ def main():
         export_config(args)
     elif args.command == 'import':
         import_config(args)
+    elif args.command == 'migrate':
+        migrate_config(args)
+    elif args.command == 'agent':
+        agent_command(args)
+    elif args.command == 'batch':
+        # Scripts check the exit status to see whether the batch was committed
+        sys.exit(0 if batch_config(args) else 1)
+    elif args.command == 'serve':
+        serve_config(args)
     else:
         parser.print_help()
 
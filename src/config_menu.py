@@ -5,17 +5,127 @@ import os
 import sys
 import time
 import re
+import argparse
+import bisect
 import datetime
-from env_crypto import EnvCrypto
+import threading
+from env_crypto import (EnvCrypto, ConcurrentModificationError, atomic_write, clear_key_cache,
+                        file_lock, file_signature, validate_key)
+
+# Keys shown per page in the key browser
+KEYS_PER_PAGE = 20
+
+
+class KeyIndex:
+    """
+    Search index over configuration keys, built once per load
+    
+    Matching is case-insensitive. Results list keys starting with the query
+    first, then keys containing it, then keys containing its characters in
+    order (fuzzy matches, e.g. 'sqlhst' finds 'SQL_HOST'), each group in
+    file order. Substring and fuzzy matching scan a single joined string,
+    so filtering stays fast with tens of thousands of keys.
+    """
+    
+    def __init__(self, keys):
+        """
+        Build the index
+        
+        Args:
+            keys (list): Keys in file order
+        """
+        self.keys = list(keys)
+        lowered = [key.lower() for key in self.keys]
+        # Sorted copy for prefix ranges
+        self.sorted_keys = sorted((key, i) for i, key in enumerate(lowered))
+        # All keys on one line each, with the offset where each line starts
+        self.text = '\n'.join(lowered)
+        self.starts = []
+        offset = 0
+        for key in lowered:
+            self.starts.append(offset)
+            offset += len(key) + 1
+        self.last_query = None
+        self.last_results = None
+        
+    def _prefix_matches(self, query):
+        """Positions of keys starting with the query"""
+        low = bisect.bisect_left(self.sorted_keys, (query,))
+        high = bisect.bisect_left(self.sorted_keys, (query + '\U0010ffff',))
+        return sorted(i for _, i in self.sorted_keys[low:high])
+    
+    def _substring_matches(self, query):
+        """Positions of keys containing the query"""
+        positions = []
+        found = self.text.find(query)
+        while found != -1:
+            position = bisect.bisect_right(self.starts, found) - 1
+            positions.append(position)
+            # Continue on the next key, so each key is reported once
+            if position + 1 == len(self.starts):
+                break
+            found = self.text.find(query, self.starts[position + 1])
+        return positions
+    
+    def _fuzzy_matches(self, query):
+        """Positions of keys containing the characters of the query in order"""
+        # Each gap excludes the character that ends it, so a key that does not
+        # match fails in one pass instead of backtracking over every split
+        pattern = '^' + ''.join(f"[^\n{re.escape(char)}]*{re.escape(char)}" for char in query) + '[^\n]*$'
+        return [bisect.bisect_right(self.starts, match.start()) - 1
+                for match in re.finditer(pattern, self.text, re.MULTILINE)]
+    
+    def search(self, query):
+        """
+        Find the keys matching a query
+        
+        Args:
+            query (str): Search text; an empty query matches every key
+            
+        Returns:
+            list: Matching keys, best matches first
+        """
+        query = query.strip().lower()
+        if not query or '\n' in query:
+            return list(self.keys)
+        if query == self.last_query:
+            return self.last_results
+        
+        results = self._prefix_matches(query)
+        seen = set(results)
+        for group in (self._substring_matches(query), self._fuzzy_matches(query)):
+            for position in group:
+                if position not in seen:
+                    seen.add(position)
+                    results.append(position)
+        
+        self.last_query, self.last_results = query, [self.keys[i] for i in results]
+        return self.last_results
+
 
 class ConfigMenu:
     """Interactive menu for managing encrypted configuration"""
     
-    def __init__(self):
+    def __init__(self, autosave_delay=None):
+        """
+        Initialize the menu
+        
+        Args:
+            autosave_delay (float, optional): Save pending changes after this many
+                                              seconds without further edits; only
+                                              the Save menu item saves when None
+        """
         self.password = None
         self.crypto = None
         self.env_values = {}
         self.key_order = []  # To preserve original order of keys
+        self.file_version = None  # file_signature() the values were read at, None when stale
+        self.key_index = None  # KeyIndex of key_order, built when first searched
+        self.dirty = {}  # Unsaved changes: key -> new value, or None for a deletion
+        self.last_change = 0.0
+        self.model_lock = threading.RLock()  # Shared with the autosave thread
+        self.autosave_delay = autosave_delay
+        self.autosave_stop = threading.Event()
         self.env_file = '.env.enc'
         self.key_file = '.env.key'
         
@@ -49,35 +159,199 @@ class ConfigMenu:
         self.crypto = EnvCrypto(self.password)
         
         # If key file exists, we need to validate the password
-        # by attempting to decrypt the file before loading the key
+        # against the file header before loading the key
         if os.path.exists(self.env_file) and os.path.exists(self.key_file):
-            # First try with password-derived key
-            test_content = self.crypto.decrypt_env_file(self.env_file)
-            
-            # If decryption succeeded, the password is correct
-            if test_content and self.crypto.password_valid:
+            # If verification succeeded, the password is correct
+            if self.crypto.verify_password(self.env_file):
                 # Now we can safely load the key file
                 self.crypto.load_key_from_file(self.key_file)
             # Otherwise, don't load the key file - the password is wrong
             
     def load_config(self):
-        """Load the configuration values"""
+        """
+        Load the configuration values
+        
+        The values are kept in memory for the whole session; the file is only
+        decrypted again when another program changed it since it was read.
+        
+        Returns:
+            bool: True if there are values to show, False otherwise
+        """
         if not self.crypto:
             self.initialize_crypto()
             
         if os.path.exists(self.env_file):
-            self.env_values, self.key_order = self.crypto.get_env_values(self.env_file)
+            if self.is_current():
+                return len(self.env_values) > 0
             
-            # Check if password is valid
-            if not self.crypto.password_valid:
-                print("Invalid password. Please try again.")
-                self.password = None  # Reset password so it will be asked again
-                self.crypto = None    # Reset crypto object
-                return False
+            with self.model_lock:
+                # Taken before reading, so a write during the read is noticed next time
+                version = file_signature(self.env_file)
+                self.env_values, self.key_order = self.crypto.get_env_values(self.env_file)
+                self.key_index = None
                 
-            return len(self.env_values) > 0
+                # Check if password is valid
+                if not self.crypto.password_valid:
+                    print("Invalid password. Please try again.")
+                    self.password = None  # Reset password so it will be asked again
+                    self.crypto = None    # Reset crypto object
+                    self.file_version = None
+                    return False
+                    
+                self.file_version = version
+                # Unsaved edits stay on top of what the other program wrote
+                for key, value in self.dirty.items():
+                    if value is None:
+                        self.delete_cached_value(key)
+                    else:
+                        self.set_cached_value(key, value)
+                return len(self.env_values) > 0
+        self.file_version = None
         return False
     
+    def is_current(self):
+        """
+        Check whether the values in memory still match the file
+        
+        Returns:
+            bool: True if the file has not changed since it was read
+        """
+        return self.file_version is not None and file_signature(self.env_file) == self.file_version
+    
+    def save_change(self, write, apply=None):
+        """
+        Write a change to the file and apply the same change to the values in memory
+        
+        The writer lock is held across the check and the write, so the values
+        in memory are only patched when nobody else wrote in between; otherwise
+        they are read again on the next load.
+        
+        Args:
+            write (callable): Writes the change, returns True if successful
+            apply (callable, optional): Applies the change to the values in memory
+            
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        with file_lock(self.env_file):
+            current = self.is_current()
+            if not write():
+                return False
+            if current:
+                if apply:
+                    apply()
+                self.file_version = file_signature(self.env_file)
+            else:
+                self.file_version = None
+        return True
+    
+    def set_cached_value(self, key, value):
+        """Set a value in memory, keeping the key order"""
+        if key not in self.env_values:
+            self.key_order.append(key)
+            self.key_index = None
+        self.env_values[key] = value
+    
+    def delete_cached_value(self, key):
+        """Remove a value from memory"""
+        if self.env_values.pop(key, None) is not None:
+            self.key_order.remove(key)
+            self.key_index = None
+    
+    def stage_value(self, key, value):
+        """
+        Change a value in memory and remember it for the next save
+        
+        Args:
+            key (str): Variable name
+            value (str or None): New value, or None to delete the variable
+        """
+        with self.model_lock:
+            if value is None:
+                self.delete_cached_value(key)
+            else:
+                self.set_cached_value(key, value)
+            self.dirty[key] = value
+            self.last_change = time.monotonic()
+    
+    def save_changes(self, quiet=False):
+        """
+        Write all pending changes to the file at once
+        
+        The changes are applied in a transaction on top of the current file,
+        so values changed by other programs in the meantime are kept.
+        
+        Args:
+            quiet (bool): Do not print errors or ask for the password (used by
+                          the autosave thread)
+            
+        Returns:
+            bool: True if there is nothing left to save, False otherwise
+        """
+        with self.model_lock:
+            if not self.dirty:
+                return True
+            if self.crypto is None:
+                # Reset after a wrong password; the edits stay pending until it is given again
+                if quiet:
+                    return False
+                self.initialize_crypto()
+            pending = dict(self.dirty)
+            
+            def stage(tx):
+                for key, value in pending.items():
+                    if value is None:
+                        tx.delete(key)
+                    else:
+                        tx.set(key, value)
+                return tx
+            
+            try:
+                with file_lock(self.env_file):
+                    tx = self.crypto.run_transaction(stage, self.env_file)
+                    version = file_signature(self.env_file)
+            except (ValueError, OSError, ConcurrentModificationError) as e:
+                if not quiet:
+                    print(f"Failed to save changes: {e}")
+                if os.path.exists(self.env_file) and not self.crypto.password_valid:
+                    self.password = None  # Ask for the password again on the next save
+                    self.crypto = None
+                return False
+            
+            self.env_values, self.key_order = dict(tx.values), list(tx.values)
+            self.key_index = None
+            self.file_version = version
+            self.dirty.clear()
+        return True
+    
+    def start_autosave(self):
+        """
+        Start the background thread that saves after a quiet period
+        """
+        if not self.autosave_delay:
+            return
+        
+        def autosave():
+            while not self.autosave_stop.wait(min(self.autosave_delay, 1.0)):
+                if self.dirty and time.monotonic() - self.last_change >= self.autosave_delay:
+                    # Errors are left for the Save menu item or the save on exit to report
+                    self.save_changes(quiet=True)
+        
+        threading.Thread(target=autosave, daemon=True).start()
+    
+    def shutdown(self):
+        """
+        Stop autosaving and save any pending changes
+        
+        Returns:
+            bool: True if nothing was left unsaved, False otherwise
+        """
+        self.autosave_stop.set()
+        if not self.dirty:
+            return True
+        print(f"Saving {len(self.dirty)} pending change(s)...")
+        return self.save_changes()
+    
     def show_main_menu(self):
         """Display the main menu"""
         while True:
@@ -91,6 +365,7 @@ class ConfigMenu:
             # print("6. Export Configuration")
             print("7. Import Configuration")
             print("3. Change Encryption Password")
+            print(f"S. Save Changes ({len(self.dirty)} pending)")
             print("0. Exit")
             
             self.print_footer()
@@ -112,14 +387,35 @@ class ConfigMenu:
             #     self.import_config()
             elif choice == '3':
                 self.change_password()
+            elif choice.lower() == 's':
+                self.save_menu()
             elif choice == '0':
                 self.print_header("Exiting Configuration Manager")
+                if not self.shutdown():
+                    if input("Exit anyway and lose the pending changes? (y/n): ").lower() != 'y':
+                        continue
                 print("Thank you for using the Configuration Manager!")
+                clear_key_cache()
                 time.sleep(1)
                 sys.exit(0)
             else:
                 input("Invalid choice. Press Enter to continue...")
     
+    def save_menu(self):
+        """Save pending changes from the menu"""
+        self.print_header("Save Changes")
+        
+        if not self.dirty:
+            print("There are no pending changes.")
+        else:
+            for key, value in self.dirty.items():
+                print(f"{key}: {'deleted' if value is None else 'changed'}")
+            count = len(self.dirty)
+            if self.save_changes():
+                print(f"\nSaved {count} change(s).")
+                
+        input("\nPress Enter to continue...")
+    
     def view_all_values(self):
         """View all configuration values"""
         if not self.load_config():
@@ -137,11 +433,12 @@ class ConfigMenu:
         for key in self.key_order:
             value = self.env_values[key]
             # Mask sensitive values
+            unsaved = " (unsaved)" if key in self.dirty else ""
             if any(secret in key.lower() for secret in ['password', 'secret', 'key', 'token']):
                 display_value = '*' * 8
-                print(f"{key.ljust(max_key_len)} = {display_value} (hidden)")
+                print(f"{key.ljust(max_key_len)} = {display_value} (hidden){unsaved}")
             else:
-                print(f"{key.ljust(max_key_len)} = {value}")
+                print(f"{key.ljust(max_key_len)} = {value}{unsaved}")
         
         show_sensitive = input("\nShow sensitive values? (y/n): ").lower() == 'y'
         
@@ -257,23 +554,14 @@ class ConfigMenu:
             input("\nPress Enter to continue...")
             return
             
+        # Pick the key by searching, so thousands of keys stay manageable
+        key = self.browse_keys("Edit Configuration Value")
+        if key is None:
+            return
+            
         self.print_header("Edit Configuration Value")
         
-        # Display all keys in original order
-        print("Available keys:")
-        for i, key in enumerate(self.key_order, 1):
-            print(f"{i}. {key}")
-            
         try:
-            key_index = int(input("\nEnter key number to edit (0 to cancel): ")) - 1
-            if key_index < 0:
-                return
-                
-            if key_index >= len(self.key_order):
-                input("Invalid key number. Press Enter to continue...")
-                return
-                
-            key = self.key_order[key_index]
             current_value = self.env_values[key]
             
             # Mask sensitive values in display
@@ -318,12 +606,8 @@ class ConfigMenu:
                 confirm = input(f"Confirm change {key} from '{display_value}' to '{new_value}'? (y/n): ")
                 
                 if confirm.lower() == 'y':
-                    if not self.crypto.set_env_value(key, new_value, self.env_file):
-                        print("Failed to update value.")
-                    else:
-                        print(f"Successfully updated {key}.")
-                        # Reload config
-                        self.env_values, self.key_order = self.crypto.get_env_values(self.env_file)
+                    self.stage_value(key, new_value)
+                    print(f"Updated {key}. {self.pending_note()}")
             else:
                 print("Edit cancelled.")
                 
@@ -332,6 +616,76 @@ class ConfigMenu:
             
         input("\nPress Enter to continue...")
     
+    def search_keys(self, query):
+        """
+        Find the keys matching a search
+        
+        Args:
+            query (str): Prefix, substring or fuzzy search text
+            
+        Returns:
+            list: Matching keys, best matches first
+        """
+        with self.model_lock:
+            if self.key_index is None:
+                self.key_index = KeyIndex(self.key_order)
+            return self.key_index.search(query)
+    
+    def browse_keys(self, title):
+        """
+        Let the user pick a key by searching and paging through the keys
+        
+        Args:
+            title (str): Header shown above the list
+            
+        Returns:
+            str or None: The chosen key, or None if cancelled
+        """
+        query = ''
+        page = 0
+        while True:
+            matches = self.search_keys(query)
+            pages = max(1, (len(matches) + KEYS_PER_PAGE - 1) // KEYS_PER_PAGE)
+            page = min(page, pages - 1)
+            first = page * KEYS_PER_PAGE
+            
+            self.print_header(title)
+            if query:
+                print(f"Search: {query} ({len(matches)} of {len(self.key_order)} keys)")
+            else:
+                print(f"All {len(matches)} keys")
+            print()
+            for number, key in enumerate(matches[first:first + KEYS_PER_PAGE], first + 1):
+                print(f"{number:>6}. {key}")
+            if not matches:
+                print("No matching keys.")
+            print(f"\nPage {page + 1} of {pages}")
+            print("Number = select, text = search (/text to search for n, p or digits),")
+            print("n or Enter/p = next/previous page, c = clear search, 0 = cancel")
+            
+            choice = input("\n> ").strip()
+            if choice == '0':
+                return None
+            if choice.isdigit():
+                number = int(choice)
+                if 1 <= number <= len(matches):
+                    return matches[number - 1]
+                input("Invalid key number. Press Enter to continue...")
+            elif choice.lower() == 'n' or not choice:
+                page = min(page + 1, pages - 1)
+            elif choice.lower() == 'p':
+                page = max(page - 1, 0)
+            elif choice.lower() == 'c':
+                query, page = '', 0
+            else:
+                query, page = choice[1:] if choice.startswith('/') else choice, 0
+    
+    def pending_note(self):
+        """Describe when pending changes will be written"""
+        if self.autosave_delay:
+            return f"It will be saved after {self.autosave_delay:g}s without further edits."
+        return "Choose 'S. Save Changes' to write it to the file."
+    
     def add_value(self):
         """Add a new configuration value"""
         if not self.load_config():
@@ -349,6 +703,13 @@ class ConfigMenu:
             input("\nPress Enter to continue...")
             return
             
+        try:
+            validate_key(key)
+        except ValueError as e:
+            print(f"Invalid key: {e}")
+            input("\nPress Enter to continue...")
+            return
+            
         if key in self.env_values:
             print(f"Key '{key}' already exists. Use Edit option to change its value.")
             input("\nPress Enter to continue...")
@@ -376,12 +737,8 @@ class ConfigMenu:
         confirm = input(f"Confirm adding {key}={value}? (y/n): ")
         
         if confirm.lower() == 'y':
-            if not self.crypto.set_env_value(key, value, self.env_file):
-                print("Failed to add value.")
-            else:
-                print(f"Successfully added {key}.")
-                # Reload config
-                self.env_values, self.key_order = self.crypto.get_env_values(self.env_file)
+            self.stage_value(key, value)
+            print(f"Added {key}. {self.pending_note()}")
         else:
             print("Addition cancelled.")
             
@@ -395,23 +752,14 @@ class ConfigMenu:
             input("\nPress Enter to continue...")
             return
             
+        # Pick the key by searching, so thousands of keys stay manageable
+        key = self.browse_keys("Delete Configuration Value")
+        if key is None:
+            return
+            
         self.print_header("Delete Configuration Value")
         
-        # Display all keys in original order
-        print("Available keys:")
-        for i, key in enumerate(self.key_order, 1):
-            print(f"{i}. {key}")
-            
         try:
-            key_index = int(input("\nEnter key number to delete (0 to cancel): ")) - 1
-            if key_index < 0:
-                return
-                
-            if key_index >= len(self.key_order):
-                input("Invalid key number. Press Enter to continue...")
-                return
-                
-            key = self.key_order[key_index]
             value = self.env_values[key]
             
             # Mask sensitive values in display
@@ -422,23 +770,9 @@ class ConfigMenu:
             confirm = input(f"Are you sure you want to delete {key}={display_value}? (y/n): ")
             
             if confirm.lower() == 'y':
-                # Remove from dictionary
-                env_dict = self.env_values.copy()
-                del env_dict[key]
-                
-                # Convert back to .env format
-                content = '\n'.join([f"{k}={v}" for k, v in env_dict.items()])
-                
-                # Re-encrypt and save
-                try:
-                    encrypted_data = self.crypto.cipher.encrypt(content.encode('utf-8'))
-                    with open(self.env_file, 'wb') as f:
-                        f.write(encrypted_data)
-                    print(f"Successfully deleted {key}.")
-                    # Reload config
-                    self.env_values, self.key_order = self.crypto.get_env_values(self.env_file)
-                except Exception as e:
-                    print(f"Error deleting key: {e}")
+                # Stage the deletion; it is written with the next save
+                self.stage_value(key, None)
+                print(f"Deleted {key}. {self.pending_note()}")
             else:
                 print("Deletion cancelled.")
                 
@@ -447,10 +781,27 @@ class ConfigMenu:
             
         input("\nPress Enter to continue...")
     
+    def confirm_discard_changes(self):
+        """
+        Ask before replacing the file while there are pending changes
+        
+        Returns:
+            bool: True if there are none or the user agrees to drop them
+        """
+        if not self.dirty:
+            return True
+        print(f"There are {len(self.dirty)} unsaved change(s), they will be lost.")
+        return input("Discard them and continue? (y/n): ").lower() == 'y'
+    
     def initialize_config(self):
         """Initialize or reset the configuration"""
         self.print_header("Initialize/Reset Configuration")
         
+        if not self.confirm_discard_changes():
+            print("Initialization cancelled.")
+            input("\nPress Enter to continue...")
+            return
+        
         if os.path.exists(self.env_file):
             confirm = input("This will overwrite the existing configuration. Continue? (y/n): ")
             if confirm.lower() != 'y':
@@ -474,13 +825,16 @@ class ConfigMenu:
         # Check if .env exists
         if not os.path.exists('.env'):
             print("No .env file found. Creating an empty configuration.")
-            with open('.env', 'w') as f:
+            with atomic_write('.env', 'w') as f:
                 f.write("# Configuration file\n")
         
         # Encrypt the file
         if self.crypto.encrypt_env_file():
             print("Successfully initialized configuration.")
-            self.env_values, self.key_order = self.crypto.get_env_values(self.env_file)
+            with self.model_lock:
+                # The file was replaced, so edits to the old one are dropped
+                self.dirty.clear()
+                self.file_version = None  # Read again on the next load
         else:
             print("Failed to initialize configuration.")
             
@@ -496,6 +850,14 @@ class ConfigMenu:
             
         self.print_header("Export Configuration")
         
+        # The export is written from the file, so it has to include the pending changes
+        if self.dirty:
+            print(f"Saving {len(self.dirty)} pending change(s) first...")
+            if not self.save_changes():
+                print("Export cancelled.")
+                input("\nPress Enter to continue...")
+                return
+        
         output_file = input("Enter output file path (default: .env.exported): ") or '.env.exported'
         
         if os.path.exists(output_file):
@@ -522,6 +884,11 @@ class ConfigMenu:
             print(f"File {input_file} does not exist.")
             input("\nPress Enter to continue...")
             return
+        
+        if not self.confirm_discard_changes():
+            print("Import cancelled.")
+            input("\nPress Enter to continue...")
+            return
             
         # Get password if not already set
         if not self.password:
@@ -533,7 +900,10 @@ class ConfigMenu:
         # Encrypt the file
         if self.crypto.encrypt_env_file(input_file, self.env_file):
             print(f"Successfully imported configuration from {input_file}")
-            self.env_values, self.key_order = self.crypto.get_env_values(self.env_file)
+            with self.model_lock:
+                # The file was replaced, so edits to the old one are dropped
+                self.dirty.clear()
+                self.file_version = None  # Read again on the next load
         else:
             print("Failed to import configuration.")
             
@@ -557,9 +927,8 @@ class ConfigMenu:
         if not self.crypto:
             self.crypto = EnvCrypto(self.password)
         
-        # Try to decrypt the file to verify the password
-        content = self.crypto.decrypt_env_file(self.env_file)
-        if not content or not self.crypto.password_valid:
+        # Verify the password against the file header
+        if not self.crypto.verify_password(self.env_file):
             print("Error: Failed to decrypt with current password.")
             self.password = None  # Reset password
             self.crypto = None    # Reset crypto object
@@ -581,26 +950,21 @@ class ConfigMenu:
             input("\nPress Enter to continue...")
             return
         
-        # Get current values and key order
-        env_dict, key_order = self.crypto.get_env_values(self.env_file)
-        
-        # Create a new crypto instance with the new password
-        new_crypto = EnvCrypto(new_password)
-        
-        # Re-encrypt with the new password
-        if not new_crypto.set_env_values(env_dict, key_order, self.env_file):
-            print("Error: Failed to re-encrypt with new password.")
+        # Re-wrap the data key with the new password (only the header is rewritten,
+        # so the values in memory stay valid)
+        if not self.save_change(lambda: self.crypto.change_file_password(new_password, self.env_file)):
+            print("Error: Failed to change the password.")
             input("\nPress Enter to continue...")
             return
         
-        # Update the key file if it exists
+        # Update the key file if it exists (the data key only changes when
+        # a file without envelope encryption is upgraded)
         if os.path.exists(self.key_file):
-            with open(self.key_file, 'wb') as f:
-                f.write(new_crypto.key)
+            with atomic_write(self.key_file) as f:
+                f.write(self.crypto.key)
             print(f"Updated key file: {self.key_file}")
         
-        # Update the current crypto instance and password
-        self.crypto = new_crypto
+        # Update the current password
         self.password = new_password
         
         print("Password changed successfully.")
@@ -609,8 +973,19 @@ class ConfigMenu:
 
 def main():
     """Main entry point"""
-    menu = ConfigMenu()
-    menu.show_main_menu()
+    parser = argparse.ArgumentParser(description='Interactive menu for encrypted configuration')
+    parser.add_argument('--autosave', type=float, metavar='SECONDS',
+                        help='Save edits after this many seconds without further changes')
+    args = parser.parse_args()
+    
+    menu = ConfigMenu(autosave_delay=args.autosave)
+    menu.start_autosave()
+    try:
+        menu.show_main_menu()
+    except KeyboardInterrupt:
+        # Ctrl-C still writes what was edited
+        print()
+        sys.exit(0 if menu.shutdown() else 1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,317 @@
+"""
+Config server that answers get/set/list requests over a local socket
+
+Scripts that read configuration many times a second can talk to one
+long-running server instead of starting config_cli.py for every value.
+The server unlocks the encrypted file once, keeps the variables in memory
+and answers one reply line per request line:
+
+    GET <key>             OK <value> | MISS
+    SET <key> <value>     OK
+    DEL <key>             OK | MISS
+    LIST [prefix]         OK <key> <key> ...
+    STATUS                OK locked=<0|1> keys=<n> idle_ttl=<seconds>
+    LOCK                  OK (forget the variables and the key)
+    UNLOCK [password]     OK (password mode needs the password again)
+    STOP                  OK
+
+Errors are answered with 'ERR <message>'. Clients may send many requests
+before reading the replies, which come back in order. Writes are applied
+one at a time; reads never wait for them.
+"""
+import os
+import threading
+import time
+import socketserver
+
+import key_agent
+from env_crypto import EnvCrypto, agent_key_id, clear_key_cache, file_signature, read_kdf_params, validate_key
+
+# Forget the variables after this many seconds without a request
+DEFAULT_IDLE_TTL = 900
+
+# Drop clients that send a single line longer than this
+MAX_LINE_LENGTH = 1024 * 1024
+
+
+def get_socket_path():
+    """
+    Get the path of the config server socket
+
+    The ENV_CRYPTO_CONFIG_SOCK environment variable overrides the default,
+    which sits next to the key agent socket in the same owner-only directory.
+
+    Returns:
+        str: Path to the server socket
+    """
+    path = os.environ.get('ENV_CRYPTO_CONFIG_SOCK')
+    if path:
+        return path
+    return os.path.join(os.path.dirname(key_agent.get_socket_path()), 'config.sock')
+
+
+def query(lines, socket_path=None, timeout=5.0):
+    """
+    Send requests to the config server
+
+    Args:
+        lines (list): Request lines, e.g. ['GET DB_HOST', 'GET DB_PORT']
+        socket_path (str, optional): Path of the server socket
+        timeout (float): Socket timeout in seconds
+
+    Returns:
+        list or None: One reply line per request, or None if no server is running
+    """
+    if not key_agent.AGENT_SUPPORTED:
+        return None
+    return key_agent.send_requests(lines, socket_path or get_socket_path(), timeout)
+
+
+class _ConfigHandler(socketserver.BaseRequestHandler):
+    """Answer the pipelined requests of one client connection"""
+
+    def handle(self):
+        if not self.server.peer_allowed(self.request):
+            return
+
+        pending = b''
+        while not self.server.stopping:
+            data = self.request.recv(65536)
+            if not data:
+                return
+            *lines, pending = (pending + data).split(b'\n')
+            if len(pending) > MAX_LINE_LENGTH:
+                return
+
+            # Answer everything that has arrived with a single write
+            replies = []
+            for raw_line in lines:
+                line = raw_line.decode('utf-8', 'replace').rstrip('\r')
+                if line.strip():
+                    replies.append(self.server.dispatch(line).encode('utf-8') + b'\n')
+            if replies:
+                self.request.sendall(b''.join(replies))
+
+
+# PrivateUnixServer only exists where Unix domain sockets do
+if key_agent.AGENT_SUPPORTED:
+    class ConfigServer(key_agent.PrivateUnixServer):
+        """
+        Unix socket server that holds a decrypted configuration in memory
+        """
+
+        def __init__(self, env_file='.env.enc', password=None, key_file=None,
+                     idle_ttl=DEFAULT_IDLE_TTL, socket_path=None):
+            """
+            Initialize the server and bind its socket
+
+            Args:
+                env_file (str): Path to the encrypted .env file
+                password (str, optional): Password to decrypt the file
+                key_file (str, optional): Key file used when there is no password
+                idle_ttl (int): Seconds without requests after which the server locks
+                socket_path (str, optional): Path of the socket to listen on
+            """
+            self.env_file = env_file
+            self.key_file = key_file
+            self.idle_ttl = idle_ttl
+            self.crypto = None
+            self.values = None  # Variables in file order, None while locked
+            self.signature = None
+            self.agent_key_id = None  # Key agent entry of the password, if one was used
+            self.last_used = time.monotonic()
+            self.stopping = False
+            self.write_lock = threading.Lock()
+            super().__init__(socket_path or get_socket_path(), _ConfigHandler)
+
+        def unlock(self, password=None):
+            """
+            Decrypt the file and keep its variables in memory
+
+            Args:
+                password (str, optional): Password to decrypt the file, the key
+                                          file is used when it is not given
+
+            Returns:
+                bool: True if successful, False otherwise
+            """
+            crypto = EnvCrypto(password)
+            if not password:
+                if not self.key_file or not os.path.exists(self.key_file):
+                    return False
+                crypto.load_key_from_file(self.key_file)
+
+            with self.write_lock:
+                signature = file_signature(self.env_file)
+                env_dict, _ = crypto.get_env_values(self.env_file)
+                if not crypto.password_valid:
+                    return False
+                self.crypto, self.values, self.signature = crypto, env_dict, signature
+                kdf_params = read_kdf_params(self.env_file) if password else None
+                self.agent_key_id = agent_key_id(password, *kdf_params) if kdf_params else None
+            return True
+
+        def lock(self):
+            """
+            Drop the variables and the key
+
+            The derived key is also wiped from the in-process key cache and,
+            when the password went through the key agent, from the agent.
+            """
+            with self.write_lock:
+                self.crypto, self.values, self.signature = None, None, None
+                clear_key_cache()
+                if self.agent_key_id:
+                    key_agent.forget_key(self.agent_key_id)
+                    self.agent_key_id = None
+
+        def refresh(self):
+            """
+            Reload the variables if the file was changed by another program (caller holds write_lock)
+            """
+            signature = file_signature(self.env_file)
+            if signature != self.signature:
+                env_dict, _ = self.crypto.get_env_values(self.env_file)
+                if self.crypto.password_valid:
+                    self.values, self.signature = env_dict, signature
+
+        def write(self, change):
+            """
+            Apply a change to the variables and save the file
+
+            The change runs in a transaction against the file itself, so writes
+            by other programs in the meantime are never lost.
+
+            Args:
+                change (callable): Stages the change on an EnvTransaction, returns False if there is nothing to do
+
+            Returns:
+                str: The reply line
+            """
+            def apply(tx):
+                return change(tx), dict(tx.values)
+
+            with self.write_lock:
+                if self.values is None:
+                    return 'ERR locked'
+                try:
+                    outcome, values = self.crypto.run_transaction(apply, self.env_file)
+                except Exception as e:
+                    return f"ERR write failed: {e}"
+                # Readers pick up the new dictionary as a whole
+                self.values, self.signature = values, file_signature(self.env_file)
+            return 'MISS' if outcome is False else 'OK'
+
+        def dispatch(self, line):
+            """
+            Execute one request
+
+            Args:
+                line (str): The request line
+
+            Returns:
+                str: The reply line
+            """
+            self.last_used = time.monotonic()
+            command, _, rest = line.partition(' ')
+            command = command.upper()
+
+            if command == 'STATUS':
+                count = len(self.values) if self.values is not None else 0
+                return f"OK locked={int(self.values is None)} keys={count} idle_ttl={self.idle_ttl}"
+            if command == 'STOP':
+                self.stopping = True
+                self.lock()
+                threading.Thread(target=self.shutdown, daemon=True).start()
+                return 'OK'
+            if command == 'LOCK':
+                self.lock()
+                return 'OK'
+            if command == 'UNLOCK':
+                return 'OK' if self.unlock(rest or None) else 'ERR unlock failed'
+
+            if self.values is None:
+                return 'ERR locked'
+            if self.signature != file_signature(self.env_file):
+                with self.write_lock:
+                    if self.values is not None:
+                        self.refresh()
+
+            values = self.values
+            if values is None:
+                return 'ERR locked'
+            if command == 'GET' and rest:
+                value = values.get(rest)
+                return 'MISS' if value is None else f"OK {value}"
+            if command == 'LIST':
+                return ' '.join(['OK'] + [key for key in values if key.startswith(rest)])
+            if command == 'SET':
+                key, _, value = rest.partition(' ')
+                if not key:
+                    return 'ERR missing key'
+                try:
+                    validate_key(key)
+                except ValueError as e:
+                    return f"ERR {e}"
+                return self.write(lambda tx: tx.set(key, value))
+            if command == 'DEL' and rest:
+                return self.write(lambda tx: tx.delete(rest))
+            return 'ERR unknown request'
+
+        def run(self):
+            """
+            Serve requests until the server is stopped
+            """
+            def idle_locker():
+                # Lock the server when nobody has used it for a while
+                while True:
+                    time.sleep(min(self.idle_ttl, 30))
+                    if self.values is not None and time.monotonic() - self.last_used > self.idle_ttl:
+                        self.lock()
+
+            threading.Thread(target=idle_locker, daemon=True).start()
+            try:
+                self.serve_forever()
+            finally:
+                self.lock()
+                self.close_socket()
+
+
+def run_server(env_file='.env.enc', password=None, key_file=None, idle_ttl=DEFAULT_IDLE_TTL):
+    """
+    Run the config server in the foreground
+
+    Args:
+        env_file (str): Path to the encrypted .env file
+        password (str, optional): Password to decrypt the file
+        key_file (str, optional): Key file used when there is no password
+        idle_ttl (int): Seconds without requests after which the server locks
+
+    Returns:
+        bool: True when the server exited cleanly, False if it could not start
+    """
+    if not key_agent.AGENT_SUPPORTED:
+        print("Error: the config server needs Unix domain sockets, which this platform does not provide")
+        return False
+
+    if query(['STATUS']):
+        print(f"Error: a config server is already running on {get_socket_path()}")
+        return False
+
+    try:
+        server = ConfigServer(env_file, password, key_file, idle_ttl)
+    except OSError as e:
+        print(f"Error: could not start the config server: {e}")
+        return False
+    if not server.unlock(password):
+        print(f"Error: could not decrypt {env_file}")
+        server.close_socket()
+        return False
+
+    print(f"Config server listening on {server.socket_path} (idle lock after {idle_ttl}s)")
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+    print("Config server stopped")
+    return True
@@ -0,0 +1,233 @@
+"""
+Immutable, typed view of a decrypted configuration
+
+Values are converted once when the snapshot is built (booleans, integers,
+floats and ISO dates), so code on hot paths reads typed values instead of
+parsing strings again on every access.
+"""
+import datetime
+import re
+from collections.abc import Mapping
+
+TRUE_VALUES = frozenset(['true', 'yes', 'on', 'enabled'])
+FALSE_VALUES = frozenset(['false', 'no', 'off', 'disabled'])
+
+_INT_PATTERN = re.compile(r'[+-]?\d+\Z')
+_FLOAT_PATTERN = re.compile(r'[+-]?((0|[1-9]\d*)\.\d*|\.\d+)([eE][+-]?\d+)?\Z')
+_DATE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}\Z')
+_DATETIME_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?\Z')
+
+
+def parse_bool(value):
+    """
+    Convert a boolean setting
+
+    Args:
+        value (str): Text such as 'True', 'false', 'yes', 'off', '1' or '0'
+
+    Returns:
+        bool: The boolean value
+
+    Raises:
+        ValueError: If the text is not a boolean
+    """
+    text = value.strip().lower()
+    if text in TRUE_VALUES or text == '1':
+        return True
+    if text in FALSE_VALUES or text == '0':
+        return False
+    raise ValueError(f"not a boolean: {value!r}")
+
+
+def parse_date(value):
+    """
+    Convert an ISO date, as stored by the config menu
+
+    Args:
+        value (str): Text in YYYY-MM-DD form
+
+    Returns:
+        datetime.date: The date
+
+    Raises:
+        ValueError: If the text is not a date
+    """
+    return datetime.date.fromisoformat(value.strip())
+
+
+def parse_datetime(value):
+    """
+    Convert an ISO date and time
+
+    Args:
+        value (str): Text in YYYY-MM-DD HH:MM[:SS] or YYYY-MM-DDTHH:MM[:SS] form
+
+    Returns:
+        datetime.datetime: The date and time
+
+    Raises:
+        ValueError: If the text is not a date and time
+    """
+    return datetime.datetime.fromisoformat(value.strip())
+
+
+def infer_value(value):
+    """
+    Convert a value to the type its text looks like
+
+    Only unambiguous forms are converted: boolean words, integers, decimal
+    numbers and ISO dates. Anything else (including '1' and '0', which stay
+    integers) is kept as text. Numbers with leading zeros or a '+' sign
+    (codes such as CLAVE_PLAZA='007') are kept as text, since converting
+    them would lose digits.
+
+    Args:
+        value (str): The stored text
+
+    Returns:
+        bool, int, float, datetime.date, datetime.datetime or str: The converted value
+    """
+    text = value.strip()
+    lowered = text.lower()
+    try:
+        if lowered in TRUE_VALUES:
+            return True
+        if lowered in FALSE_VALUES:
+            return False
+        if _INT_PATTERN.match(text) and str(int(text)) == text:
+            return int(text)
+        if _FLOAT_PATTERN.match(text):
+            return float(text)
+        if _DATE_PATTERN.match(text):
+            return parse_date(text)
+        if _DATETIME_PATTERN.match(text):
+            return parse_datetime(text)
+    except ValueError:
+        pass
+    return value
+
+
+class ConfigSnapshot(Mapping):
+    """
+    Read-only, ordered mapping of typed configuration values
+
+    Values can be read as items (snapshot['DEBUG_MODE']) or attributes
+    (snapshot.DEBUG_MODE); both are a single dictionary lookup. Keys that
+    clash with mapping methods (e.g. 'items') are only reachable as items.
+    A snapshot never changes after it is built, so threads can share it
+    without locking.
+    """
+    __slots__ = ('_keys', '_values', '_raw', '_positions')
+
+    def __init__(self, values, types=None):
+        """
+        Convert and freeze a set of variables
+
+        Args:
+            values (dict or iterable): Variables as a dict or (key, value) pairs, in order
+            types (dict, optional): Converter for specific keys, e.g.
+                                    {'SPECIFIC_DATE': parse_bool, 'PORT': int, 'NAME': str};
+                                    other keys use infer_value
+
+        Raises:
+            ValueError: If a value does not convert with the converter given for its key
+        """
+        items = tuple(values.items() if isinstance(values, Mapping) else values)
+        types = types or {}
+        converted = []
+        for key, value in items:
+            converter = types.get(key, infer_value)
+            try:
+                converted.append(converter(value))
+            except ValueError as e:
+                raise ValueError(f"{key}: {e}") from None
+
+        set_slot = object.__setattr__
+        set_slot(self, '_keys', tuple(key for key, _ in items))
+        set_slot(self, '_raw', tuple(value for _, value in items))
+        set_slot(self, '_values', tuple(converted))
+        set_slot(self, '_positions', {key: i for i, key in enumerate(self._keys)})
+
+    @classmethod
+    def from_file(cls, crypto, input_file='.env.enc', keys=None, prefix=None, types=None):
+        """
+        Build a snapshot from an encrypted .env file
+
+        Args:
+            crypto (EnvCrypto): Unlocked crypto instance
+            input_file (str): Path to the encrypted .env file
+            keys (collection, optional): Only include these variables
+            prefix (str, optional): Only include variables starting with this prefix
+            types (dict, optional): Converters for specific keys
+
+        Returns:
+            ConfigSnapshot or None: The snapshot, or None if the file could not be read
+        """
+        env_dict, _ = crypto.get_env_values(input_file, keys, prefix)
+        if not crypto.password_valid:
+            return None
+        return cls(env_dict, types)
+
+    def __getitem__(self, key):
+        return self._values[self._positions[key]]
+
+    def __getattr__(self, name):
+        # Only called for names that are not slots or methods
+        try:
+            return self._values[self._positions[name]]
+        except KeyError:
+            raise AttributeError(f"no configuration value named {name!r}") from None
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ConfigSnapshot is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError("ConfigSnapshot is read-only")
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return f"ConfigSnapshot({len(self._keys)} values)"
+
+    def raw(self, key):
+        """
+        Get the stored text of a value
+
+        Args:
+            key (str): Variable name
+
+        Returns:
+            str: The value exactly as stored
+        """
+        return self._raw[self._positions[key]]
+
+    def as_environ(self):
+        """
+        Get the stored text of every value, for exporting to os.environ
+
+        Returns:
+            dict: Variable names and stored text, in order
+        """
+        return dict(zip(self._keys, self._raw))
+
+    def __reduce__(self):
+        # Rebuild from the stored text, e.g. when sent to a worker process
+        return (_rebuild_snapshot, (tuple(zip(self._keys, self._raw)), self._values))
+
+
+def _rebuild_snapshot(items, values):
+    """Restore a pickled snapshot without converting its values again"""
+    snapshot = ConfigSnapshot.__new__(ConfigSnapshot)
+    set_slot = object.__setattr__
+    set_slot(snapshot, '_keys', tuple(key for key, _ in items))
+    set_slot(snapshot, '_raw', tuple(value for _, value in items))
+    set_slot(snapshot, '_values', values)
+    set_slot(snapshot, '_positions', {key: i for i, key in enumerate(snapshot._keys)})
+    return snapshot
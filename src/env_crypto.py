@@ -2,109 +2,1748 @@
 Simple encryption/decryption module for .env files
 """
 import os
+import json
+import asyncio
 import base64
+import codecs
+import contextlib
+import functools
+import hashlib
+import hmac
+import shutil
+import random
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from cryptography.fernet import Fernet
+
+try:
+    import fcntl
+    msvcrt = None
+except ImportError:  # Windows: writer locks use msvcrt byte-range locks instead
+    fcntl = None
+    try:
+        import msvcrt
+    except ImportError:
+        msvcrt = None
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+import key_agent
+
+# Salt and iteration count of files written before the header existed
+KDF_SALT = b'fixed_salt_for_env_crypto'
+KDF_ITERATIONS = 100000
+
+# New files get a random salt and an iteration count calibrated so that
+# unlocking takes about KDF_TARGET_SECONDS on the machine creating them
+KDF_TARGET_SECONDS = 0.5
+KDF_MIN_ITERATIONS = 100000
+KDF_MAX_ITERATIONS = 10000000
+KDF_SALT_SIZE = 16
+
+# Encrypted files start with a small header:
+# magic, format version, header length, then the JSON header itself
+FILE_MAGIC = b'ENVC'
+FILE_VERSION = 1
+_FILE_PREFIX = struct.Struct('>4sBI')
+
+# Payload ciphers: Fernet tokens (URL-safe base64, AES-128-CBC + HMAC) in older
+# files, raw AES-256-GCM (12-byte nonce, ciphertext, 16-byte tag) in new ones
+CIPHER_FERNET = 'fernet'
+CIPHER_AES_GCM = 'aes-256-gcm'
+DEFAULT_CIPHER = CIPHER_AES_GCM
+_NONCE_SIZE = 12
+
+# Blob payloads are encrypted as a stream of independently authenticated
+# chunks, so large files never have to be held in memory at once
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Payload layouts: the whole .env text as one encrypted blob, or one
+# encrypted record per variable with an encrypted offset index in the header
+LAYOUT_BLOB = 'blob'
+LAYOUT_RECORDS = 'records'
+_RECORD_PREFIX = struct.Struct('>I')
+
+# Records hold a JSON [key, value] pair; files without this 'record_format'
+# in the header hold 'key=value' text
+RECORD_FORMAT_JSON = 'json'
+
+# Single-key changes to a records-layout file are appended as small encrypted
+# journal records; the journal is folded into a new snapshot once it grows
+# past either limit
+JOURNAL_MAX_RECORDS = 64
+JOURNAL_MAX_BYTES = 64 * 1024
+
+# Every payload gets a random id in the header. Blob chunks and journal
+# records are authenticated together with it and their position, and the
+# header holds an encrypted count of the committed journal records, so
+# pieces cannot be moved between files, reordered or cut off.
+PAYLOAD_ID_SIZE = 16
+_JOURNAL_COUNT = struct.Struct('>Q')
+
+# The JSON header is padded to a multiple of this size, so updating a header
+# field (e.g. after a password change) rarely changes the payload offset
+HEADER_BLOCK_SIZE = 256
+
+# Files are replaced through a temporary file that is synced and renamed into
+# place. Tests can set _crash_hook to a function that is called with the name
+# of each step ('before_fsync', 'before_rename', 'before_dir_fsync') to
+# simulate a crash at that point.
+_crash_hook = None
+_group_commit = threading.local()
+
+# Writers serialize on an advisory lock of a sidecar file (the encrypted file
+# itself is replaced on every rewrite, so it cannot carry the lock). Readers
+# never lock. Every rewrite bumps the 'generation' counter in the header, so
+# optimistic writers can check that nothing changed before they commit.
+LOCK_SUFFIX = '.lock'
+TRANSACTION_RETRIES = 10
+_held_locks = threading.local()
+
+_calibrated_iterations = None
+
+# In-process cache of derived keys, so repeated EnvCrypto objects with the
+# same password only pay for PBKDF2 once
+KEY_CACHE_MAX_ENTRIES = 16
+KEY_CACHE_TTL = 300  # seconds
+
+_key_cache = OrderedDict()  # (salt, iterations, password digest) -> [key, expiry time]
+_key_cache_lock = threading.Lock()
+
+
+def agent_key_id(password, salt=KDF_SALT, iterations=KDF_ITERATIONS):
+    """
+    Build the identifier under which the key agent caches a derived key
+    
+    Args:
+        password (str): Password the key is derived from
+        salt (bytes): KDF salt
+        iterations (int): KDF iteration count
+        
+    Returns:
+        str: Hex identifier that does not reveal the password
+    """
+    digest = hashlib.sha256(b'env_crypto agent key id\0')
+    digest.update(salt)
+    digest.update(iterations.to_bytes(8, 'big'))
+    digest.update(password.encode('utf-8'))
+    return digest.hexdigest()
+
+def _cache_lookup(cache_key):
+    """Return a cached key and mark it as recently used, or None"""
+    with _key_cache_lock:
+        entry = _key_cache.get(cache_key)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            _wipe_cache_entry(_key_cache.pop(cache_key))
+            return None
+        _key_cache.move_to_end(cache_key)
+        return bytes(entry[0])
+
+
+def _cache_store(cache_key, key):
+    """Store a derived key, evicting the least recently used entries"""
+    if KEY_CACHE_MAX_ENTRIES <= 0:
+        return
+    with _key_cache_lock:
+        old_entry = _key_cache.pop(cache_key, None)
+        if old_entry:
+            _wipe_cache_entry(old_entry)
+        _key_cache[cache_key] = [bytearray(key), time.monotonic() + KEY_CACHE_TTL]
+        while len(_key_cache) > KEY_CACHE_MAX_ENTRIES:
+            _, evicted = _key_cache.popitem(last=False)
+            _wipe_cache_entry(evicted)
+
+
+def _wipe_cache_entry(entry):
+    """Overwrite the key bytes of a cache entry"""
+    entry[0][:] = bytes(len(entry[0]))
+
+
+def clear_key_cache():
+    """
+    Wipe every derived key held by the in-process cache
+    """
+    with _key_cache_lock:
+        for entry in _key_cache.values():
+            _wipe_cache_entry(entry)
+        _key_cache.clear()
+
+
+def derive_key(password, salt=KDF_SALT, iterations=KDF_ITERATIONS, use_agent=True):
+    """
+    Derive a Fernet key from a password using PBKDF2
+    
+    The in-process cache is checked first, then the key agent, and only
+    then is PBKDF2 actually run.
+    
+    Args:
+        password (str): Password to derive the key from
+        salt (bytes): KDF salt
+        iterations (int): KDF iteration count
+        use_agent (bool): Ask the local key agent for cached keys
+        
+    Returns:
+        bytes: URL-safe base64 encoded key
+    """
+    cache_key = (salt, iterations, hashlib.sha256(password.encode('utf-8')).digest())
+    key = _cache_lookup(cache_key)
+    if key is not None:
+        return key
+    
+    # Ask the key agent so only the first call of a session pays for PBKDF2
+    key_id = agent_key_id(password, salt, iterations)
+    key = key_agent.get_key(key_id) if use_agent else None
+    
+    if key is None:
+        # hashlib releases the GIL while deriving, so other threads (and an
+        # event loop waiting on an executor) keep running
+        raw_key = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations, 32)
+        key = base64.urlsafe_b64encode(raw_key)
+        
+        if use_agent:
+            key_agent.put_key(key_id, key)
+    
+    _cache_store(cache_key, key)
+    return key
+
+def calibrate_iterations(target_seconds=KDF_TARGET_SECONDS):
+    """
+    Measure PBKDF2 speed and pick an iteration count for a target latency
+    
+    Args:
+        target_seconds (float): How long deriving a key should take
+        
+    Returns:
+        int: Iteration count, rounded and clamped to the allowed range
+    """
+    probe_iterations = 20000
+    start = time.perf_counter()
+    hashlib.pbkdf2_hmac('sha256', b'calibration', os.urandom(KDF_SALT_SIZE), probe_iterations, 32)
+    elapsed = max(time.perf_counter() - start, 1e-6)
+    
+    iterations = int(probe_iterations * target_seconds / elapsed) // 1000 * 1000
+    return max(KDF_MIN_ITERATIONS, min(iterations, KDF_MAX_ITERATIONS))
+
+
+def default_iterations():
+    """
+    Get the iteration count for new files, calibrating once per process
+    
+    Returns:
+        int: Iteration count
+    """
+    global _calibrated_iterations
+    if _calibrated_iterations is None:
+        _calibrated_iterations = calibrate_iterations()
+    return _calibrated_iterations
+
+
+def _crash_point(step):
+    """Give an injected crash the chance to happen at a step of a write"""
+    if _crash_hook is not None:
+        _crash_hook(step)
+
+
+def _fsync_directory(directory):
+    """
+    Make a rename in a directory durable
+    
+    Args:
+        directory (str): Path to the directory
+    """
+    if not hasattr(os, 'O_DIRECTORY'):
+        return  # Windows cannot open directories, renames are durable there
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='wb'):
+    """
+    Replace a file so that it holds either its old or its new contents, even after a crash
+    
+    The new contents go to a temporary file in the same directory, which is
+    synced, renamed over the target and followed by a sync of the directory.
+    The target keeps its permissions; new files are only readable by the owner.
+    
+    Usage:
+        with atomic_write('.env.enc') as f:
+            f.write(data)
+    
+    Args:
+        path (str): Path to the file to replace
+        mode (str): 'wb' or 'w'
+        
+    Yields:
+        file: The temporary file to write to
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            _crash_point('before_fsync')
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    
+    pending = getattr(_group_commit, 'pending', None)
+    if pending is not None:
+        # Renamed when the group commits; a later write of the same file replaces this one
+        superseded = pending.pop(os.path.abspath(path), None)
+        if superseded:
+            os.unlink(superseded)
+        pending[os.path.abspath(path)] = tmp_path
+        return
+    
+    _crash_point('before_rename')
+    os.replace(tmp_path, path)
+    _crash_point('before_dir_fsync')
+    _fsync_directory(directory)
+
+
+def _refuse_in_group(path):
+    """
+    Refuse a read-modify-write of a file inside group_commit()
+    
+    Inside a group, rewrites are only renamed into place when the block ends,
+    so reading the file back would miss them and appending to it would write
+    into the file that is about to be replaced.
+    
+    Args:
+        path (str): Path to the file about to be read and changed
+        
+    Raises:
+        RuntimeError: If a group commit is in progress on this thread
+    """
+    if getattr(_group_commit, 'pending', None) is not None:
+        raise RuntimeError(f"{path} cannot be read and changed inside group_commit(); "
+                           "only whole-file writes can be grouped")
+
+
+@contextlib.contextmanager
+def group_commit():
+    """
+    Commit the atomic writes made in a block together
+    
+    Each file is still written and synced as it is saved, but the renames
+    happen together when the block ends, followed by one directory sync per
+    directory. Only the last write of each file is kept. If the block raises,
+    none of the files is replaced. Writer locks taken inside the block are
+    held until the renames are done, so other writers never see a half
+    committed group.
+    
+    Files written inside the block keep their old contents until it ends, so
+    only whole-file writes can be grouped: single-key changes, journal
+    appends, compaction, password changes and transactions raise RuntimeError.
+    
+    Usage:
+        with group_commit():
+            crypto.set_env_values(values, output_file='.env.enc')
+            with atomic_write('.env.key') as f:
+                f.write(crypto.key)
+    """
+    if getattr(_group_commit, 'pending', None) is not None:
+        # Nested groups join the outer one
+        yield
+        return
+    
+    _group_commit.pending = pending = {}
+    _group_commit.locks = locks = []
+    try:
+        try:
+            yield
+        except BaseException:
+            for tmp_path in pending.values():
+                os.unlink(tmp_path)
+            raise
+        finally:
+            _group_commit.pending = None
+            _group_commit.locks = None
+        
+        directories = set()
+        _crash_point('before_rename')
+        for path, tmp_path in pending.items():
+            os.replace(tmp_path, path)
+            directories.add(os.path.dirname(path))
+        _crash_point('before_dir_fsync')
+        for directory in directories:
+            _fsync_directory(directory)
+    finally:
+        for lock_file in locks:
+            _unlock_fd(_held_locks.files.pop(lock_file)[0])
+
+
+def _lock_fd(fd):
+    """
+    Wait for the exclusive lock of an open lock file
+    
+    Args:
+        fd (int): Descriptor of the lock file
+    """
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return
+    # msvcrt locks the first byte; LK_LOCK gives up after about ten seconds, so keep waiting
+    while True:
+        try:
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue
+
+
+def _unlock_fd(fd):
+    """
+    Release the lock of a lock file and close it
+    
+    Args:
+        fd (int): Descriptor of the lock file
+    """
+    try:
+        if msvcrt is not None:
+            # Windows may keep a byte-range lock for a while after the file is closed
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+    finally:
+        os.close(fd)  # Also releases an fcntl lock
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Hold the exclusive writer lock of an encrypted file
+    
+    The lock is an advisory fcntl lock (a msvcrt byte-range lock on Windows)
+    on '<path>.lock'. It is re-entrant within a thread, and other threads
+    and processes wait for it. Inside group_commit() it is held until the
+    group's files are renamed. Without either module nothing is locked.
+    
+    Args:
+        path (str): Path to the encrypted file
+    """
+    if fcntl is None and msvcrt is None:
+        yield
+        return
+    
+    lock_file = os.path.abspath(path) + LOCK_SUFFIX
+    held = getattr(_held_locks, 'files', None)
+    if held is None:
+        held = _held_locks.files = {}
+    if lock_file in held:
+        held[lock_file][1] += 1
+        try:
+            yield
+        finally:
+            held[lock_file][1] -= 1
+        return
+    
+    fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        _lock_fd(fd)
+    except BaseException:
+        os.close(fd)
+        raise
+    held[lock_file] = [fd, 1]
+    
+    group_locks = getattr(_group_commit, 'locks', None)
+    if group_locks is not None:
+        # Released by group_commit() once the deferred renames are done
+        group_locks.append(lock_file)
+        yield
+        return
+    try:
+        yield
+    finally:
+        del held[lock_file]
+        _unlock_fd(fd)
+
+
+def read_version(path):
+    """
+    Get the version of an encrypted file for optimistic concurrency checks
+    
+    The header generation changes on every rewrite, and the size and the
+    committed journal count on every journal append, so together they
+    change on every write.
+    
+    Args:
+        path (str): Path to the encrypted file
+        
+    Returns:
+        tuple or None: (generation, size, encrypted journal count), or None if
+                       the file does not exist
+    """
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            header, _ = _read_header(f)
+    except FileNotFoundError:
+        return None
+    except (ValueError, struct.error):
+        return (0, size, None)
+    header = header or {}
+    return (header.get('generation', 0), size, header.get('journal'))
+
+
+def pack_header(header, header_len=None):
+    """
+    Serialize a file header
+    
+    Args:
+        header (dict): Header fields
+        header_len (int, optional): Pad the JSON header to exactly this size if it fits
+        
+    Returns:
+        bytes: The magic, version, length prefix and padded JSON header
+    """
+    header_data = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    if header_len is None or len(header_data) > header_len:
+        header_len = -(-len(header_data) // HEADER_BLOCK_SIZE) * HEADER_BLOCK_SIZE
+    header_data = header_data.ljust(header_len, b' ')
+    return _FILE_PREFIX.pack(FILE_MAGIC, FILE_VERSION, header_len) + header_data
+
+
+def _read_header(f):
+    """
+    Read the header from an open file, leaving it positioned at the payload
+    
+    Args:
+        f (file): Encrypted file opened in binary mode
+        
+    Returns:
+        tuple: (header dict, or None for headerless legacy files, payload offset)
+    """
+    prefix = f.read(_FILE_PREFIX.size)
+    if len(prefix) < _FILE_PREFIX.size or not prefix.startswith(FILE_MAGIC):
+        f.seek(0)
+        return None, 0
+    
+    _, version, header_len = _FILE_PREFIX.unpack(prefix)
+    if version > FILE_VERSION:
+        raise ValueError(f"Unsupported file format version {version}")
+    header = json.loads(f.read(header_len).decode('utf-8'))
+    return header, _FILE_PREFIX.size + header_len
+
+
+def read_header(input_file):
+    """
+    Read only the header of an encrypted file
+    
+    Args:
+        input_file (str): Path to the encrypted file
+        
+    Returns:
+        tuple: (header dict, or None for headerless legacy files, payload offset)
+    """
+    with open(input_file, 'rb') as f:
+        return _read_header(f)
+
+
+def file_signature(path):
+    """
+    Get a cheap signature that changes whenever a file is rewritten or appended to
+    
+    Args:
+        path (str): Path to the file
+        
+    Returns:
+        tuple or None: (device, inode, size, mtime_ns), or None if the file is missing
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def read_container(input_file):
+    """
+    Read an encrypted file and split it into header and payload
+    
+    Args:
+        input_file (str): Path to the encrypted file
+        
+    Returns:
+        tuple: (header dict, or None for headerless legacy files, payload bytes)
+    """
+    with open(input_file, 'rb') as f:
+        header, _ = _read_header(f)
+        return header, f.read()
+
+
+def parse_env_content(content):
+    """
+    Parse .env text into a dictionary
+    
+    Args:
+        content (str): Contents of a .env file
+        
+    Returns:
+        tuple: (dict of environment variables, list of keys in original order)
+    """
+    return parse_env_lines(content.splitlines())
+
+
+def parse_env_lines(lines):
+    """
+    Parse .env lines into a dictionary
+    
+    Args:
+        lines (iterable): Lines of a .env file
+        
+    Returns:
+        tuple: (dict of environment variables, list of keys in original order)
+    """
+    env_dict = {}
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+            
+        if '=' in line:
+            key, value = line.split('=', 1)
+            env_dict[key] = value
+    
+    # Dictionaries keep insertion order, which is the original order of keys
+    return env_dict, list(env_dict)
+
+
+def iter_file_chunks(f, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Read an open file in chunks
+    
+    Args:
+        f (file): File opened in binary mode
+        chunk_size (int): Size of each chunk
+        
+    Yields:
+        bytes: The next chunk of the file
+    """
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_text_lines(pieces):
+    """
+    Split a stream of UTF-8 data into text lines
+    
+    Args:
+        pieces (iterable): Pieces of UTF-8 encoded data, split anywhere
+        
+    Yields:
+        str: Lines without their line endings
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = ''
+    for piece in pieces:
+        pending += decoder.decode(piece)
+        lines = pending.splitlines(keepends=True)
+        # The last line may continue in the next piece
+        pending = lines.pop() if lines and not lines[-1].endswith(('\n', '\r')) else ''
+        for line in lines:
+            yield line.rstrip('\r\n')
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+
+def _rechunk(pieces, chunk_size):
+    """
+    Regroup a stream of data into chunks of a fixed size
+    
+    Args:
+        pieces (iterable): Pieces of data of any size
+        chunk_size (int): Size of each chunk
+        
+    Yields:
+        tuple: (chunk, True if it is the last one). At least one chunk
+               is produced, even for empty input.
+    """
+    buffer = bytearray()
+    for piece in pieces:
+        buffer += piece
+        # Always keep some data back: only the last chunk may be marked final
+        pos = 0
+        while len(buffer) - pos > chunk_size:
+            yield bytes(buffer[pos:pos + chunk_size]), False
+            pos += chunk_size
+        del buffer[:pos]
+    yield bytes(buffer), True
+
+
+def _ordered_map(func, items, workers=1):
+    """
+    Apply a function to a stream of items, optionally on a thread pool
+    
+    Results come back in input order. At most a few items per worker are in
+    flight at once, so memory stays bounded however long the stream is.
+    
+    Args:
+        func (callable): Function to apply
+        items (iterable): Input items
+        workers (int): Number of threads, 1 runs everything on the calling thread
+        
+    Yields:
+        The results of func, in input order
+    """
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _journal_context(header, seq):
+    """Associated data for a journal record: the payload it extends and its position"""
+    if 'payload_id' not in header:
+        return b'journal'  # Files written before journal records were numbered
+    return b'journal' + base64.b64decode(header['payload_id']) + struct.pack('>Q', seq)
+
+
+def _journal_count_context(header):
+    """Associated data for the committed journal record count of a header"""
+    return b'journal-count' + base64.b64decode(header['payload_id'])
+
+
+def _chunk_context(header, index, final):
+    """Associated data for a stream chunk: its payload, its position and whether it is the last one"""
+    payload_id = base64.b64decode(header['payload_id']) if 'payload_id' in header else b''
+    return b'blob' + payload_id + struct.pack('>Q?', index, final)
+
+
+def key_selected(key, keys=None, prefix=None):
+    """
+    Check whether a variable passes a key list and prefix filter
+    
+    Args:
+        key (str): Variable name
+        keys (collection, optional): Accepted names, None for any
+        prefix (str, optional): Required name prefix, None for any
+        
+    Returns:
+        bool: True if the variable is selected
+    """
+    return (keys is None or key in keys) and (prefix is None or key.startswith(prefix))
+
+
+def validate_key(key):
+    """
+    Check that a variable name can be stored and read back
+    
+    Names end at the first '=' of a .env line and at a line break, so
+    they cannot contain either.
+    
+    Args:
+        key (str): Variable name
+        
+    Raises:
+        ValueError: If the name is empty or contains '=', a line break or a NUL
+    """
+    if not isinstance(key, str) or not key:
+        raise ValueError("variable name cannot be empty")
+    if any(c in key for c in '=\r\n\0'):
+        raise ValueError(f"invalid variable name {key!r}: names cannot contain '=' or line breaks")
+
+
+def ordered_items(env_dict, key_order=None):
+    """
+    List the items of a dictionary in a given key order
+    
+    Args:
+        env_dict (dict): Dictionary of environment variables
+        key_order (list, optional): Keys in the order they should appear,
+                                    keys missing from it are added at the end
+        
+    Returns:
+        list: (key, value) pairs
+    """
+    if not key_order:
+        return list(env_dict.items())
+    all_keys = dict.fromkeys(key_order)
+    all_keys.update(dict.fromkeys(env_dict))
+    return [(k, env_dict[k]) for k in all_keys if k in env_dict]
+
+
+def header_cipher(header):
+    """
+    Get the payload cipher of a file header
+    
+    Args:
+        header (dict or None): Parsed header, None for legacy files
+        
+    Returns:
+        str: CIPHER_FERNET or CIPHER_AES_GCM
+    """
+    if not header:
+        return CIPHER_FERNET
+    return header.get('cipher', CIPHER_FERNET)
+
+
+def header_layout(header):
+    """
+    Get the payload layout of a file header
+    
+    Args:
+        header (dict or None): Parsed header, None for legacy files
+        
+    Returns:
+        str: LAYOUT_BLOB or LAYOUT_RECORDS
+    """
+    if not header:
+        return LAYOUT_BLOB
+    return header.get('layout', LAYOUT_BLOB)
+
+
+def key_check_value(key):
+    """
+    Compute the key check value stored in file headers
+    
+    The value is a truncated HMAC made with the data key, so it can only be
+    produced by someone who holds the key and reveals nothing about it.
+    
+    Args:
+        key (bytes): URL-safe base64 encoded data key
+        
+    Returns:
+        str: Base64 encoded key check value
+    """
+    mac = hmac.new(base64.urlsafe_b64decode(key), b'env_crypto key check', hashlib.sha256)
+    return base64.b64encode(mac.digest()[:16]).decode('ascii')
+
+
+def kdf_params_from_header(header):
+    """
+    Get the KDF parameters recorded in a file header
+    
+    Args:
+        header (dict or None): Parsed header, None for legacy files
+        
+    Returns:
+        tuple or None: (salt, iterations), or None if the file has no password slot
+    """
+    if header is None:
+        return KDF_SALT, KDF_ITERATIONS
+    kdf = header.get('kdf')
+    if not kdf:
+        return None
+    return base64.b64decode(kdf['salt']), kdf['iterations']
+
+
+def read_kdf_params(input_file='.env.enc'):
+    """
+    Get the KDF parameters of an encrypted file
+    
+    Args:
+        input_file (str): Path to the encrypted file
+        
+    Returns:
+        tuple or None: (salt, iterations), or None if the file has no password slot
+    """
+    header, _ = read_header(input_file)
+    return kdf_params_from_header(header)
+
+class ConcurrentModificationError(Exception):
+    """Raised when an encrypted file changed while a transaction was open"""
+
 
 class EnvCrypto:
     """
     A simple class to encrypt and decrypt .env files
     """
-    def __init__(self, password=None):
+    def __init__(self, password=None, use_agent=True):
+        """
+        Initialize the EnvCrypto class
+        
+        Args:
+            password (str, optional): Password to derive the key from
+            use_agent (bool): Ask the local key agent for cached keys
+        """
+        self._key = None
+        self._cipher = None
+        self.kdf = None  # (salt, iterations) of the password slot protecting the key
+        self.wrapped_key = None  # Data key encrypted with the password key
+        self.key_from_file = False
+        self.password = password
+        self.password_valid = False
+        self.use_agent = use_agent
+        self.write_cipher = DEFAULT_CIPHER  # Payload cipher used when writing files
+        self.workers = 1  # Threads used to encrypt and decrypt chunked payloads
+        self._payload_cipher = CIPHER_FERNET  # Payload cipher of the file being read
+        self._aead = None
+        
+        # With a password the data key comes from the header of the file
+        # being opened, so it is only loaded (or created) once it is needed
+        if not password:
+            # Generate a random key
+            self.generate_random_key()
+    
+    @property
+    def key(self):
+        """The data key, a new random one protected by the password if none is loaded yet"""
+        if self._key is None and self.password:
+            self.change_password(self.password)
+        return self._key
+    
+    @property
+    def cipher(self):
+        """The Fernet cipher for the data key"""
+        if self._cipher is None and self.password:
+            self.change_password(self.password)
+        return self._cipher
+    
+    def _set_key(self, key):
+        """Use a data key for encryption and decryption"""
+        self._cipher = Fernet(key)
+        self._key = key
+        self._aead = None
+    
+    def _aead_cipher(self):
+        """The AES-256-GCM cipher, keyed with a subkey of the data key"""
+        if self._aead is None:
+            hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b'env_crypto aes-256-gcm')
+            self._aead = AESGCM(hkdf.derive(base64.urlsafe_b64decode(self.key)))
+        return self._aead
+    
+    def _seal(self, data, context):
+        """
+        Encrypt data with the payload cipher of the current file
+        
+        Args:
+            data (bytes): Plain data
+            context (bytes): What the data is (e.g. b'record'), authenticated
+                             but not stored, so pieces cannot be swapped around
+                             
+        Returns:
+            bytes: Encrypted data
+        """
+        if self._payload_cipher == CIPHER_FERNET:
+            return self.cipher.encrypt(data)
+        nonce = os.urandom(_NONCE_SIZE)
+        return nonce + self._aead_cipher().encrypt(nonce, data, context)
+    
+    def _open(self, sealed, context):
+        """
+        Decrypt data sealed with the payload cipher of the current file
+        
+        Args:
+            sealed (bytes): Encrypted data
+            context (bytes): The context the data was sealed with
+            
+        Returns:
+            bytes: Plain data
+        """
+        if self._payload_cipher == CIPHER_FERNET:
+            return self.cipher.decrypt(sealed)
+        return self._aead_cipher().decrypt(sealed[:_NONCE_SIZE], sealed[_NONCE_SIZE:], context)
+    
+    def _begin_write(self, output_file):
+        """
+        Build the header for a new payload and select the write cipher
+        
+        Args:
+            output_file (str): Path of the file that will be written
+            
+        Returns:
+            dict: Header fields
+        """
+        header = self._header_for_write(output_file)
+        header['cipher'] = self._payload_cipher = self.write_cipher
+        header['payload_id'] = base64.b64encode(os.urandom(PAYLOAD_ID_SIZE)).decode('ascii')
+        return header
+    
+    def _seal_text(self, data, context):
+        """
+        Encrypt data for a header field
+        
+        Args:
+            data (bytes): Plain data
+            context (bytes): The context to seal the data with
+            
+        Returns:
+            str: Encrypted data as ASCII text
+        """
+        sealed = self._seal(data, context)
+        if self._payload_cipher == CIPHER_FERNET:
+            return sealed.decode('ascii')  # Fernet tokens are already text
+        return base64.b64encode(sealed).decode('ascii')
+    
+    def _open_text(self, text, context):
+        """
+        Decrypt a header field sealed with _seal_text
+        
+        Args:
+            text (str): Encrypted data as ASCII text
+            context (bytes): The context the data was sealed with
+            
+        Returns:
+            bytes: Plain data
+        """
+        if self._payload_cipher == CIPHER_FERNET:
+            return self._open(text.encode('ascii'), context)
+        return self._open(base64.b64decode(text), context)
+    
+    def derive_key_from_password(self, password, salt=None, iterations=None):
+        """
+        Derive the password key using PBKDF2
+        
+        The password key only encrypts (wraps) the data key stored in the
+        file header. In files written before envelope encryption it is the
+        data key itself.
+        
+        Args:
+            password (str): Password to derive the key from
+            salt (bytes, optional): KDF salt, a random one is used if None
+            iterations (int, optional): Iteration count, calibrated if None
+            
+        Returns:
+            bytes: The derived password key
+        """
+        if salt is None:
+            salt = os.urandom(KDF_SALT_SIZE)
+        if iterations is None:
+            iterations = default_iterations()
+        
+        self.kdf = (salt, iterations)
+        self.password = password
+        return derive_key(password, salt, iterations, use_agent=self.use_agent)
+    
+    def generate_random_key(self):
+        """
+        Generate a random key
+        """
+        self._set_key(Fernet.generate_key())
+        self.kdf = None
+        self.wrapped_key = None
+    
+    def change_password(self, new_password):
+        """
+        Protect the data key with a new password
+        
+        The data key itself is kept, so only the file header has to be
+        rewritten. A key that was derived directly from the old password
+        (files without envelope encryption) is replaced by a random data key,
+        which means the payload has to be re-encrypted once.
+        
+        Args:
+            new_password (str): The new password
+        """
+        if self._key is None or (self.wrapped_key is None and (self.kdf or self.key_from_file)):
+            self.generate_random_key()
+        
+        password_key = self.derive_key_from_password(new_password)
+        self.wrapped_key = Fernet(password_key).encrypt(self._key).decode('ascii')
+        self.key_from_file = False
+    
+    def _unlock(self, header):
+        """
+        Load the data key for a file header
+        
+        Args:
+            header (dict or None): Parsed header of the file, None for legacy files
+            
+        Raises:
+            cryptography.fernet.InvalidToken: If the password cannot unwrap the data key
+        """
+        params = kdf_params_from_header(header)
+        wrapped_key = header.get('wrapped_key') if header else None
+        
+        if self.key_from_file or not self.password or params is None:
+            # The data key is already loaded, just remember the password slot of the file
+            self.kdf, self.wrapped_key = params, wrapped_key
+            return
+        
+        if self._key is not None and (params, wrapped_key) == (self.kdf, self.wrapped_key):
+            return
+        
+        password_key = self.derive_key_from_password(self.password, *params)
+        if wrapped_key:
+            data_key = Fernet(password_key).decrypt(wrapped_key.encode('ascii'))
+        else:
+            data_key = password_key
+        self._set_key(data_key)
+        self.wrapped_key = wrapped_key
+    
+    def _check_key(self, header):
+        """
+        Check the current data key against the key check value of a header
+        
+        Args:
+            header (dict or None): Parsed header of the file
+            
+        Returns:
+            bool or None: Whether the key matches, None if the header has no key check value
+        """
+        if not header or 'kcv' not in header:
+            return None
+        if self._key is None:
+            return False
+        return hmac.compare_digest(key_check_value(self._key), header['kcv'])
+    
+    def verify_password(self, input_file='.env.enc'):
+        """
+        Check the password (or loaded key) using only the file header
+        
+        The data key is unwrapped and compared with the key check value in
+        the header, so the cost does not depend on the size of the file.
+        Files without a key check value are verified by decrypting them.
+        
+        Args:
+            input_file (str): Path to the encrypted .env file
+            
+        Returns:
+            bool: True if the password or key opens the file, False otherwise
+        """
+        try:
+            header, _ = read_header(input_file)
+            if not header or 'kcv' not in header:
+                content = self.decrypt_env_file(input_file)
+                return content is not None and self.password_valid
+            
+            self._unlock(header)
+            self.password_valid = bool(self._check_key(header))
+        except Exception:
+            self.password_valid = False
+        return self.password_valid
+    
+    def _header_for_write(self, output_file):
+        """
+        Build the header for a file about to be written
+        
+        Args:
+            output_file (str): Path of the file that will be written
+            
+        Returns:
+            dict: Header fields
+            
+        Raises:
+            ValueError: If a loaded key file does not open the existing file
+        """
+        if self.key_from_file and self.kdf is None and os.path.exists(output_file):
+            # Keep the password slot of the existing file, which only works if it wraps this key
+            header, _ = read_header(output_file)
+            if self._check_key(header) is False:
+                raise ValueError(f"the key file does not match {output_file}")
+            self.kdf = kdf_params_from_header(header)
+            self.wrapped_key = header.get('wrapped_key') if header else None
+        elif self.password and self._key is None:
+            # New file: random data key protected by the password
+            self.change_password(self.password)
+        
+        version = read_version(output_file)
+        header = {'generation': (version[0] if version else 0) + 1}
+        if self.kdf:
+            header['kdf'] = {
+                'name': 'pbkdf2-sha256',
+                'salt': base64.b64encode(self.kdf[0]).decode('ascii'),
+                'iterations': self.kdf[1],
+            }
+        if self.wrapped_key:
+            header['wrapped_key'] = self.wrapped_key
+        header['kcv'] = key_check_value(self.key)
+        return header
+    
+    def _write_blob(self, pieces, output_file, workers=None):
+        """
+        Encrypt a stream of data as a blob and write it with a header
+        
+        With AES-GCM the data is sealed chunk by chunk as it arrives, so
+        memory use does not depend on the size of the data.
+        
+        Args:
+            pieces (iterable): Pieces of plain data of any size
+            output_file (str): Path to the encrypted file
+            workers (int, optional): Threads sealing chunks, defaults to self.workers
+        """
+        with file_lock(output_file):
+            header = self._begin_write(output_file)
+            
+            if self.write_cipher == CIPHER_FERNET:
+                # Fernet tokens cannot be streamed
+                with atomic_write(output_file) as f:
+                    f.write(pack_header(header))
+                    f.write(self._seal(b''.join(pieces), b'blob'))
+                return
+            
+            header['chunk_size'] = STREAM_CHUNK_SIZE
+            with atomic_write(output_file) as f:
+                f.write(pack_header(header))
+                for frame in self._seal_stream(header, _rechunk(pieces, STREAM_CHUNK_SIZE), workers):
+                    f.write(frame)
+    
+    def _seal_stream(self, header, chunks, workers=None):
+        """
+        Encrypt a stream of chunks
+        
+        Each chunk is authenticated together with the payload id of the file,
+        its position and a flag marking the last one, so chunks cannot be moved
+        between files, reordered, dropped or cut off.
+        Chunks are independent, so they can be sealed on several threads.
+        
+        Args:
+            header (dict): Header of the file being written
+            chunks (iterable): (chunk, is last chunk) pairs
+            workers (int, optional): Threads sealing chunks, defaults to self.workers
+            
+        Yields:
+            bytes: Length-prefixed encrypted chunks, in order
+        """
+        def seal_chunk(numbered_chunk):
+            index, (chunk, final) = numbered_chunk
+            sealed = self._seal(chunk, _chunk_context(header, index, final))
+            return _RECORD_PREFIX.pack(len(sealed)) + sealed
+        
+        self._aead_cipher()  # Create the shared cipher before the threads start
+        yield from _ordered_map(seal_chunk, enumerate(chunks), workers or self.workers)
+    
+    def _open_stream(self, f, header, workers=None):
+        """
+        Decrypt the chunks of a streamed blob
+        
+        Args:
+            f (file): Encrypted file positioned at the start of the payload
+            header (dict): Parsed header of the file
+            workers (int, optional): Threads opening chunks, defaults to self.workers
+            
+        Yields:
+            bytes: Decrypted chunks, in order
+        """
+        def open_chunk(frame):
+            index, sealed, final = frame
+            return self._open(sealed, _chunk_context(header, index, final))
+        
+        self._aead_cipher()  # Create the shared cipher before the threads start
+        yield from _ordered_map(open_chunk, self._read_stream_frames(f), workers or self.workers)
+    
+    def _read_stream_frames(self, f):
+        """
+        Read the encrypted chunks of a streamed blob
+        
+        Args:
+            f (file): Encrypted file positioned at the start of the payload
+            
+        Yields:
+            tuple: (chunk index, encrypted chunk, True if it is the last one)
+        """
+        start = f.tell()
+        file_end = f.seek(0, os.SEEK_END)
+        f.seek(start)
+        
+        index = 0
+        while True:
+            prefix = f.read(_RECORD_PREFIX.size)
+            if len(prefix) < _RECORD_PREFIX.size:
+                raise ValueError("truncated encrypted stream")
+            length = _RECORD_PREFIX.unpack(prefix)[0]
+            sealed = f.read(length)
+            if len(sealed) < length:
+                raise ValueError("truncated encrypted stream")
+            
+            final = f.tell() == file_end
+            yield index, sealed, final
+            if final:
+                return
+            index += 1
+    
+    def _iter_blob(self, f, header, workers=None):
+        """
+        Decrypt the payload of a blob-layout file
+        
+        Args:
+            f (file): Encrypted file positioned at the start of the payload
+            header (dict or None): Parsed header of the file
+            workers (int, optional): Threads opening chunks, defaults to self.workers
+            
+        Yields:
+            bytes: Pieces of the decrypted .env text
+        """
+        if header and 'chunk_size' in header:
+            yield from self._open_stream(f, header, workers)
+        else:
+            yield self._open(f.read(), b'blob')
+    
+    def _write_records(self, items, output_file):
+        """
+        Encrypt each variable as its own record and write them with an index
+        
+        Args:
+            items (list): (key, value) pairs in the order they should appear
+            output_file (str): Path to the encrypted file
+        """
+        with file_lock(output_file):
+            header = self._begin_write(output_file)
+            
+            payload = bytearray()
+            index = []  # [key, offset of its record in the payload]
+            for key, value in items:
+                record = self._seal(json.dumps([key, value]).encode('utf-8'), b'record')
+                index.append([key, len(payload)])
+                payload += _RECORD_PREFIX.pack(len(record)) + record
+            
+            header['layout'] = LAYOUT_RECORDS
+            header['record_format'] = RECORD_FORMAT_JSON
+            header['index'] = self._seal_text(json.dumps(index).encode('utf-8'), b'index')
+            header['body_len'] = len(payload)  # The journal starts after the snapshot
+            header['journal'] = self._seal_text(_JOURNAL_COUNT.pack(0), _journal_count_context(header))
+            with atomic_write(output_file) as f:
+                f.write(pack_header(header))
+                f.write(payload)
+    
+    def _read_unlocked_header(self, f):
+        """
+        Read the header of an open file and load the matching data key
+        
+        Args:
+            f (file): Encrypted file opened in binary mode
+            
+        Returns:
+            dict or None: The header, the file is left positioned at the payload
+            
+        Raises:
+            Exception: If the password or key does not open the file
+        """
+        header, _ = _read_header(f)
+        self._load_header_key(header)
+        return header
+    
+    def _load_header_key(self, header):
+        """
+        Load the data key for a header and check it before any payload is read
+        
+        Args:
+            header (dict or None): Parsed header of the file
+            
+        Raises:
+            Exception: If the password or key does not open the file
+        """
+        self._unlock(header)
+        if self._check_key(header) is False:
+            raise ValueError("key does not match this file")
+        self._payload_cipher = header_cipher(header)
+    
+    def _read_record(self, f, header, expected_key):
+        """
+        Read and decrypt the record at the current position of a file
+        
+        Args:
+            f (file): Encrypted file opened in binary mode
+            header (dict): Parsed header of the file
+            expected_key (str): The key the index lists for this record
+            
+        Returns:
+            tuple: (key, value)
+        """
+        prefix = f.read(_RECORD_PREFIX.size)
+        if len(prefix) < _RECORD_PREFIX.size:
+            raise ValueError("truncated record")
+        record = f.read(_RECORD_PREFIX.unpack(prefix)[0])
+        text = self._open(record, b'record').decode('utf-8')
+        if header.get('record_format') == RECORD_FORMAT_JSON:
+            key, value = json.loads(text)
+            return key, value
+        
+        # Older files store 'key=value', which is ambiguous if the key has an '='
+        if text.startswith(expected_key + '='):
+            return expected_key, text[len(expected_key) + 1:]
+        key, value = text.split('=', 1)
+        return key, value
+    
+    def _read_records(self, f, header, keys=None, prefix=None):
+        """
+        Read records through the encrypted index of a records-layout file
+        
+        Args:
+            f (file): Encrypted file positioned at the start of the payload
+            header (dict): Parsed header of the file
+            keys (collection, optional): Only decrypt the records of these keys
+            prefix (str, optional): Only decrypt the records of keys with this prefix
+            
+        Returns:
+            list: (key, value) pairs in file order
+        """
+        payload_start = f.tell()
+        index = json.loads(self._open_text(header['index'], b'index'))
+        
+        # Replay the journal: the last change of each key wins (None = deleted)
+        changes = {}
+        if 'body_len' in header:
+            for entry in self._read_journal(f, header, payload_start + header['body_len']):
+                changes[entry['key']] = entry['value'] if entry['op'] == 'set' else None
+        
+        items = []
+        for key, offset in index:
+            if not key_selected(key, keys, prefix):
+                continue
+            if key in changes:
+                if changes[key] is not None:
+                    items.append((key, changes[key]))
+                continue
+            f.seek(payload_start + offset)
+            record_key, value = self._read_record(f, header, key)
+            if record_key != key:
+                raise ValueError(f"record for {key} does not match the index")
+            items.append((key, value))
+        
+        # Keys added since the snapshot go at the end
+        indexed_keys = {key for key, _ in index}
+        for key, value in changes.items():
+            if value is not None and key not in indexed_keys and key_selected(key, keys, prefix):
+                items.append((key, value))
+        return items
+    
+    def _journal_count(self, header):
+        """
+        Get the number of committed journal records from a header
+        
+        Args:
+            header (dict): Parsed header of a records-layout file
+            
+        Returns:
+            int or None: The record count, None for files that do not store it
+        """
+        if 'journal' not in header:
+            return None
+        return _JOURNAL_COUNT.unpack(self._open_text(header['journal'], _journal_count_context(header)))[0]
+    
+    def _read_journal(self, f, header, journal_start):
+        """
+        Read the journal records of a records-layout file
+        
+        Records past the committed count in the header (an append that was
+        interrupted before the header was updated) are ignored. In older files
+        without the count, a record cut short at the end of the file is ignored.
+        
+        Args:
+            f (file): Encrypted file opened in binary mode
+            header (dict): Parsed header of the file
+            journal_start (int): File offset of the first journal record
+            
+        Yields:
+            dict: Journal entries with 'op', 'key' and, for sets, 'value'
+            
+        Raises:
+            ValueError: If the file ends before the committed records
+        """
+        committed = self._journal_count(header)
+        f.seek(journal_start)
+        seq = 0
+        while committed is None or seq < committed:
+            prefix = f.read(_RECORD_PREFIX.size)
+            length = _RECORD_PREFIX.unpack(prefix)[0] if len(prefix) == _RECORD_PREFIX.size else 0
+            record = f.read(length)
+            if len(prefix) < _RECORD_PREFIX.size or len(record) < length:
+                if committed is not None:
+                    raise ValueError("the journal is shorter than the header says")
+                return
+            yield json.loads(self._open(record, _journal_context(header, seq)))
+            seq += 1
+    
+    def _journal_stats(self, f, journal_start, limit=None):
+        """
+        Count the journal records of a file without decrypting them
+        
+        Args:
+            f (file): Encrypted file opened in binary mode
+            journal_start (int): File offset of the first journal record
+            limit (int, optional): Stop after this many records
+            
+        Returns:
+            tuple: (number of complete records, file offset where the last one ends)
+        """
+        file_end = f.seek(0, os.SEEK_END)
+        count = 0
+        journal_end = journal_start
+        while (limit is None or count < limit) and journal_end + _RECORD_PREFIX.size <= file_end:
+            f.seek(journal_end)
+            length = _RECORD_PREFIX.unpack(f.read(_RECORD_PREFIX.size))[0]
+            if journal_end + _RECORD_PREFIX.size + length > file_end:
+                break
+            journal_end += _RECORD_PREFIX.size + length
+            count += 1
+        return count, journal_end
+    
+    def _append_journal(self, input_file, entry):
+        """
+        Append a change to the journal of a records-layout file
+        
+        Args:
+            input_file (str): Path to the encrypted .env file
+            entry (dict): Journal entry with 'op', 'key' and, for sets, 'value'
+            
+        Returns:
+            bool or None: True if appended, None if the file has no journal
+                          (or an older one without a committed count) and
+                          must be rewritten instead
+                          
+        Raises:
+            ValueError: If the file ends before the committed records
+        """
+        _refuse_in_group(input_file)
+        with file_lock(input_file):
+            if not os.path.exists(input_file):
+                return None
+            
+            with open(input_file, 'r+b') as f:
+                header = self._read_unlocked_header(f)
+                if header_layout(header) != LAYOUT_RECORDS or 'journal' not in header:
+                    return None
+                payload_start = f.tell()
+                journal_start = payload_start + header['body_len']
+                
+                committed = self._journal_count(header)
+                count, journal_end = self._journal_stats(f, journal_start, committed)
+                if count < committed:
+                    raise ValueError("the journal is shorter than the header says")
+                
+                # Drop whatever an interrupted append left behind the committed records
+                if f.seek(0, os.SEEK_END) > journal_end:
+                    f.truncate(journal_end)
+                
+                record = self._seal(json.dumps(entry).encode('utf-8'), _journal_context(header, count))
+                f.seek(journal_end)
+                f.write(_RECORD_PREFIX.pack(len(record)) + record)
+                f.flush()
+                os.fsync(f.fileno())
+                count += 1
+                size = f.tell() - journal_start
+                
+                # The record is committed once the header counts it. The count has
+                # a fixed size, so the header is rewritten in place at the same length.
+                header['journal'] = self._seal_text(_JOURNAL_COUNT.pack(count), _journal_count_context(header))
+                header_block = pack_header(header, payload_start - _FILE_PREFIX.size)
+                if len(header_block) != payload_start:
+                    raise ValueError("the journal count does not fit the header")
+                f.seek(0)
+                f.write(header_block)
+                f.flush()
+                os.fsync(f.fileno())
+            
+            if count > JOURNAL_MAX_RECORDS or size > JOURNAL_MAX_BYTES:
+                self.compact_env_file(input_file)
+            return True
+    
+    def compact_env_file(self, input_file='.env.enc'):
         """
-        Initialize the EnvCrypto class
+        Fold the journal of an encrypted file into a new snapshot
         
         Args:
-            password (str, optional): Password to derive the key from
+            input_file (str): Path to the encrypted .env file
+            
+        Returns:
+            bool: True if successful, False otherwise
         """
-        self.key = None
-        self.password = password
-        self.password_valid = False
-        
-        if password:
-            # Derive a key from the password
-            self.derive_key_from_password(password)
-        else:
-            # Generate a random key
-            self.generate_random_key()
+        _refuse_in_group(input_file)
+        with file_lock(input_file):
+            items = self._read_items(input_file)
+            if items is None:
+                return False
+            try:
+                self._write_records(items, input_file)
+                return True
+            except Exception as e:
+                print(f"Error compacting encrypted file: {e}")
+                return False
+    
+    def _read_items(self, input_file, keys=None, prefix=None):
+        """
+        Read the variables of an encrypted file
         
-        # Create the Fernet cipher with our key
-        self.cipher = Fernet(self.key)
+        Args:
+            input_file (str): Path to the encrypted .env file
+            keys (collection, optional): Only return these keys. With the records
+                                         layout the other records are not decrypted.
+            prefix (str, optional): Only return keys starting with this prefix
+            
+        Returns:
+            list or None: (key, value) pairs in file order, None if unsuccessful
+        """
+        try:
+            with open(input_file, 'rb') as f:
+                try:
+                    header = self._read_unlocked_header(f)
+                    items = self._read_payload_items(f, header, keys, prefix)
+                    self.password_valid = True
+                    return items
+                except Exception as e:
+                    print(f"Password validation failed: {e}")
+                    self.password_valid = False
+                    return None
+        except Exception as e:
+            print(f"Error decrypting file: {e}")
+            self.password_valid = False
+            return None
     
-    def derive_key_from_password(self, password):
+    def _read_payload_items(self, f, header, keys=None, prefix=None):
         """
-        Derive a key from a password using PBKDF2
+        Decrypt and parse the payload of an unlocked file
         
         Args:
-            password (str): Password to derive the key from
+            f (file): Encrypted file positioned at the start of the payload
+            header (dict or None): Parsed header of the file
+            keys (collection, optional): Only return these keys
+            prefix (str, optional): Only return keys starting with this prefix
+            
+        Returns:
+            list: (key, value) pairs in file order
+        """
+        if header_layout(header) == LAYOUT_RECORDS:
+            return self._read_records(f, header, keys, prefix)
+        lines = iter_text_lines(self._iter_blob(f, header))
+        env_dict, key_order = parse_env_lines(lines)
+        return [(k, env_dict[k]) for k in key_order if key_selected(k, keys, prefix)]
+    
+    def _rewrite_header(self, env_file):
         """
-        # Use a fixed salt for simplicity
-        # In a production environment, you might want to store this salt securely
-        salt = b'fixed_salt_for_env_crypto'
+        Replace the header of an encrypted file, keeping its payload
         
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            iterations=100000,
-        )
+        The encrypted payload is copied as it is, without decrypting it, into
+        an atomically replaced file.
         
-        # Derive the key
-        key = base64.urlsafe_b64encode(kdf.derive(password.encode('utf-8')))
-        self.key = key
-        self.password = password
-        self.cipher = Fernet(key)
+        Args:
+            env_file (str): Path to the encrypted file
+        """
+        _refuse_in_group(env_file)
+        with file_lock(env_file):
+            with open(env_file, 'rb') as src:
+                header, payload_offset = _read_header(src)
+                header.update(self._header_for_write(env_file))
+                with atomic_write(env_file) as f:
+                    f.write(pack_header(header, payload_offset - _FILE_PREFIX.size))
+                    shutil.copyfileobj(src, f)
     
-    def generate_random_key(self):
+    def change_file_password(self, new_password, env_file='.env.enc'):
         """
-        Generate a random key
+        Change the password of an encrypted file
+        
+        With envelope encryption only the header holding the wrapped data key
+        is rewritten. Older files are re-encrypted once under a random data key.
+        
+        Args:
+            new_password (str): The new password
+            env_file (str): Path to the encrypted .env file
+            
+        Returns:
+            bool: True if successful, False otherwise
         """
-        self.key = Fernet.generate_key()
-        self.cipher = Fernet(self.key)
+        _refuse_in_group(env_file)
+        with file_lock(env_file):
+            try:
+                header, _ = read_header(env_file)
+                content = None
+                if header and header.get('wrapped_key'):
+                    # Unwrapping the data key proves the current password is correct
+                    self._unlock(header)
+                else:
+                    content = self.decrypt_env_file(env_file)
+                    if content is None or not self.password_valid:
+                        return False
+                
+                self.change_password(new_password)
+                
+                if content is None:
+                    self._rewrite_header(env_file)
+                else:
+                    self._write_blob([content.encode('utf-8')], env_file)
+                return True
+            except Exception as e:
+                print(f"Error changing password: {e}")
+                return False
     
-    def change_password(self, new_password):
+    def migrate_env_file(self, input_file='.env.enc'):
         """
-        Change the password and re-derive the key
+        Rewrite an encrypted file in the current format
+        
+        Headerless files and Fernet payloads are rewritten with raw
+        AES-256-GCM. Blob files keep their exact text, records files are
+        compacted. Any other write migrates a file as well.
         
         Args:
-            new_password (str): The new password
+            input_file (str): Path to the encrypted .env file
+            
+        Returns:
+            bool: True if successful, False otherwise
         """
-        self.derive_key_from_password(new_password)
+        _refuse_in_group(input_file)
+        with file_lock(input_file):
+            try:
+                header, _ = read_header(input_file)
+            except Exception as e:
+                print(f"Error reading encrypted file: {e}")
+                return False
+            
+            if header_layout(header) == LAYOUT_RECORDS:
+                return self.compact_env_file(input_file)
+            
+            content = self.decrypt_env_file(input_file)
+            if content is None:
+                return False
+            try:
+                self._write_blob([content.encode('utf-8')], input_file)
+                return True
+            except Exception as e:
+                print(f"Error migrating encrypted file: {e}")
+                return False
     
-    def encrypt_env_file(self, input_file='.env', output_file='.env.enc'):
+    def encrypt_env_file(self, input_file='.env', output_file='.env.enc', layout=LAYOUT_BLOB, workers=None):
         """
         Encrypt the contents of a .env file
         
         Args:
             input_file (str): Path to the input .env file
             output_file (str): Path to save the encrypted file
+            layout (str): LAYOUT_BLOB keeps the file exactly as it is (comments included),
+                          LAYOUT_RECORDS stores one record per variable for fast lookups
+            workers (int, optional): Threads encrypting chunks in parallel, defaults to self.workers
             
         Returns:
             bool: True if successful, False otherwise
         """
         try:
-            # Read the .env file
-            with open(input_file, 'rb') as f:
-                env_data = f.read()
-            
-            # Encrypt the data
-            encrypted_data = self.cipher.encrypt(env_data)
-            
-            # Write the encrypted data to the output file
-            with open(output_file, 'wb') as f:
-                f.write(encrypted_data)
-                
-            # Also save the key to a file (in a real app, you'd handle this more securely)
-            with open('.env.key', 'wb') as f:
-                f.write(self.key)
+            # The encrypted file and its key file are replaced together
+            with group_commit():
+                # Stream the .env file into the encrypted output file
+                with open(input_file, 'rb') as f:
+                    if layout == LAYOUT_RECORDS:
+                        env_dict, key_order = parse_env_lines(iter_text_lines(iter_file_chunks(f)))
+                        self._write_records(ordered_items(env_dict, key_order), output_file)
+                    else:
+                        self._write_blob(iter_file_chunks(f), output_file, workers)
+                    
+                # Also save the key to a file (in a real app, you'd handle this more securely)
+                with atomic_write('.env.key') as f:
+                    f.write(self.key)
                 
             return True
         except Exception as e:
             print(f"Error encrypting file: {e}")
             return False
     
-    def decrypt_env_file(self, input_file='.env.enc', output_file=None):
+    def decrypt_env_file(self, input_file='.env.enc', output_file=None, workers=None):
         """
         Decrypt an encrypted .env file
         
@@ -112,6 +1751,7 @@ class EnvCrypto:
             input_file (str): Path to the encrypted .env file
             output_file (str, optional): Path to save the decrypted file.
                                         If None, the content is returned but not saved.
+            workers (int, optional): Threads decrypting chunks in parallel, defaults to self.workers
             
         Returns:
             str or None: The decrypted content if successful and output_file is None,
@@ -119,23 +1759,33 @@ class EnvCrypto:
                         False or None if unsuccessful
         """
         try:
-            # Read the encrypted file
             with open(input_file, 'rb') as f:
-                encrypted_data = f.read()
-            
-            # Decrypt the data
-            try:
-                decrypted_data = self.cipher.decrypt(encrypted_data)
-                self.password_valid = True  # Password is valid if decryption succeeds
-            except Exception as e:
-                print(f"Password validation failed: {e}")
-                self.password_valid = False
-                return None
+                try:
+                    # Check the key against the header before reading the payload
+                    header = self._read_unlocked_header(f)
+                    
+                    # Decrypt the payload
+                    if header_layout(header) == LAYOUT_RECORDS:
+                        items = self._read_records(f, header)
+                        pieces = ['\n'.join([f"{k}={v}" for k, v in items]).encode('utf-8')]
+                    else:
+                        pieces = self._iter_blob(f, header, workers)
+                    
+                    if output_file:
+                        # Stream the decrypted data to the output file, which
+                        # only appears once everything has been decrypted
+                        with atomic_write(output_file) as out:
+                            for piece in pieces:
+                                out.write(piece)
+                    else:
+                        decrypted_data = b''.join(pieces)
+                    self.password_valid = True  # Password is valid if decryption succeeds
+                except Exception as e:
+                    print(f"Password validation failed: {e}")
+                    self.password_valid = False
+                    return None
             
             if output_file:
-                # Write the decrypted data to the output file
-                with open(output_file, 'wb') as f:
-                    f.write(decrypted_data)
                 return True
             else:
                 # Return the decrypted data as a string
@@ -157,45 +1807,57 @@ class EnvCrypto:
         """
         try:
             with open(key_file, 'rb') as f:
-                self.key = f.read()
-            self.cipher = Fernet(self.key)
+                key = f.read()
+            self._set_key(key)
+            self.kdf = None
+            self.wrapped_key = None
+            self.key_from_file = True
             return True
         except Exception as e:
             print(f"Error loading key: {e}")
             return False
     
-    def get_env_values(self, input_file='.env.enc'):
+    def get_env_values(self, input_file='.env.enc', keys=None, prefix=None):
         """
         Get the environment values from an encrypted .env file
         
         Args:
             input_file (str): Path to the encrypted .env file
+            keys (collection, optional): Only return these keys
+            prefix (str, optional): Only return keys starting with this prefix.
+                                    With the records layout, records of other
+                                    keys are not decrypted.
             
         Returns:
             dict: Dictionary of environment variables and list of keys in original order
         """
-        # Decrypt the file
-        content = self.decrypt_env_file(input_file)
+        items = self._read_items(input_file, keys, prefix)
         
         # If decryption failed or password is invalid, return empty results
-        if not content or not self.password_valid:
+        if not items or not self.password_valid:
             return {}, []
         
-        # Parse the content into a dictionary
-        env_dict = {}
-        key_order = []  # To preserve original order of keys
-        for line in content.splitlines():
-            line = line.strip()
-            if not line or line.startswith('#'):
-                continue
-                
-            if '=' in line:
-                key, value = line.split('=', 1)
-                env_dict[key] = value
-                if key not in key_order:
-                    key_order.append(key)
+        env_dict = dict(items)
+        return env_dict, list(env_dict)
+    
+    def get_env_value(self, key, input_file='.env.enc'):
+        """
+        Get a single environment value from an encrypted .env file
         
-        return env_dict, key_order
+        With the records layout only the index and the record of the key are
+        decrypted, so the cost does not grow with the size of other values.
+        
+        Args:
+            key (str): The environment variable name
+            input_file (str): Path to the encrypted .env file
+            
+        Returns:
+            str or None: The value, or None if the key is missing or decryption failed
+        """
+        items = self._read_items(input_file, keys={key})
+        if not items:
+            return None
+        return items[-1][1]
     
     def set_env_value(self, key, value, input_file='.env.enc'):
         """
@@ -209,26 +1871,71 @@ class EnvCrypto:
         Returns:
             bool: True if successful, False otherwise
         """
-        # Get current values
-        env_dict, _ = self.get_env_values(input_file)
-        if env_dict is None:
-            return False
+        return self._change_env_value({'op': 'set', 'key': key, 'value': value}, input_file)
+    
+    def delete_env_value(self, key, input_file='.env.enc'):
+        """
+        Delete an environment variable from the encrypted .env file
+        
+        Args:
+            key (str): The environment variable name
+            input_file (str): Path to the encrypted .env file
+            
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        return self._change_env_value({'op': 'delete', 'key': key}, input_file)
+    
+    def _change_env_value(self, entry, input_file):
+        """
+        Apply a single-key change, appending to the journal when possible
         
-        # Update or add the new value
-        env_dict[key] = value
+        Files without a journal (blob layout, older files, new files) are
+        rewritten in the records layout.
         
-        # Convert back to .env format
-        content = '\n'.join([f"{k}={v}" for k, v in env_dict.items()])
+        Args:
+            entry (dict): Journal entry with 'op', 'key' and, for sets, 'value'
+            input_file (str): Path to the encrypted .env file
+            
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        if entry['op'] == 'set':
+            try:
+                validate_key(entry['key'])
+            except ValueError as e:
+                print(f"Error updating encrypted file: {e}")
+                return False
         
-        # Re-encrypt and save
-        try:
-            encrypted_data = self.cipher.encrypt(content.encode('utf-8'))
-            with open(input_file, 'wb') as f:
-                f.write(encrypted_data)
-            return True
-        except Exception as e:
-            print(f"Error updating encrypted file: {e}")
-            return False
+        _refuse_in_group(input_file)
+        with file_lock(input_file):
+            try:
+                if self._append_journal(input_file, entry):
+                    return True
+            except Exception as e:
+                print(f"Error updating encrypted file: {e}")
+                self.password_valid = False
+                return False
+            
+            # Get current values
+            env_dict, _ = self.get_env_values(input_file)
+            if not self.password_valid and os.path.exists(input_file):
+                # Never replace a file we could not read
+                return False
+            
+            # Update, add or remove the value
+            if entry['op'] == 'set':
+                env_dict[entry['key']] = entry['value']
+            else:
+                env_dict.pop(entry['key'], None)
+            
+            # Re-encrypt and save
+            try:
+                self._write_records(list(env_dict.items()), input_file)
+                return True
+            except Exception as e:
+                print(f"Error updating encrypted file: {e}")
+                return False
     
     def set_env_values(self, env_dict, key_order=None, output_file='.env.enc'):
         """
@@ -243,22 +1950,330 @@ class EnvCrypto:
             bool: True if successful, False otherwise
         """
         try:
-            # Convert to .env format using key_order if provided
-            if key_order:
-                # Use the provided key order, adding any new keys at the end
-                all_keys = key_order.copy()
-                for k in env_dict.keys():
-                    if k not in all_keys:
-                        all_keys.append(k)
-                content = '\n'.join([f"{k}={env_dict[k]}" for k in all_keys if k in env_dict])
-            else:
-                content = '\n'.join([f"{k}={v}" for k, v in env_dict.items()])
+            # Use the provided key order, adding any new keys at the end
+            items = ordered_items(env_dict, key_order)
+            for key, _ in items:
+                validate_key(key)
             
-            # Encrypt and save
-            encrypted_data = self.cipher.encrypt(content.encode('utf-8'))
-            with open(output_file, 'wb') as f:
-                f.write(encrypted_data)
+            # Encrypt each value as its own record and save
+            self._write_records(items, output_file)
             return True
         except Exception as e:
             print(f"Error setting environment values: {e}")
             return False
+    
+    def transaction(self, env_file='.env.enc'):
+        """
+        Stage several changes and write them with a single commit
+        
+        Usage:
+            with crypto.transaction('.env.enc') as tx:
+                tx['SQL_ENABLED'] = 'True'
+                del tx['OLD_KEY']
+        
+        The file is decrypted once when the block starts and written once when
+        it ends without an exception, unless nothing changed.
+        
+        Args:
+            env_file (str): Path to the encrypted .env file
+            
+        Returns:
+            EnvTransaction: The transaction, to be used as a context manager
+        """
+        return EnvTransaction(self, env_file)
+    
+    def run_transaction(self, func, env_file='.env.enc', retries=TRANSACTION_RETRIES):
+        """
+        Run a transaction, starting over when another writer got there first
+        
+        Args:
+            func (callable): Called with the EnvTransaction; it may be called
+                             again after a conflict, so it must only stage changes
+            env_file (str): Path to the encrypted .env file
+            retries (int): Attempts before giving up
+            
+        Returns:
+            The return value of func from the attempt that committed
+            
+        Raises:
+            ConcurrentModificationError: If every attempt conflicted
+            ValueError: If the file cannot be decrypted
+        """
+        for attempt in range(retries):
+            try:
+                with self.transaction(env_file) as tx:
+                    result = func(tx)
+                return result
+            except ConcurrentModificationError:
+                if attempt == retries - 1:
+                    raise
+                # Back off a little so competing writers spread out
+                time.sleep(random.uniform(0, 0.01 * (attempt + 1)))
+    
+    async def get_env_values_async(self, input_file='.env.enc', keys=None, prefix=None, timings=None):
+        """
+        Get the environment values without blocking the event loop
+        
+        Reading the header, deriving the key and decrypting the payload each
+        run on the default executor. Cancelling the call stops it between
+        stages. A stage that is already running cannot be interrupted: it
+        finishes in the background, its result is dropped and the file is
+        closed once it is done with it.
+        
+        Args:
+            input_file (str): Path to the encrypted .env file
+            keys (collection, optional): Only return these keys
+            prefix (str, optional): Only return keys starting with this prefix
+            timings (dict, optional): Filled with the seconds spent in the
+                                      'header', 'unlock' and 'decrypt' stages
+            
+        Returns:
+            dict: Dictionary of environment variables and list of keys in original order
+        """
+        loop = asyncio.get_running_loop()
+        timings = {} if timings is None else timings
+        opened = []  # The file, once the header stage has opened it
+        cancelled = False
+        
+        def close_file(_future=None):
+            for f in opened:
+                f.close()
+        
+        async def stage(name, func, *args):
+            nonlocal cancelled
+            start = time.perf_counter()
+            future = loop.run_in_executor(None, func, *args)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # The thread may still be using the file, close it when the thread is done
+                cancelled = True
+                future.add_done_callback(close_file)
+                raise
+            finally:
+                timings[name] = time.perf_counter() - start
+        
+        def open_file():
+            f = open(input_file, 'rb')
+            opened.append(f)
+            return f, _read_header(f)[0]
+        
+        try:
+            try:
+                f, header = await stage('header', open_file)
+            except Exception as e:
+                print(f"Error decrypting file: {e}")
+                self.password_valid = False
+                return {}, []
+            
+            try:
+                await stage('unlock', self._load_header_key, header)
+                items = await stage('decrypt', self._read_payload_items, f, header, keys, prefix)
+            except Exception as e:
+                print(f"Password validation failed: {e}")
+                self.password_valid = False
+                return {}, []
+        finally:
+            if not cancelled:
+                close_file()
+        
+        self.password_valid = True
+        env_dict = dict(items)
+        return env_dict, list(env_dict)
+    
+    async def get_env_value_async(self, key, input_file='.env.enc', timings=None):
+        """
+        Get a single environment value without blocking the event loop
+        
+        Args:
+            key (str): The environment variable name
+            input_file (str): Path to the encrypted .env file
+            timings (dict, optional): Filled with per-stage seconds, see get_env_values_async
+            
+        Returns:
+            str or None: The value, or None if the key is missing or decryption failed
+        """
+        env_dict, _ = await self.get_env_values_async(input_file, keys={key}, timings=timings)
+        return env_dict.get(key)
+    
+    async def _run_write_async(self, func, timings):
+        """
+        Run a write method on the default executor
+        
+        Cancelling the call stops waiting for the write, but a write that has
+        started is finished so the file is never left half written.
+        """
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(None, func)
+        finally:
+            if timings is not None:
+                timings['write'] = time.perf_counter() - start
+    
+    async def set_env_value_async(self, key, value, input_file='.env.enc', timings=None):
+        """
+        Set or update an environment variable without blocking the event loop
+        
+        Args:
+            key (str): The environment variable name
+            value (str): The value to set
+            input_file (str): Path to the encrypted .env file
+            timings (dict, optional): Filled with the seconds spent in the 'write' stage
+            
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        return await self._run_write_async(
+            functools.partial(self.set_env_value, key, value, input_file), timings)
+    
+    async def delete_env_value_async(self, key, input_file='.env.enc', timings=None):
+        """
+        Delete an environment variable without blocking the event loop
+        
+        Args:
+            key (str): The environment variable name
+            input_file (str): Path to the encrypted .env file
+            timings (dict, optional): Filled with the seconds spent in the 'write' stage
+            
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        return await self._run_write_async(
+            functools.partial(self.delete_env_value, key, input_file), timings)
+    
+    async def set_env_values_async(self, env_dict, key_order=None, output_file='.env.enc', timings=None):
+        """
+        Set multiple environment values without blocking the event loop
+        
+        Args:
+            env_dict (dict): Dictionary of environment variables
+            key_order (list, optional): List of keys in the order they should appear
+            output_file (str): Path to the output file
+            timings (dict, optional): Filled with the seconds spent in the 'write' stage
+            
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        return await self._run_write_async(
+            functools.partial(self.set_env_values, env_dict, key_order, output_file), timings)
+
+
+class EnvTransaction:
+    """
+    Staged changes to an encrypted file, see EnvCrypto.transaction
+    """
+    
+    def __init__(self, crypto, env_file):
+        """
+        Initialize the transaction
+        
+        Args:
+            crypto (EnvCrypto): Crypto instance used to read and write the file
+            env_file (str): Path to the encrypted .env file
+        """
+        self.crypto = crypto
+        self.env_file = env_file
+        self.original = None
+        self.values = None
+        self.version = None
+    
+    def begin(self):
+        """
+        Decrypt the file and start staging changes
+        
+        No lock is taken, so other writers are not held up while the
+        transaction is open.
+        
+        Raises:
+            ValueError: If the file cannot be decrypted
+            RuntimeError: If called inside group_commit()
+        """
+        _refuse_in_group(self.env_file)
+        self.version = read_version(self.env_file)
+        items = self.crypto._read_items(self.env_file)
+        if items is None or not self.crypto.password_valid:
+            raise ValueError(f"could not decrypt {self.env_file}")
+        self.original = dict(items)
+        self.values = dict(items)
+    
+    @property
+    def changed(self):
+        """True if the staged values differ from the file"""
+        return self.values != self.original
+    
+    def get(self, key, default=None):
+        """Get a staged value"""
+        return self.values.get(key, default)
+    
+    def set(self, key, value):
+        """
+        Stage setting a value
+        
+        Raises:
+            ValueError: If the key is not a valid variable name
+        """
+        validate_key(key)
+        self.values[key] = value
+    
+    def delete(self, key):
+        """
+        Stage deleting a value
+        
+        Returns:
+            bool: True if the key existed
+        """
+        return self.values.pop(key, None) is not None
+    
+    def __getitem__(self, key):
+        return self.values[key]
+    
+    def __setitem__(self, key, value):
+        self.set(key, value)
+    
+    def __delitem__(self, key):
+        del self.values[key]
+    
+    def __contains__(self, key):
+        return key in self.values
+    
+    def keys(self):
+        """Staged keys, in file order"""
+        return self.values.keys()
+    
+    def rollback(self):
+        """
+        Discard the staged changes
+        """
+        self.values = dict(self.original)
+    
+    def commit(self):
+        """
+        Write the staged changes, if there are any
+        
+        Returns:
+            bool: True if the file was written, False if nothing changed
+            
+        Raises:
+            ConcurrentModificationError: If the file changed since the transaction began
+        """
+        if not self.changed:
+            return False
+        # Compare and swap: the version is checked and the file replaced under the writer lock
+        _refuse_in_group(self.env_file)
+        with file_lock(self.env_file):
+            if read_version(self.env_file) != self.version:
+                raise ConcurrentModificationError(f"{self.env_file} was changed by another writer")
+            self.crypto._write_records(ordered_items(self.values, list(self.original)), self.env_file)
+            self.version = read_version(self.env_file)
+        self.original = dict(self.values)
+        return True
+    
+    def __enter__(self):
+        self.begin()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        return False
@@ -0,0 +1,409 @@
+"""
+Local key agent that keeps derived keys in memory between config_cli runs
+
+The agent listens on a Unix domain socket that only the current user can
+reach. EnvCrypto asks it for a derived key before running PBKDF2, so only
+the first call of a session pays for the key derivation.
+"""
+import os
+import socket
+import socketserver
+import stat
+import struct
+import tempfile
+import threading
+import time
+
+# Forget a key after this many seconds without use
+DEFAULT_IDLE_TTL = 900
+
+# Unix sockets are not available on every platform (e.g. Windows builds)
+AGENT_SUPPORTED = hasattr(socket, 'AF_UNIX') and hasattr(os, 'getuid')
+
+
+def get_socket_path():
+    """
+    Get the path of the agent socket
+
+    The ENV_CRYPTO_AGENT_SOCK environment variable overrides the default
+    location inside a per-user directory.
+
+    Returns:
+        str: Path to the agent socket
+    """
+    path = os.environ.get('ENV_CRYPTO_AGENT_SOCK')
+    if path:
+        return path
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(runtime_dir, f"env_crypto_agent-{os.getuid()}", 'agent.sock')
+
+
+def is_private_dir(path):
+    """
+    Check that a directory can only be used by the current user
+
+    Args:
+        path (str): Path of the directory
+
+    Returns:
+        bool: True if it is a real directory (not a symlink) owned by the
+              current user with mode 0700
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and stat.S_IMODE(st.st_mode) == 0o700
+
+
+def _peer_uid(connection):
+    """
+    Get the user id of the process at the other end of a Unix socket
+
+    Args:
+        connection (socket.socket): A connected Unix socket
+
+    Returns:
+        int or None: The peer's user id, or None if the platform cannot tell
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    _, uid, _ = struct.unpack('3i', creds)
+    return uid
+
+
+def send_requests(lines, socket_path, timeout=2.0):
+    """
+    Send request lines to a local server and read one reply per line
+
+    All requests are written before the first reply is read, so a batch
+    costs a single round trip. Nothing is sent unless the socket sits in a
+    directory only the current user can use and, where the platform can
+    tell, the server runs as the current user; otherwise another local user
+    could pose as the server and collect keys.
+
+    Args:
+        lines (list): Request lines without the trailing newline
+        socket_path (str): Path of the server socket
+        timeout (float): Socket timeout in seconds
+
+    Returns:
+        list or None: The reply lines, or None if no server is reachable
+    """
+    if not AGENT_SUPPORTED or not os.path.exists(socket_path):
+        return None
+    if not is_private_dir(os.path.dirname(os.path.abspath(socket_path))):
+        return None
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(socket_path)
+            if _peer_uid(sock) not in (None, os.getuid()):
+                return None
+            sock.sendall(b''.join(line.encode('utf-8') + b'\n' for line in lines))
+            with sock.makefile('rb') as reply:
+                return [reply.readline().decode('utf-8').rstrip('\n') for _ in lines]
+    except OSError:
+        return None
+
+
+def _request(line, timeout=2.0):
+    """
+    Send a single request line to the agent
+
+    Args:
+        line (str): Request line without the trailing newline
+        timeout (float): Socket timeout in seconds
+
+    Returns:
+        str or None: The reply line, or None if no agent is reachable
+    """
+    if not AGENT_SUPPORTED:
+        return None
+    replies = send_requests([line], get_socket_path(), timeout)
+    return replies[0].strip() if replies else None
+
+
+def get_key(key_id):
+    """
+    Ask the agent for a cached key
+
+    Args:
+        key_id (str): Identifier of the cached key
+
+    Returns:
+        bytes or None: The cached key, or None if the agent does not have it
+    """
+    reply = _request(f"GET {key_id}")
+    if reply and reply.startswith('OK '):
+        return reply[3:].encode('utf-8')
+    return None
+
+
+def put_key(key_id, key):
+    """
+    Hand a derived key to the agent
+
+    Args:
+        key_id (str): Identifier of the key
+        key (bytes): The derived key
+
+    Returns:
+        bool: True if the agent stored the key, False otherwise
+    """
+    return _request(f"PUT {key_id} {key.decode('utf-8')}") == 'OK'
+
+
+def forget_key(key_id):
+    """
+    Remove a single key from the agent
+
+    Args:
+        key_id (str): Identifier of the key
+
+    Returns:
+        bool: True if the agent answered, False otherwise
+    """
+    return _request(f"FORGET {key_id}") == 'OK'
+
+
+def lock():
+    """
+    Wipe every key held by the agent
+
+    Returns:
+        bool: True if the agent answered, False otherwise
+    """
+    return _request('LOCK') == 'OK'
+
+
+def status():
+    """
+    Get the agent status
+
+    Returns:
+        str or None: Status line, or None if no agent is running
+    """
+    return _request('STATUS')
+
+
+def stop():
+    """
+    Ask the agent to wipe its keys and exit
+
+    Returns:
+        bool: True if the agent answered, False otherwise
+    """
+    return _request('STOP') == 'OK'
+
+
+class _AgentHandler(socketserver.StreamRequestHandler):
+    """Handle the requests of one client connection"""
+
+    def handle(self):
+        if not self.server.peer_allowed(self.connection):
+            return
+
+        for raw_line in self.rfile:
+            parts = raw_line.decode('utf-8', 'replace').split()
+            if not parts:
+                continue
+            reply = self.server.dispatch(parts[0].upper(), parts[1:])
+            self.wfile.write(reply.encode('utf-8') + b'\n')
+            self.wfile.flush()
+            if parts[0].upper() == 'STOP':
+                break
+
+
+# The servers need Unix domain sockets, so they only exist where those do
+if AGENT_SUPPORTED:
+    class PrivateUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        """
+        Threaded Unix socket server that only the current user can reach
+        """
+        daemon_threads = True
+        # Clients connect with a timeout, which fails at once instead of waiting
+        # when the backlog is full, so leave room for bursts of clients
+        request_queue_size = 128
+
+        def __init__(self, socket_path, handler_class):
+            """
+            Bind the socket inside an owner-only directory
+
+            Args:
+                socket_path (str): Path of the socket to listen on
+                handler_class (type): Request handler for each connection
+
+            Raises:
+                PermissionError: If the socket directory may be used by other users
+            """
+            self.socket_path = socket_path
+
+            # Only the owner may enter the socket directory. A directory that
+            # already exists is used as it is, never changed.
+            socket_dir = os.path.dirname(os.path.abspath(self.socket_path))
+            try:
+                os.makedirs(socket_dir, mode=0o700)
+                os.chmod(socket_dir, 0o700)
+            except FileExistsError:
+                pass
+            if not is_private_dir(socket_dir):
+                raise PermissionError(f"{socket_dir} must be a directory owned by the current user with mode 0700")
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+            old_umask = os.umask(0o177)
+            try:
+                super().__init__(self.socket_path, handler_class)
+            finally:
+                os.umask(old_umask)
+            os.chmod(self.socket_path, 0o600)
+
+        def peer_allowed(self, connection):
+            """
+            Check that the connecting process belongs to the same user
+
+            Args:
+                connection (socket.socket): The client connection
+
+            Returns:
+                bool: True if the peer may talk to the server
+            """
+            # Without SO_PEERCRED, rely on the permissions of the socket directory
+            return _peer_uid(connection) in (None, os.getuid())
+
+        def close_socket(self):
+            """
+            Close the server and remove its socket file
+            """
+            self.server_close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+
+    class KeyAgent(PrivateUnixServer):
+        """
+        Unix socket server that holds derived keys in memory
+        """
+
+        def __init__(self, socket_path=None, idle_ttl=DEFAULT_IDLE_TTL):
+            """
+            Initialize the agent and bind its socket
+
+            Args:
+                socket_path (str, optional): Path of the socket to listen on
+                idle_ttl (int): Seconds after which an unused key is forgotten
+            """
+            self.idle_ttl = idle_ttl
+            self.keys = {}  # key_id -> [bytearray key, last used timestamp]
+            self.lock = threading.Lock()
+            super().__init__(socket_path or get_socket_path(), _AgentHandler)
+
+        def dispatch(self, command, args):
+            """
+            Execute one request
+
+            Args:
+                command (str): Request name
+                args (list): Request arguments
+
+            Returns:
+                str: The reply line
+            """
+            with self.lock:
+                self.expire_keys()
+
+                if command == 'GET' and len(args) == 1:
+                    entry = self.keys.get(args[0])
+                    if entry is None:
+                        return 'MISS'
+                    entry[1] = time.monotonic()
+                    return f"OK {entry[0].decode('utf-8')}"
+                if command == 'PUT' and len(args) == 2:
+                    self.forget(args[0])
+                    self.keys[args[0]] = [bytearray(args[1].encode('utf-8')), time.monotonic()]
+                    return 'OK'
+                if command == 'FORGET' and len(args) == 1:
+                    self.forget(args[0])
+                    return 'OK'
+                if command == 'LOCK':
+                    self.wipe()
+                    return 'OK'
+                if command == 'STATUS':
+                    return f"OK keys={len(self.keys)} idle_ttl={self.idle_ttl}"
+                if command == 'STOP':
+                    self.wipe()
+                    threading.Thread(target=self.shutdown, daemon=True).start()
+                    return 'OK'
+                return 'ERR unknown request'
+
+        def forget(self, key_id):
+            """Zero and drop a single key (caller holds the lock)"""
+            entry = self.keys.pop(key_id, None)
+            if entry:
+                entry[0][:] = bytes(len(entry[0]))
+
+        def wipe(self):
+            """Zero and drop every key (caller holds the lock)"""
+            for key_id in list(self.keys):
+                self.forget(key_id)
+
+        def expire_keys(self):
+            """Forget keys that have been idle for longer than the TTL (caller holds the lock)"""
+            now = time.monotonic()
+            for key_id, (_, last_used) in list(self.keys.items()):
+                if now - last_used > self.idle_ttl:
+                    self.forget(key_id)
+
+        def run(self):
+            """
+            Serve requests until the agent is stopped
+            """
+            def reaper():
+                # Expire idle keys even when nobody is talking to the agent
+                while True:
+                    time.sleep(min(self.idle_ttl, 30))
+                    with self.lock:
+                        self.expire_keys()
+
+            threading.Thread(target=reaper, daemon=True).start()
+            try:
+                self.serve_forever()
+            finally:
+                with self.lock:
+                    self.wipe()
+                self.close_socket()
+
+
+def run_agent(idle_ttl=DEFAULT_IDLE_TTL):
+    """
+    Run the key agent in the foreground
+
+    Args:
+        idle_ttl (int): Seconds after which an unused key is forgotten
+
+    Returns:
+        bool: True when the agent exited cleanly, False if it could not start
+    """
+    if not AGENT_SUPPORTED:
+        print("Error: the key agent needs Unix domain sockets, which this platform does not provide")
+        return False
+
+    if status():
+        print(f"Error: an agent is already running on {get_socket_path()}")
+        return False
+
+    try:
+        agent = KeyAgent(idle_ttl=idle_ttl)
+    except OSError as e:
+        print(f"Error: could not start the key agent: {e}")
+        return False
+    print(f"Key agent listening on {agent.socket_path} (idle TTL {idle_ttl}s)")
+    try:
+        agent.run()
+    except KeyboardInterrupt:
+        pass
+    print("Key agent stopped")
+    return True
@@ -2,22 +2,191 @@
 Module to load encrypted environment variables
 This would be integrated into your main.exe
 """
+import asyncio
+import json
 import os
-from env_crypto import EnvCrypto
+import threading
+import time
+from collections.abc import MutableMapping
+from config_snapshot import ConfigSnapshot
+from env_crypto import EnvCrypto, file_signature, key_selected
+import startup_cache
 
-def load_encrypted_env(env_file='.env.enc', key_file='.env.key', password=None):
+
+class LazyEnviron(MutableMapping):
     """
-    Load encrypted environment variables into os.environ
+    Stand-in for os.environ that decrypts registered files on first use
+    
+    Lookups of variables that are already set never trigger a decrypt. A
+    lookup that misses runs the pending loaders that could provide the name
+    and retries, so os.getenv() keeps working unchanged. A loader registered
+    with keys or a prefix only runs for names it selects; other misses (e.g.
+    tempfile probing TMPDIR) fall through to the real environment. Loaders
+    without a selection run on any miss. Enumerating the environment runs
+    every pending loader. Variables set by the program before the loaders run
+    are not overwritten.
+    """
+    
+    def __init__(self, environ):
+        """
+        Wrap the real environment
+        
+        Args:
+            environ (os._Environ): The original os.environ
+        """
+        self._environ = environ
+        self._loaders = []  # (loader, keys, prefix)
+        self._assigned = set()  # Keys set by the program before loading
+        self._lock = threading.RLock()
+        self._loading = False
+    
+    def add_loader(self, loader, keys=None, prefix=None):
+        """
+        Register a deferred source of variables
+        
+        Args:
+            loader (callable): Returns a dict of variables, or None on failure
+            keys (collection, optional): The only names the loader provides
+            prefix (str, optional): Prefix of every name the loader provides
+        """
+        with self._lock:
+            self._loaders.append((loader, frozenset(keys) if keys is not None else None, prefix))
+    
+    @property
+    def loaded(self):
+        """True once every registered loader has run"""
+        return not self._loaders
+    
+    def load(self, key=None):
+        """
+        Run pending loaders and copy their variables into the environment
+        
+        Args:
+            key (str, optional): Only run the loaders that could provide this
+                                 name; every pending loader runs when None
+        """
+        with self._lock:
+            if self._loading:
+                # The loader itself looked up a variable (e.g. the agent socket)
+                return
+            self._loading = True
+            try:
+                for entry in list(self._loaders):
+                    loader, keys, prefix = entry
+                    if key is not None and not key_selected(key, keys, prefix):
+                        continue
+                    self._loaders.remove(entry)
+                    for name, value in (loader() or {}).items():
+                        if name not in self._assigned:
+                            self._environ[name] = value
+            finally:
+                self._loading = False
+    
+    def __getitem__(self, key):
+        try:
+            return self._environ[key]
+        except KeyError:
+            if not self._loaders:
+                raise
+        self.load(key)
+        return self._environ[key]
+    
+    def __setitem__(self, key, value):
+        if self._loaders:
+            self._assigned.add(key)
+        self._environ[key] = value
+    
+    def __delitem__(self, key):
+        self.load(key)
+        del self._environ[key]
+    
+    def __iter__(self):
+        self.load()
+        return iter(self._environ)
+    
+    def __len__(self):
+        self.load()
+        return len(self._environ)
+    
+    def copy(self):
+        self.load()
+        return self._environ.copy()
+    
+    def __repr__(self):
+        state = 'loaded' if self.loaded else 'pending'
+        return f"LazyEnviron({state}, {self._environ!r})"
+    
+    def __getattr__(self, name):
+        # Anything else (encodekey, _data, ...) comes from the real environment
+        return getattr(self._environ, name)
+
+
+def install_lazy_environ():
+    """
+    Replace os.environ with a LazyEnviron, once
+    
+    Returns:
+        LazyEnviron: The installed proxy
+    """
+    if not isinstance(os.environ, LazyEnviron):
+        os.environ = LazyEnviron(os.environ)
+    return os.environ
+
+
+def uninstall_lazy_environ():
+    """
+    Put the real os.environ back, loading anything still pending first
+    """
+    if isinstance(os.environ, LazyEnviron):
+        os.environ.load()
+        os.environ = os.environ._environ
+
+
+def _credential(key_file, password):
+    """
+    Get the secret a file is opened with, for binding startup cache entries
+    
+    Returns:
+        bytes or None: The password or key file contents, None if there is neither
+    """
+    if password:
+        return password.encode('utf-8')
+    try:
+        with open(key_file, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def read_encrypted_env(env_file='.env.enc', key_file='.env.key', password=None, use_cache=False,
+                       keys=None, prefix=None):
+    """
+    Decrypt an encrypted .env file without touching os.environ
     
     Args:
         env_file (str): Path to the encrypted .env file
         key_file (str): Path to the key file (used if password is None)
         password (str, optional): Password to decrypt the file
+        use_cache (bool): Reuse the variables cached by an earlier start if the
+                          file is unchanged, skipping key derivation and decryption
+        keys (collection, optional): Only read these variables
+        prefix (str, optional): Only read variables starting with this prefix
         
     Returns:
-        bool: True if successful, False otherwise
+        dict or None: The variables, or None if the file could not be read
     """
     try:
+        credential = _credential(key_file, password) if use_cache else None
+        if credential and (keys is not None or prefix is not None):
+            # Filtered reads get their own cache entries
+            selection = json.dumps([sorted(keys) if keys is not None else None, prefix])
+            credential += b'\0' + selection.encode('utf-8')
+        if credential:
+            env_values = startup_cache.load_cached_values(env_file, credential)
+            if env_values:
+                return env_values
+            identity = startup_cache.file_identity(env_file)
+        
         # Create crypto instance
         crypto = EnvCrypto(password)
         
@@ -26,22 +195,289 @@ def load_encrypted_env(env_file='.env.enc', key_file='.env.key', password=None):
             crypto.load_key_from_file(key_file)
         
         # Get environment values
-        env_values, _ = crypto.get_env_values(env_file)
+        env_values, _ = crypto.get_env_values(env_file, keys, prefix)
         
         if not env_values:
+            print(f"Failed to load environment from {env_file}")
+            return None
+        
+        if credential:
+            startup_cache.store_cached_values(env_file, credential, identity, env_values)
+        return env_values
+    
+    except Exception as e:
+        print(f"Error loading encrypted environment: {e}")
+        return None
+
+
+def load_encrypted_env(env_file='.env.enc', key_file='.env.key', password=None, lazy=False,
+                       use_cache=False, keys=None, prefix=None):
+    """
+    Load encrypted environment variables into os.environ
+    
+    Args:
+        env_file (str): Path to the encrypted .env file
+        key_file (str): Path to the key file (used if password is None)
+        password (str, optional): Password to decrypt the file
+        lazy (bool): Defer the key derivation and decryption until a variable
+                     that is not already set is first looked up. With keys or
+                     prefix, only lookups of selected names trigger it. Child
+                     processes inherit only what has been loaded, so call
+                     os.environ.load() before spawning them.
+        use_cache (bool): Keep the decrypted variables in the startup cache (on
+                          tmpfs, under a short-lived session key) so the next
+                          start with an unchanged file skips the decryption
+        keys (collection, optional): Only export these variables, e.g.
+                                     ['CLAVE_SUCURSAL', 'CLAVE_PLAZA']
+        prefix (str, optional): Only export variables starting with this prefix.
+                                With an indexed file, other records are not even
+                                decrypted.
+        
+    Returns:
+        bool: True if successful (or scheduled, when lazy), False otherwise
+    """
+    if lazy:
+        if not os.path.exists(env_file):
             print(f"Failed to load environment from {env_file}")
             return False
         
-        # Set environment variables
-        for key, value in env_values.items():
-            os.environ[key] = value
+        def loader():
+            env_values = read_encrypted_env(env_file, key_file, password, use_cache, keys, prefix)
+            if env_values:
+                print(f"Successfully loaded {len(env_values)} environment variables")
+            return env_values
         
-        print(f"Successfully loaded {len(env_values)} environment variables")
+        install_lazy_environ().add_loader(loader, keys, prefix)
         return True
     
+    env_values = read_encrypted_env(env_file, key_file, password, use_cache, keys, prefix)
+    if env_values is None:
+        return False
+    
+    # Set environment variables
+    for key, value in env_values.items():
+        os.environ[key] = value
+    
+    print(f"Successfully loaded {len(env_values)} environment variables")
+    return True
+
+def load_config_snapshot(env_file='.env.enc', key_file='.env.key', password=None,
+                         keys=None, prefix=None, types=None, use_cache=False):
+    """
+    Decrypt an encrypted .env file into a typed, read-only ConfigSnapshot
+    
+    Args:
+        env_file (str): Path to the encrypted .env file
+        key_file (str): Path to the key file (used if password is None)
+        password (str, optional): Password to decrypt the file
+        keys (collection, optional): Only include these variables
+        prefix (str, optional): Only include variables starting with this prefix
+        types (dict, optional): Converters for specific keys, see ConfigSnapshot
+        use_cache (bool): Use the startup cache, see read_encrypted_env
+        
+    Returns:
+        ConfigSnapshot or None: The snapshot, or None if the file could not be read
+    """
+    env_values = read_encrypted_env(env_file, key_file, password, use_cache, keys, prefix)
+    if env_values is None:
+        return None
+    try:
+        return ConfigSnapshot(env_values, types)
+    except ValueError as e:
+        print(f"Invalid configuration value: {e}")
+        return None
+
+
+async def load_encrypted_env_async(env_file='.env.enc', key_file='.env.key', password=None,
+                                   keys=None, prefix=None, timings=None):
+    """
+    Load encrypted environment variables into os.environ without blocking the event loop
+    
+    File reads, the key derivation and the decryption run on the default
+    executor. os.environ is only changed after every stage has finished, so
+    cancelling the call leaves the environment untouched.
+    
+    Args:
+        env_file (str): Path to the encrypted .env file
+        key_file (str): Path to the key file (used if password is None)
+        password (str, optional): Password to decrypt the file
+        keys (collection, optional): Only export these variables
+        prefix (str, optional): Only export variables starting with this prefix
+        timings (dict, optional): Filled with the seconds spent in each stage
+                                  ('key_file', 'header', 'unlock', 'decrypt', 'apply')
+        
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    loop = asyncio.get_running_loop()
+    timings = {} if timings is None else timings
+    
+    try:
+        # Create crypto instance
+        crypto = EnvCrypto(password)
+        
+        # If no password provided, try to load key from file
+        if not password and os.path.exists(key_file):
+            start = time.perf_counter()
+            await loop.run_in_executor(None, crypto.load_key_from_file, key_file)
+            timings['key_file'] = time.perf_counter() - start
+        
+        env_values, _ = await crypto.get_env_values_async(env_file, keys, prefix, timings)
     except Exception as e:
         print(f"Error loading encrypted environment: {e}")
         return False
+    
+    if not env_values:
+        print(f"Failed to load environment from {env_file}")
+        return False
+    
+    start = time.perf_counter()
+    for key, value in env_values.items():
+        os.environ[key] = value
+    timings['apply'] = time.perf_counter() - start
+    
+    print(f"Successfully loaded {len(env_values)} environment variables")
+    return True
+
+
+class EnvWatcher:
+    """
+    Reload an encrypted .env file into os.environ when it changes
+    
+    Each check only stats the file; it is decrypted again only when its
+    signature changed. Added, changed and removed variables are applied to
+    os.environ one by one and reported to the registered callbacks.
+    """
+    
+    def __init__(self, env_file='.env.enc', key_file='.env.key', password=None, interval=2.0):
+        """
+        Initialize the watcher
+        
+        Args:
+            env_file (str): Path to the encrypted .env file
+            key_file (str): Path to the key file (used if password is None)
+            password (str, optional): Password to decrypt the file
+            interval (float): Seconds between checks of the background thread
+        """
+        self.env_file = env_file
+        self.key_file = key_file
+        self.password = password
+        self.interval = interval
+        self.values = {}  # Variables applied by the last successful reload
+        self._signature = None
+        self._callbacks = {}  # key (None for every key) -> list of callbacks
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+    
+    def on_change(self, key, callback):
+        """
+        Register a callback for changes of one variable
+        
+        Args:
+            key (str or None): Variable to watch, or None for every variable
+            callback (callable): Called as callback(key, old_value, new_value);
+                                 old_value is None for added variables and
+                                 new_value is None for removed ones
+        """
+        with self._lock:
+            self._callbacks.setdefault(key, []).append(callback)
+    
+    def check(self, notify=True):
+        """
+        Reload the file if it changed since the last check
+        
+        Args:
+            notify (bool): Call the registered callbacks for the changes
+            
+        Returns:
+            dict: {key: (old value, new value)} for every variable that changed
+        """
+        with self._lock:
+            signature = file_signature(self.env_file)
+            if signature is None or signature == self._signature:
+                return {}
+            # Remember failed reads too, so a broken file is retried only when it changes again
+            self._signature = signature
+            
+            values = read_encrypted_env(self.env_file, self.key_file, self.password)
+            if values is None:
+                return {}
+            
+            changes = {}
+            for key, value in values.items():
+                old_value = self.values.get(key)
+                if old_value != value:
+                    changes[key] = (old_value, value)
+                    os.environ[key] = value
+            for key in self.values.keys() - values.keys():
+                changes[key] = (self.values[key], None)
+                # Leave variables alone that the program has set itself since
+                if os.environ.get(key) == self.values[key]:
+                    del os.environ[key]
+            self.values = values
+            
+            callbacks = [(key, change, self._callbacks.get(key, []) + self._callbacks.get(None, []))
+                         for key, change in changes.items()] if notify else []
+        
+        for key, (old_value, new_value), key_callbacks in callbacks:
+            for callback in key_callbacks:
+                try:
+                    callback(key, old_value, new_value)
+                except Exception as e:
+                    print(f"Error in change callback for {key}: {e}")
+        return changes
+    
+    def start(self):
+        """
+        Load the file and keep checking it on a background thread
+        
+        Returns:
+            bool: True if the initial load succeeded, False otherwise
+        """
+        self.check(notify=False)
+        if not self.values:
+            return False
+        
+        def run():
+            while not self._stop_event.wait(self.interval):
+                self.check()
+        
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        return True
+    
+    def stop(self):
+        """
+        Stop the background thread
+        """
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+
+def watch_encrypted_env(env_file='.env.enc', key_file='.env.key', password=None, interval=2.0):
+    """
+    Load encrypted environment variables and keep them up to date
+    
+    Args:
+        env_file (str): Path to the encrypted .env file
+        key_file (str): Path to the key file (used if password is None)
+        password (str, optional): Password to decrypt the file
+        interval (float): Seconds between checks for changes
+        
+    Returns:
+        EnvWatcher or None: The running watcher, or None if the file could not be loaded
+    """
+    watcher = EnvWatcher(env_file, key_file, password, interval)
+    if not watcher.start():
+        print(f"Failed to load environment from {env_file}")
+        return None
+    print(f"Watching {env_file} for changes ({len(watcher.values)} variables loaded)")
+    return watcher
+
 
 if __name__ == "__main__":
     # Example usage
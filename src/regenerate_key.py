@@ -7,7 +7,7 @@ import os
 import getpass
 
 # Use the EnvCrypto class directly to ensure consistency
-from env_crypto import EnvCrypto
+from env_crypto import EnvCrypto, atomic_write
 
 def main():
     """Main function to regenerate the key file"""
@@ -29,22 +29,18 @@ def main():
     # Create crypto instance with the password
     crypto = EnvCrypto(password)
     
-    # Test if the password works by trying to decrypt
+    # Test if the password works by unwrapping the key stored in the header
     print("Verifying password...")
     try:
-        # Read the encrypted file
-        with open('.env.enc', 'rb') as f:
-            encrypted_data = f.read()
-        
-        # Try to decrypt
-        decrypted_data = crypto.cipher.decrypt(encrypted_data)
+        if not crypto.verify_password('.env.enc'):
+            raise ValueError("invalid password or corrupted file")
         
         # If we get here, decryption was successful
         print("Password verified successfully!")
         
         # Save the key
         key_file = '.env.key'
-        with open(key_file, 'wb') as f:
+        with atomic_write(key_file) as f:
             f.write(crypto.key)
         
         print(f"Success! Key file regenerated and saved to {key_file}")
@@ -0,0 +1,243 @@
+"""
+Share decrypted configuration with worker processes through shared memory
+
+The parent decrypts the file once and publishes a compact, read-only
+snapshot in a shared memory block. Workers attach to the block by name and
+read values straight out of it, without deriving a key or decrypting the
+file again. The parent zeroes and unlinks the block when it is closed or
+when the parent exits.
+"""
+import atexit
+import os
+import struct
+import sys
+from collections.abc import Mapping
+from multiprocessing import resource_tracker, shared_memory
+
+from load_env import read_encrypted_env
+
+# Workers find the published block through this environment variable
+SHM_NAME_VARIABLE = 'ENV_CRYPTO_SHM'
+
+_SNAPSHOT_MAGIC = b'ENVS'
+_SNAPSHOT_PREFIX = struct.Struct('>4sI')  # magic, number of variables
+_LENGTH = struct.Struct('>I')
+
+# Only POSIX shared memory blocks are registered with a resource tracker
+_TRACKED = os.name == 'posix'
+
+
+def _tracker_name(name):
+    """Name under which the resource tracker knows a shared memory block"""
+    return '/' + name
+
+
+def pack_snapshot(values):
+    """
+    Serialize variables into the snapshot format
+
+    Each variable is stored as a length-prefixed key followed by a
+    length-prefixed value, all UTF-8.
+
+    Args:
+        values (dict): The variables, in order
+
+    Returns:
+        bytes: The serialized snapshot
+    """
+    parts = [_SNAPSHOT_PREFIX.pack(_SNAPSHOT_MAGIC, len(values))]
+    for key, value in values.items():
+        for text in (key, value):
+            data = text.encode('utf-8')
+            parts.append(_LENGTH.pack(len(data)))
+            parts.append(data)
+    return b''.join(parts)
+
+
+class SharedEnvSnapshot(Mapping):
+    """
+    Read-only view of a published snapshot
+
+    Attaching only records where each value starts and ends; values are
+    decoded from the shared block when they are looked up.
+    """
+
+    def __init__(self, buf, shm=None):
+        """
+        Index a serialized snapshot
+
+        Args:
+            buf (buffer): Snapshot bytes, usually a shared memory buffer
+            shm (SharedMemory, optional): Block to close with the snapshot
+        """
+        self._shm = shm
+        self._buf = memoryview(buf).toreadonly()
+        magic, count = _SNAPSHOT_PREFIX.unpack_from(self._buf)
+        if magic != _SNAPSHOT_MAGIC:
+            raise ValueError("not an environment snapshot")
+
+        self._spans = {}  # key -> (start, end) of its value
+        offset = _SNAPSHOT_PREFIX.size
+        for _ in range(count):
+            spans = []
+            for _ in range(2):
+                (length,) = _LENGTH.unpack_from(self._buf, offset)
+                offset += _LENGTH.size
+                spans.append((offset, offset + length))
+                offset += length
+            (key_start, key_end), value_span = spans
+            self._spans[str(self._buf[key_start:key_end], 'utf-8')] = value_span
+
+    @classmethod
+    def attach(cls, name=None):
+        """
+        Attach to a snapshot published by another process
+
+        Args:
+            name (str, optional): Name of the shared memory block,
+                                  defaults to the ENV_CRYPTO_SHM variable
+
+        Returns:
+            SharedEnvSnapshot: The attached snapshot
+        """
+        name = name or os.environ[SHM_NAME_VARIABLE]
+        if sys.version_info >= (3, 13):
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            # Attaching registers the block with the resource tracker, which would
+            # unlink it when this process exits. Take the registration back; the
+            # publisher registers the block again right before it unlinks it.
+            shm = shared_memory.SharedMemory(name=name)
+            if _TRACKED:
+                resource_tracker.unregister(_tracker_name(shm.name), 'shared_memory')
+        try:
+            return cls(shm.buf, shm)
+        except Exception:
+            shm.close()
+            raise
+
+    def __getitem__(self, key):
+        start, end = self._spans[key]
+        return str(self._buf[start:end], 'utf-8')
+
+    def __iter__(self):
+        return iter(self._spans)
+
+    def __len__(self):
+        return len(self._spans)
+
+    def close(self):
+        """
+        Detach from the shared memory block
+        """
+        self._buf.release()
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SharedEnvPublisher:
+    """
+    Owner of a published snapshot
+    """
+
+    def __init__(self, values):
+        """
+        Publish variables in a new shared memory block
+
+        Args:
+            values (dict): The variables to publish
+        """
+        data = pack_snapshot(values)
+        self._shm = shared_memory.SharedMemory(create=True, size=len(data))
+        self._shm.buf[:len(data)] = data
+        self.name = self._shm.name
+        self._pid = os.getpid()
+        atexit.register(self.close)
+
+    def close(self):
+        """
+        Zero and unlink the shared memory block
+
+        Workers that are still attached keep their mapping, but only see zeros.
+        Forked children inherit the publisher and its exit hook, but the block
+        belongs to the process that published it, so closing does nothing there.
+        """
+        if self._shm is None or os.getpid() != self._pid:
+            return
+        atexit.unregister(self.close)
+        self._shm.buf[:] = bytes(self._shm.size)
+        self._shm.close()
+        if _TRACKED and sys.version_info < (3, 13):
+            # Workers sharing our resource tracker took the registration back when they attached
+            resource_tracker.register(_tracker_name(self.name), 'shared_memory')
+        try:
+            self._shm.unlink()
+        except FileNotFoundError:
+            # Already removed by someone else; forget it like unlink() would have
+            if _TRACKED:
+                resource_tracker.unregister(_tracker_name(self.name), 'shared_memory')
+        self._shm = None
+        if os.environ.get(SHM_NAME_VARIABLE) == self.name:
+            del os.environ[SHM_NAME_VARIABLE]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def publish_encrypted_env(env_file='.env.enc', key_file='.env.key', password=None,
+                          keys=None, prefix=None):
+    """
+    Decrypt an encrypted .env file once and publish it for worker processes
+
+    The block name is exported as ENV_CRYPTO_SHM, so workers started
+    afterwards can call load_shared_env() without arguments.
+
+    Args:
+        env_file (str): Path to the encrypted .env file
+        key_file (str): Path to the key file (used if password is None)
+        password (str, optional): Password to decrypt the file
+        keys (collection, optional): Only publish these variables
+        prefix (str, optional): Only publish variables starting with this prefix
+
+    Returns:
+        SharedEnvPublisher or None: The publisher, or None if the file could not be read
+    """
+    values = read_encrypted_env(env_file, key_file, password, keys=keys, prefix=prefix)
+    if values is None:
+        return None
+
+    publisher = SharedEnvPublisher(values)
+    os.environ[SHM_NAME_VARIABLE] = publisher.name
+    print(f"Published {len(values)} environment variables in shared memory {publisher.name}")
+    return publisher
+
+
+def load_shared_env(name=None):
+    """
+    Load a published snapshot into os.environ
+
+    Args:
+        name (str, optional): Name of the shared memory block,
+                              defaults to the ENV_CRYPTO_SHM variable
+
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    try:
+        with SharedEnvSnapshot.attach(name) as snapshot:
+            for key, value in snapshot.items():
+                os.environ[key] = value
+        return True
+    except (KeyError, OSError, ValueError) as e:
+        print(f"Error loading shared environment: {e}")
+        return False
@@ -0,0 +1,218 @@
+"""
+Startup cache for decrypted configuration
+
+Processes that are restarted often (e.g. main.exe under a watchdog) pay for
+the key derivation and a full decrypt on every start. This cache keeps the
+parsed variables on a tmpfs path, encrypted under a short-lived random
+session key, so a restart against an unchanged .env.enc skips both.
+
+An entry is only used when the file's inode, size, modification time and
+content hash all match, and when the same password or key file is used.
+The cache directory must be owned by the current user with mode 0700, and
+platforms without user ids (Windows) skip the cache altogether.
+"""
+import hashlib
+import hmac
+import json
+import os
+import tempfile
+import time
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from key_agent import is_private_dir
+
+# The cache relies on per-user directories, which need user ids
+CACHE_SUPPORTED = hasattr(os, 'getuid')
+
+# Session keys (and with them every cache entry) expire after this many seconds
+STARTUP_CACHE_TTL = 3600
+
+
+def get_cache_dir():
+    """
+    Get the directory holding the startup cache
+
+    The ENV_CRYPTO_CACHE_DIR environment variable overrides the default
+    per-user directory on tmpfs, so decrypted data never reaches a disk.
+
+    Returns:
+        str: Path to the cache directory
+    """
+    path = os.environ.get('ENV_CRYPTO_CACHE_DIR')
+    if path:
+        return path
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if not runtime_dir:
+        runtime_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(runtime_dir, f"env_crypto_cache-{os.getuid()}")
+
+
+def _private_dir(create=False):
+    """
+    Get the cache directory if only the current user can use it
+
+    A directory that already exists is never changed; one that is a symlink,
+    belongs to someone else or is open to other users is not used.
+
+    Args:
+        create (bool): Create the directory (mode 0700) if it does not exist
+
+    Returns:
+        str or None: Path to the cache directory, None if it cannot be used
+    """
+    if not CACHE_SUPPORTED:
+        return None
+    cache_dir = get_cache_dir()
+    if create:
+        try:
+            os.makedirs(cache_dir, mode=0o700)
+            os.chmod(cache_dir, 0o700)
+        except FileExistsError:
+            pass
+        except OSError:
+            return None
+    return cache_dir if is_private_dir(cache_dir) else None
+
+
+def _write_private(path, data):
+    """Replace a cache file with owner-only permissions"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _session_key(create=False):
+    """
+    Get the current session key
+
+    Args:
+        create (bool): Start a new session if there is none or it has expired
+
+    Returns:
+        bytes or None: The session key
+    """
+    cache_dir = _private_dir(create)
+    if cache_dir is None:
+        return None
+    path = os.path.join(cache_dir, 'session.key')
+    try:
+        if time.time() - os.path.getmtime(path) < STARTUP_CACHE_TTL:
+            with open(path, 'rb') as f:
+                return f.read()
+    except OSError:
+        pass
+
+    if not create:
+        return None
+    # A new session key orphans every entry written under the old one
+    clear_startup_cache()
+    key = Fernet.generate_key()
+    _write_private(path, key)
+    return key
+
+
+def file_identity(env_file):
+    """
+    Identify the exact contents of an encrypted file
+
+    Args:
+        env_file (str): Path to the encrypted file
+
+    Returns:
+        list or None: [device, inode, size, mtime_ns, sha256], None if it cannot be read
+    """
+    try:
+        with open(env_file, 'rb') as f:
+            st = os.fstat(f.fileno())
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, digest.hexdigest()]
+
+
+def _entry_path(session_key, env_file, credential):
+    """Name the cache entry of one file opened with one credential"""
+    name = hmac.new(session_key, os.path.realpath(env_file).encode('utf-8') + b'\0' + credential,
+                    hashlib.sha256).hexdigest()
+    return os.path.join(get_cache_dir(), f"{name}.cache")
+
+
+def load_cached_values(env_file, credential):
+    """
+    Get the cached variables of an encrypted file
+
+    Args:
+        env_file (str): Path to the encrypted file
+        credential (bytes): The password or key file contents used to open it
+
+    Returns:
+        dict or None: The variables, or None if there is no valid entry
+    """
+    session_key = _session_key()
+    if session_key is None:
+        return None
+
+    path = _entry_path(session_key, env_file, credential)
+    try:
+        with open(path, 'rb') as f:
+            token = f.read()
+        entry = json.loads(Fernet(session_key).decrypt(token, ttl=STARTUP_CACHE_TTL))
+    except (OSError, ValueError, InvalidToken):
+        return None
+
+    if entry['identity'] != file_identity(env_file):
+        # The file changed since the entry was written
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return None
+    return dict(entry['values'])
+
+
+def store_cached_values(env_file, credential, identity, values):
+    """
+    Cache the variables of an encrypted file
+
+    Args:
+        env_file (str): Path to the encrypted file
+        credential (bytes): The password or key file contents used to open it
+        identity (list): file_identity() of the file the values were read from
+        values (dict): The decrypted variables
+
+    Returns:
+        bool: True if the entry was written, False otherwise
+    """
+    if identity is None or identity != file_identity(env_file):
+        # The file changed while it was being decrypted
+        return False
+    try:
+        session_key = _session_key(create=True)
+        if session_key is None:
+            return False
+        entry = json.dumps({'identity': identity, 'values': list(values.items())})
+        _write_private(_entry_path(session_key, env_file, credential),
+                       Fernet(session_key).encrypt(entry.encode('utf-8')))
+        return True
+    except OSError:
+        return False
+
+
+def clear_startup_cache():
+    """
+    Remove every cache entry and the session key
+    """
+    cache_dir = _private_dir()
+    if cache_dir is None:
+        return
+    for name in os.listdir(cache_dir):
+        if name.endswith('.cache') or name == 'session.key':
+            try:
+                os.unlink(os.path.join(cache_dir, name))
+            except OSError:
+                pass
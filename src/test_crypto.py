@@ -1,8 +1,53 @@
 """
 Test script for the encryption/decryption module
 """
+import os
+import contextlib
+import fcntl
+import tempfile
+import time
+import traceback
+import tracemalloc
+from cryptography.fernet import Fernet
+
+import env_crypto
 from env_crypto import EnvCrypto
 
+@contextlib.contextmanager
+def counting_calls(owner, name, record=None):
+    """
+    Record the calls of a method or function for the length of a with block
+    
+    Args:
+        owner: Class, instance or module holding the attribute
+        name (str): Attribute name
+        record (callable, optional): Maps the result of a call to what is
+                                     recorded; the call arguments are recorded if None
+        
+    Yields:
+        list: One entry per call, filled in as the calls are made
+    """
+    calls = []
+    original = getattr(owner, name)
+    own_attribute = vars(owner).get(name)
+    
+    def counting(*args, **kwargs):
+        if record is None:
+            calls.append(args)
+            return original(*args, **kwargs)
+        result = original(*args, **kwargs)
+        calls.append(record(result))
+        return result
+    
+    setattr(owner, name, counting)
+    try:
+        yield calls
+    finally:
+        if own_attribute is None:
+            delattr(owner, name)  # Uncovers the class attribute again
+        else:
+            setattr(owner, name, own_attribute)
+
 def test_encryption_decryption():
     """Test basic encryption and decryption"""
     print("Testing basic encryption and decryption...")
@@ -30,5 +75,1206 @@ def test_encryption_decryption():
     else:
         print("❌ Failed! Decrypted data doesn't match original")
 
+def test_key_cache():
+    """Test that derived keys are cached, bounded and wiped"""
+    print("Testing the derived key cache...")
+    env_crypto.clear_key_cache()
+    
+    first = env_crypto.derive_key("cache-password", use_agent=False)
+    second = env_crypto.derive_key("cache-password", use_agent=False)
+    assert first == second
+    assert len(env_crypto._key_cache) == 1
+    
+    # Different iteration counts must not share a cache entry
+    env_crypto.derive_key("cache-password", iterations=1000, use_agent=False)
+    assert len(env_crypto._key_cache) == 2
+    
+    # The cache never grows past its size bound
+    old_limit = env_crypto.KEY_CACHE_MAX_ENTRIES
+    env_crypto.KEY_CACHE_MAX_ENTRIES = 2
+    try:
+        env_crypto.derive_key("other-password", iterations=1000, use_agent=False)
+        assert len(env_crypto._key_cache) == 2
+    finally:
+        env_crypto.KEY_CACHE_MAX_ENTRIES = old_limit
+    
+    env_crypto.clear_key_cache()
+    assert len(env_crypto._key_cache) == 0
+    print("✅ Success! Derived keys are cached and wiped correctly")
+
+def test_header_and_legacy_files():
+    """Test that new files carry KDF parameters and headerless files still open"""
+    print("Testing the file header and legacy files...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # New files get a header with a random salt and calibrated iterations
+        new_file = os.path.join(tmp_dir, 'new.env.enc')
+        crypto = EnvCrypto("header-password", use_agent=False)
+        assert crypto.set_env_values({'A': '1', 'B': '2'}, ['A', 'B'], new_file)
+        salt, iterations = env_crypto.read_kdf_params(new_file)
+        assert salt != env_crypto.KDF_SALT
+        assert iterations >= env_crypto.KDF_MIN_ITERATIONS
+        
+        values, order = EnvCrypto("header-password", use_agent=False).get_env_values(new_file)
+        assert values == {'A': '1', 'B': '2'} and order == ['A', 'B']
+        
+        # Files written before the header existed use the fixed salt
+        legacy_file = os.path.join(tmp_dir, 'legacy.env.enc')
+        legacy_key = env_crypto.derive_key("header-password", use_agent=False)
+        with open(legacy_file, 'wb') as f:
+            f.write(Fernet(legacy_key).encrypt(b"A=legacy"))
+        legacy = EnvCrypto("header-password", use_agent=False)
+        values, _ = legacy.get_env_values(legacy_file)
+        assert values == {'A': 'legacy'}
+        
+        # Rewriting a legacy file keeps its key, so old key files stay valid
+        assert legacy.set_env_value('B', 'new', legacy_file)
+        assert env_crypto.read_kdf_params(legacy_file) == (env_crypto.KDF_SALT, env_crypto.KDF_ITERATIONS)
+        assert legacy.key == legacy_key
+        
+        # A wrong password must not open or overwrite the file
+        wrong = EnvCrypto("wrong-password", use_agent=False)
+        assert wrong.get_env_values(new_file) == ({}, [])
+        assert not wrong.set_env_value('A', 'x', new_file)
+    print("✅ Success! Headers and legacy files handled correctly")
+
+def test_password_change_rewraps_data_key():
+    """Test that changing the password only rewrites the header"""
+    print("Testing password changes with envelope encryption...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env_file = os.path.join(tmp_dir, '.env.enc')
+        crypto = EnvCrypto("old-password", use_agent=False)
+        assert crypto.set_env_values({'A': '1', 'CERT': 'x' * 10000}, None, env_file)
+        data_key = crypto.key
+        
+        _, payload_offset = env_crypto.read_header(env_file)
+        with open(env_file, 'rb') as f:
+            payload_before = f.read()[payload_offset:]
+        
+        assert EnvCrypto("old-password", use_agent=False).change_file_password("new-password", env_file)
+        
+        # The payload and data key are untouched, only the wrapped key changed
+        _, new_payload_offset = env_crypto.read_header(env_file)
+        with open(env_file, 'rb') as f:
+            assert f.read()[new_payload_offset:] == payload_before
+        assert new_payload_offset == payload_offset
+        
+        assert EnvCrypto("old-password", use_agent=False).get_env_values(env_file) == ({}, [])
+        new = EnvCrypto("new-password", use_agent=False)
+        assert new.get_env_values(env_file)[0]['A'] == '1'
+        assert new.key == data_key
+        
+        # Files without envelope encryption are upgraded with a new data key
+        legacy_file = os.path.join(tmp_dir, 'legacy.env.enc')
+        legacy_key = env_crypto.derive_key("old-password", use_agent=False)
+        with open(legacy_file, 'wb') as f:
+            f.write(Fernet(legacy_key).encrypt(b"A=legacy"))
+        legacy = EnvCrypto("old-password", use_agent=False)
+        assert legacy.change_file_password("new-password", legacy_file)
+        assert legacy.key != legacy_key
+        assert EnvCrypto("old-password", use_agent=False).get_env_values(legacy_file) == ({}, [])
+        assert EnvCrypto("new-password", use_agent=False).get_env_values(legacy_file)[0] == {'A': 'legacy'}
+    print("✅ Success! Password changes only rewrap the data key")
+
+def test_verify_password_reads_header_only():
+    """Test password verification through the key check value"""
+    print("Testing password verification...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env_file = os.path.join(tmp_dir, '.env.enc')
+        crypto = EnvCrypto("check-password", use_agent=False)
+        assert crypto.set_env_values({'A': '1'}, None, env_file)
+        
+        # Corrupt the payload: verification must not depend on it
+        with open(env_file, 'ab') as f:
+            f.write(b'garbage')
+        
+        assert EnvCrypto("check-password", use_agent=False).verify_password(env_file)
+        wrong = EnvCrypto("wrong-password", use_agent=False)
+        assert not wrong.verify_password(env_file)
+        assert not wrong.password_valid
+        
+        # A loaded data key is checked the same way
+        key_file = os.path.join(tmp_dir, '.env.key')
+        with open(key_file, 'wb') as f:
+            f.write(crypto.key)
+        key_only = EnvCrypto()
+        assert key_only.load_key_from_file(key_file)
+        assert key_only.verify_password(env_file)
+        assert not EnvCrypto().verify_password(env_file)
+        
+        # A key file that does not match must not take over the file's password slot
+        other_key_file = os.path.join(tmp_dir, 'other.key')
+        with open(other_key_file, 'wb') as f:
+            f.write(Fernet.generate_key())
+        other = EnvCrypto()
+        assert other.load_key_from_file(other_key_file)
+        header_before = env_crypto.read_header(env_file)[0]
+        assert not other.set_env_values({'A': '2'}, None, env_file)
+        assert env_crypto.read_header(env_file)[0] == header_before
+        assert EnvCrypto("check-password", use_agent=False).verify_password(env_file)
+    print("✅ Success! Passwords are verified from the header")
+
+def test_single_key_lookup_reads_one_record():
+    """Test that get_env_value only decrypts the requested record"""
+    print("Testing single-key lookups in the records layout...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env_file = os.path.join(tmp_dir, '.env.enc')
+        crypto = EnvCrypto("record-password", use_agent=False)
+        values = {'CLAVE_SUCURSAL': 'ROTON', 'CERT': 'c' * 50000, 'CLAVE_PLAZA': 'XALAP'}
+        assert crypto.set_env_values(values, ['CLAVE_SUCURSAL', 'CERT', 'CLAVE_PLAZA'], env_file)
+        
+        reader = EnvCrypto("record-password", use_agent=False)
+        assert reader.get_env_values(env_file) == (values, ['CLAVE_SUCURSAL', 'CERT', 'CLAVE_PLAZA'])
+        assert reader.get_env_value('MISSING', env_file) is None
+        
+        # Corrupt the middle of the large record: other keys must still be readable
+        _, payload_offset = env_crypto.read_header(env_file)
+        with open(env_file, 'r+b') as f:
+            f.seek(payload_offset + 1000)
+            f.write(b'!!!!')
+        
+        reader = EnvCrypto("record-password", use_agent=False)
+        assert reader.get_env_value('CLAVE_PLAZA', env_file) == 'XALAP'
+        assert reader.get_env_value('CLAVE_SUCURSAL', env_file) == 'ROTON'
+        assert reader.get_env_value('CERT', env_file) is None
+        assert reader.get_env_values(env_file) == ({}, [])
+    print("✅ Success! Single keys are read from their own record")
+
+def test_journal_appends_and_compaction():
+    """Test journaled single-key changes and compaction"""
+    print("Testing the append-only journal...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env_file = os.path.join(tmp_dir, '.env.enc')
+        crypto = EnvCrypto("journal-password", use_agent=False)
+        assert crypto.set_env_values({'SQL_ENABLED': 'False', 'CERT': 'c' * 20000}, None, env_file)
+        size_before = os.path.getsize(env_file)
+        
+        # A change appends a small record instead of rewriting the file
+        assert crypto.set_env_value('SQL_ENABLED', 'True', env_file)
+        assert crypto.set_env_value('NEW_KEY', 'new', env_file)
+        assert crypto.delete_env_value('CERT', env_file)
+        assert os.path.getsize(env_file) - size_before < 1000
+        
+        reader = EnvCrypto("journal-password", use_agent=False)
+        assert reader.get_env_values(env_file) == (
+            {'SQL_ENABLED': 'True', 'NEW_KEY': 'new'}, ['SQL_ENABLED', 'NEW_KEY'])
+        assert reader.get_env_value('SQL_ENABLED', env_file) == 'True'
+        assert reader.get_env_value('CERT', env_file) is None
+        
+        # An interrupted append leaves a partial record that is ignored
+        with open(env_file, 'ab') as f:
+            f.write(b'\x00\x00\x01\x00partial')
+        assert reader.get_env_value('SQL_ENABLED', env_file) == 'True'
+        
+        # Cutting committed records off the end is detected, not read as an older state
+        with open(env_file, 'rb') as f:
+            intact = f.read()
+        size = os.path.getsize(env_file)
+        assert crypto.set_env_value('SQL_ENABLED', 'False', env_file)
+        os.truncate(env_file, size)
+        assert reader.get_env_value('SQL_ENABLED', env_file) is None and not reader.password_valid
+        assert not crypto.set_env_value('OTHER', '1', env_file)
+        with open(env_file, 'wb') as f:
+            f.write(intact)
+        assert reader.get_env_value('SQL_ENABLED', env_file) == 'True'
+        
+        # Passing the record limit folds the journal into a new snapshot
+        for i in range(env_crypto.JOURNAL_MAX_RECORDS + 1):
+            assert crypto.set_env_value('COUNTER', str(i), env_file)
+        header, payload_offset = env_crypto.read_header(env_file)
+        assert os.path.getsize(env_file) - payload_offset - header['body_len'] < 1000
+        values, _ = reader.get_env_values(env_file)
+        assert values['COUNTER'] == str(env_crypto.JOURNAL_MAX_RECORDS) and 'CERT' not in values
+        
+        # A wrong password must not append anything
+        size = os.path.getsize(env_file)
+        assert not EnvCrypto("wrong-password", use_agent=False).set_env_value('X', '1', env_file)
+        assert os.path.getsize(env_file) == size
+    print("✅ Success! Journal appends and compaction work")
+
+def test_record_keys_and_values_round_trip():
+    """Test that records keep values with '=' and reject names that cannot be stored"""
+    print("Testing record encoding and key validation...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env_file = os.path.join(tmp_dir, '.env.enc')
+        crypto = EnvCrypto("record-password", use_agent=False)
+        assert crypto.set_env_values({'URL': 'a=b&c=d', 'PEM': 'line1\nline2'}, None, env_file)
+        assert crypto.set_env_value('QUERY', 'x==y', env_file)
+        reader = EnvCrypto("record-password", use_agent=False)
+        assert reader.get_env_values(env_file) == (
+            {'URL': 'a=b&c=d', 'PEM': 'line1\nline2', 'QUERY': 'x==y'}, ['URL', 'PEM', 'QUERY'])
+        
+        # Names with '=' or line breaks are refused at every entry point
+        size = os.path.getsize(env_file)
+        assert not crypto.set_env_value('A=B', '1', env_file)
+        assert not crypto.set_env_value('A\nB', '1', env_file)
+        assert not crypto.set_env_values({'A=B': '1'}, None, env_file)
+        try:
+            with crypto.transaction(env_file) as tx:
+                tx['A=B'] = '1'
+            assert False, "a transaction must refuse names with '='"
+        except ValueError:
+            pass
+        assert os.path.getsize(env_file) == size
+        assert reader.get_env_values(env_file)[0]['URL'] == 'a=b&c=d'
+    print("✅ Success! Records round-trip and invalid names are refused")
+
+def test_fernet_files_migrate_to_aead():
+    """Test that Fernet files are detected and migrated to raw AES-GCM"""
+    print("Testing migration from Fernet to AES-GCM...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        legacy_file = os.path.join(tmp_dir, 'legacy.env.enc')
+        legacy_key = env_crypto.derive_key("migrate-password", use_agent=False)
+        content = b"# comment\nA=1\nCERT=" + b"c" * 30000
+        with open(legacy_file, 'wb') as f:
+            f.write(Fernet(legacy_key).encrypt(content))
+        legacy_size = os.path.getsize(legacy_file)
+        
+        crypto = EnvCrypto("migrate-password", use_agent=False)
+        assert crypto.migrate_env_file(legacy_file)
+        header, _ = env_crypto.read_header(legacy_file)
+        assert env_crypto.header_cipher(header) == env_crypto.CIPHER_AES_GCM
+        assert os.path.getsize(legacy_file) < legacy_size * 0.8
+        
+        # Blob files keep their exact text, comments included
+        reader = EnvCrypto("migrate-password", use_agent=False)
+        assert reader.decrypt_env_file(legacy_file) == content.decode('utf-8')
+        
+        # Records files written with Fernet are still readable and migrate on write
+        records_file = os.path.join(tmp_dir, 'records.env.enc')
+        fernet_writer = EnvCrypto("migrate-password", use_agent=False)
+        fernet_writer.write_cipher = env_crypto.CIPHER_FERNET
+        assert fernet_writer.set_env_values({'A': '1', 'B': '2'}, None, records_file)
+        assert reader.set_env_value('C', '3', records_file)
+        assert reader.get_env_values(records_file)[0] == {'A': '1', 'B': '2', 'C': '3'}
+        assert reader.migrate_env_file(records_file)
+        header, _ = env_crypto.read_header(records_file)
+        assert env_crypto.header_cipher(header) == env_crypto.CIPHER_AES_GCM
+        assert reader.get_env_value('C', records_file) == '3'
+    print("✅ Success! Fernet files migrate to AES-GCM")
+
+def test_streaming_uses_bounded_memory():
+    """Test that large blob files are encrypted and decrypted in chunks"""
+    print("Testing streaming encryption of a large file...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        plain_file = os.path.join(tmp_dir, '.env')
+        env_file = os.path.join(tmp_dir, '.env.enc')
+        out_file = os.path.join(tmp_dir, '.env.out')
+        line = b"LOOKUP=" + b"x" * 1000 + b"\n"
+        with open(plain_file, 'wb') as f:
+            for _ in range(8 * 1024):  # about 8 MB
+                f.write(line)
+        plain_size = os.path.getsize(plain_file)
+        
+        original_dir = os.getcwd()
+        os.chdir(tmp_dir)  # encrypt_env_file also writes .env.key
+        try:
+            crypto = EnvCrypto()
+            tracemalloc.start()
+            assert crypto.encrypt_env_file(plain_file, env_file)
+            assert crypto.decrypt_env_file(env_file, out_file)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        finally:
+            os.chdir(original_dir)
+        
+        assert peak < plain_size / 8
+        with open(plain_file, 'rb') as a, open(out_file, 'rb') as b:
+            assert a.read() == b.read()
+        
+        # Cutting the stream at a chunk boundary is detected
+        header, payload_offset = env_crypto.read_header(env_file)
+        frame_size = 4 + 12 + env_crypto.STREAM_CHUNK_SIZE + 16
+        with open(env_file, 'r+b') as f:
+            f.truncate(payload_offset + 3 * frame_size)
+        assert crypto.decrypt_env_file(env_file, out_file) is None
+        # The earlier output is left as it was, not partly overwritten
+        with open(plain_file, 'rb') as a, open(out_file, 'rb') as b:
+            assert a.read() == b.read()
+        # No temporary files are left next to it (the writer lock file stays)
+        names = [name for name in os.listdir(tmp_dir) if not name.endswith(env_crypto.LOCK_SUFFIX)]
+        assert names.count('.env.out') == 1 and len(names) == 4
+    print("✅ Success! Large files are streamed in chunks")
+
+def test_parallel_chunks_keep_order():
+    """Test that chunks sealed on several threads decrypt in the right order"""
+    print("Testing parallel chunk encryption...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        plain_file = os.path.join(tmp_dir, '.env')
+        env_file = os.path.join(tmp_dir, '.env.enc')
+        with open(plain_file, 'w') as f:
+            for i in range(2000):  # many chunks, each line is distinct
+                f.write(f"VAR_{i}=" + f"{i:08d}" * 50 + "\n")
+        
+        original_dir = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            crypto = EnvCrypto()
+            assert crypto.encrypt_env_file(plain_file, env_file, workers=4)
+            # A second file under the same key, for the splicing check below
+            other_plain = os.path.join(tmp_dir, 'other.env')
+            other_file = os.path.join(tmp_dir, 'other.env.enc')
+            with open(other_plain, 'w') as f:
+                f.write("OTHER=1\n")
+            assert crypto.encrypt_env_file(other_plain, other_file)
+        finally:
+            os.chdir(original_dir)
+        
+        with open(plain_file) as f:
+            expected = f.read()
+        # Threads on one side only must not change the result
+        assert crypto.decrypt_env_file(env_file) == expected
+        assert crypto.decrypt_env_file(env_file, workers=3) == expected
+        
+        # Chunks of another file under the same key cannot be spliced in
+        _, payload_offset = env_crypto.read_header(env_file)
+        _, other_offset = env_crypto.read_header(other_file)
+        with open(env_file, 'rb') as f:
+            header_block = f.read(payload_offset)
+        with open(other_file, 'rb') as f:
+            f.seek(other_offset)
+            spliced = header_block + f.read()
+        spliced_file = os.path.join(tmp_dir, 'spliced.env.enc')
+        with open(spliced_file, 'wb') as f:
+            f.write(spliced)
+        assert crypto.decrypt_env_file(spliced_file) is None
+        
+        # A tampered chunk still fails the whole file
+        header, payload_offset = env_crypto.read_header(env_file)
+        with open(env_file, 'r+b') as f:
+            f.seek(payload_offset + 100)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([byte[0] ^ 1]))
+        assert crypto.decrypt_env_file(env_file, workers=4) is None
+    print("✅ Success! Parallel chunks decrypt in order")
+
+def test_lazy_environ_loads_on_first_miss():
+    """Test that lazy loading defers decryption until os.getenv misses"""
+    print("Testing lazy loading of os.environ...")
+    import load_env
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env_file = os.path.join(tmp_dir, '.env.enc')
+        crypto = EnvCrypto("lazy_password")
+        assert crypto.set_env_values({'LAZY_DB_HOST': 'db.local', 'LAZY_MODE': 'file'},
+                                     output_file=env_file)
+        
+        original_environ = dict(os.environ)
+        with counting_calls(EnvCrypto, 'get_env_values') as calls:
+            try:
+                assert load_env.load_encrypted_env(env_file, password="lazy_password", lazy=True)
+                assert os.getenv('PATH') is not None
+                os.environ['LAZY_MODE'] = 'set by program'
+                assert not calls  # nothing decrypted yet
+                
+                assert os.getenv('LAZY_DB_HOST') == 'db.local'
+                assert os.getenv('LAZY_MISSING', 'default') == 'default'
+                assert len(calls) == 1
+                assert os.environ['LAZY_MODE'] == 'set by program'
+                assert 'LAZY_DB_HOST' in dict(os.environ)
+                load_env.uninstall_lazy_environ()
+                del os.environ['LAZY_DB_HOST']
+                
+                # A filtered load only runs for the names it selects
+                calls.clear()
+                assert load_env.load_encrypted_env(env_file, password="lazy_password", lazy=True,
+                                                   keys=['LAZY_DB_HOST', 'LAZY_EXTRA'])
+                assert os.getenv('TMPDIR') == original_environ.get('TMPDIR')
+                tempfile.gettempdir()
+                assert os.getenv('LAZY_OTHER') is None and not calls
+                assert os.getenv('LAZY_EXTRA') is None and len(calls) == 1
+                assert os.environ.loaded and os.getenv('LAZY_DB_HOST') == 'db.local'
+                assert os.getenv('LAZY_EXTRA') is None and len(calls) == 1
+            finally:
+                load_env.uninstall_lazy_environ()
+                for key in ('LAZY_DB_HOST', 'LAZY_MODE'):
+                    os.environ.pop(key, None)
+        assert not isinstance(os.environ, load_env.LazyEnviron)
+    print("✅ Success! Variables are decrypted on first use")
+
+def test_startup_cache_skips_unchanged_files():
+    """Test that restarts reuse the startup cache until the file changes"""
+    print("Testing the startup cache...")
+    import load_env
+    import startup_cache
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env_file = os.path.join(tmp_dir, '.env.enc')
+        os.environ['ENV_CRYPTO_CACHE_DIR'] = os.path.join(tmp_dir, 'cache')
+        crypto = EnvCrypto("cache_password")
+        assert crypto.set_env_values({'CLAVE_SUCURSAL': '001'}, output_file=env_file)
+        
+        with counting_calls(EnvCrypto, 'get_env_values') as calls:
+            try:
+                read = lambda password: load_env.read_encrypted_env(env_file, password=password,
+                                                                   use_cache=True)
+                assert read("cache_password") == {'CLAVE_SUCURSAL': '001'}
+                assert read("cache_password") == {'CLAVE_SUCURSAL': '001'}
+                assert len(calls) == 1
+                
+                # Another password does not get the cached values
+                assert read("wrong_password") is None
+                assert len(calls) == 2
+                
+                # Any change to the file invalidates the entry
+                assert crypto.set_env_value('CLAVE_SUCURSAL', '002', env_file)
+                assert read("cache_password") == {'CLAVE_SUCURSAL': '002'}
+                assert len(calls) == 3
+                
+                cache_files = os.listdir(startup_cache.get_cache_dir())
+                assert 'session.key' in cache_files
+                for name in cache_files:
+                    with open(os.path.join(startup_cache.get_cache_dir(), name), 'rb') as f:
+                        assert b'002' not in f.read()
+                startup_cache.clear_startup_cache()
+                assert not os.listdir(startup_cache.get_cache_dir())
+                
+                # A cache directory other users can reach is neither used nor changed
+                shared_dir = os.path.join(tmp_dir, 'shared')
+                os.mkdir(shared_dir)
+                os.chmod(shared_dir, 0o755)
+                os.environ['ENV_CRYPTO_CACHE_DIR'] = shared_dir
+                with open(os.path.join(shared_dir, 'session.key'), 'wb') as f:
+                    f.write(Fernet.generate_key())
+                calls.clear()
+                assert read("cache_password") == {'CLAVE_SUCURSAL': '002'}
+                assert read("cache_password") == {'CLAVE_SUCURSAL': '002'}
+                assert len(calls) == 2 and os.listdir(shared_dir) == ['session.key']
+                assert os.stat(shared_dir).st_mode & 0o777 == 0o755
+            finally:
+                del os.environ['ENV_CRYPTO_CACHE_DIR']
+    print("✅ Success! Unchanged files are served from the startup cache")
+
+def test_env_watcher_applies_changes():
+    """Test that the watcher applies only the changed variables"""
+    print("Testing hot reload of the environment...")
+    import load_env
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env_file = os.path.join(tmp_dir, '.env.enc')
+        crypto = EnvCrypto("watch_password")
+        assert crypto.set_env_values({'WATCH_SQL_ENABLED': 'false', 'WATCH_PLAZA': '01'},
+                                     output_file=env_file)
+        
+        watcher = load_env.EnvWatcher(env_file, password="watch_password")
+        seen = []
+        watcher.on_change('WATCH_SQL_ENABLED', lambda *change: seen.append(change))
+        try:
+            assert watcher.start()
+            assert os.environ['WATCH_SQL_ENABLED'] == 'false'
+            assert watcher.check() == {}  # unchanged file, no decrypt
+            
+            assert crypto.set_env_value('WATCH_SQL_ENABLED', 'true', env_file)
+            assert crypto.delete_env_value('WATCH_PLAZA', env_file)
+            changes = watcher.check()
+            assert changes == {'WATCH_SQL_ENABLED': ('false', 'true'), 'WATCH_PLAZA': ('01', None)}
+            assert seen == [('WATCH_SQL_ENABLED', 'false', 'true')]
+            assert os.environ['WATCH_SQL_ENABLED'] == 'true'
+            assert 'WATCH_PLAZA' not in os.environ
+        finally:
+            watcher.stop()
+            for key in ('WATCH_SQL_ENABLED', 'WATCH_PLAZA'):
+                os.environ.pop(key, None)
+    print("✅ Success! Changed variables are applied without a restart")
+
+def test_selective_loading():
+    """Test that load_encrypted_env can export only some variables"""
+    print("Testing selective loading...")
+    import load_env
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env_file = os.path.join(tmp_dir, '.env.enc')
+        crypto = EnvCrypto("select_password")
+        assert crypto.set_env_values({'CLAVE_SUCURSAL': '001', 'CLAVE_PLAZA': '02',
+                                      'SQL_PASSWORD': 'secret', 'SQL_USER': 'sa'},
+                                     output_file=env_file)
+        
+        with counting_calls(EnvCrypto, '_read_record', record=lambda record: record[0]) as decrypted:
+            try:
+                assert load_env.load_encrypted_env(env_file, password="select_password", prefix='CLAVE_')
+                assert decrypted == ['CLAVE_SUCURSAL', 'CLAVE_PLAZA']
+                assert os.environ['CLAVE_PLAZA'] == '02'
+                assert 'SQL_PASSWORD' not in os.environ
+                
+                values = load_env.read_encrypted_env(env_file, password="select_password",
+                                                     keys=['SQL_USER'])
+                assert values == {'SQL_USER': 'sa'}
+            finally:
+                for key in ('CLAVE_SUCURSAL', 'CLAVE_PLAZA'):
+                    os.environ.pop(key, None)
+    print("✅ Success! Only the selected variables are loaded")
+
+def _read_shared_value(key):
+    """Attach to the published snapshot from a worker process"""
+    import shared_env
+    with shared_env.SharedEnvSnapshot.attach() as snapshot:
+        return snapshot[key]
+
+def test_shared_memory_snapshot():
+    """Test publishing decrypted config to worker processes"""
+    print("Testing shared memory snapshots...")
+    import multiprocessing
+    import shared_env
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env_file = os.path.join(tmp_dir, '.env.enc')
+        crypto = EnvCrypto("shared_password")
+        assert crypto.set_env_values({'SHARED_HOST': 'db.local', 'SHARED_NAME': 'sucursal ñ'},
+                                     output_file=env_file)
+        
+        publisher = shared_env.publish_encrypted_env(env_file, password="shared_password")
+        try:
+            with multiprocessing.get_context('fork').Pool(2) as pool:
+                assert pool.map(_read_shared_value, ['SHARED_HOST', 'SHARED_NAME']) == \
+                    ['db.local', 'sucursal ñ']
+            
+            # A forked child that exits (running the inherited exit hook) leaves the block alone
+            pid = os.fork()
+            if pid == 0:
+                publisher.close()
+                os._exit(0)
+            os.waitpid(pid, 0)
+            
+            with shared_env.SharedEnvSnapshot.attach(publisher.name) as snapshot:
+                assert list(snapshot) == ['SHARED_HOST', 'SHARED_NAME']
+                assert snapshot['SHARED_HOST'] == 'db.local'
+        finally:
+            publisher.close()
+        
+        assert shared_env.SHM_NAME_VARIABLE not in os.environ
+        try:
+            shared_env.SharedEnvSnapshot.attach(publisher.name)
+            assert False, "the block should be unlinked"
+        except FileNotFoundError:
+            pass
+        
+        # Closing a block someone else already unlinked is not an error
+        publisher = shared_env.SharedEnvPublisher({'A': '1'})
+        shared_env.SharedEnvSnapshot.attach(publisher.name).close()
+        os.unlink(os.path.join('/dev/shm', publisher.name))
+        publisher.close()
+    print("✅ Success! Workers read the snapshot from shared memory")
+
+def test_async_loading():
+    """Test that async loading keeps the event loop free and can be cancelled"""
+    print("Testing asyncio loading...")
+    import asyncio
+    import threading
+    import load_env
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env_file = os.path.join(tmp_dir, '.env.enc')
+        crypto = EnvCrypto("async_password")
+        assert crypto.set_env_values({'ASYNC_HOST': 'db.local'}, output_file=env_file)
+        
+        async def ticker(ticks):
+            while True:
+                await asyncio.sleep(0.005)
+                ticks.append(1)
+        
+        async def load_while_ticking():
+            ticks = []
+            tick_task = asyncio.create_task(ticker(ticks))
+            timings = {}
+            try:
+                assert await load_env.load_encrypted_env_async(env_file, password="async_password",
+                                                               timings=timings)
+            finally:
+                tick_task.cancel()
+            return ticks, timings
+        
+        async def cancel_load():
+            task = asyncio.create_task(
+                load_env.load_encrypted_env_async(env_file, password="async_password"))
+            await asyncio.sleep(0.01)  # still deriving the key
+            task.cancel()
+            try:
+                await task
+                assert False, "the load should be cancelled"
+            except asyncio.CancelledError:
+                pass
+        
+        try:
+            env_crypto.clear_key_cache()
+            asyncio.run(cancel_load())
+            assert 'ASYNC_HOST' not in os.environ
+            
+            env_crypto.clear_key_cache()
+            ticks, timings = asyncio.run(load_while_ticking())
+            assert os.environ['ASYNC_HOST'] == 'db.local'
+            assert set(timings) == {'header', 'unlock', 'decrypt', 'apply'}
+            assert len(ticks) > 5  # the loop kept running during the key derivation
+            
+            async def edit():
+                assert await crypto.set_env_value_async('ASYNC_HOST', 'db2.local', env_file)
+                return await crypto.get_env_value_async('ASYNC_HOST', env_file)
+            assert asyncio.run(edit()) == 'db2.local'
+            
+            # Cancelled while a thread reads the file: it is closed only after the read
+            reading = threading.Event()
+            seen = {}
+            original_read = crypto._read_payload_items
+            def slow_read(f, *args):
+                reading.set()
+                time.sleep(0.05)
+                seen['closed during read'], seen['file'] = f.closed, f
+                return original_read(f, *args)
+            
+            async def cancel_decrypt():
+                task = asyncio.create_task(crypto.get_env_values_async(env_file))
+                while not reading.is_set():
+                    await asyncio.sleep(0.001)
+                task.cancel()
+                try:
+                    await task
+                    assert False, "the read should be cancelled"
+                except asyncio.CancelledError:
+                    pass
+                await asyncio.sleep(0.2)
+            
+            crypto._read_payload_items = slow_read
+            try:
+                asyncio.run(cancel_decrypt())
+            finally:
+                del crypto._read_payload_items
+            assert seen['closed during read'] is False and seen['file'].closed
+        finally:
+            os.environ.pop('ASYNC_HOST', None)
+    print("✅ Success! Loading runs off the event loop")
+
+def test_config_snapshot_types():
+    """Test that snapshots convert values once and cannot be changed"""
+    print("Testing typed config snapshots...")
+    import datetime
+    import pickle
+    from config_snapshot import ConfigSnapshot, parse_bool
+    
+    snapshot = ConfigSnapshot({'DEBUG_MODE': 'True', 'SPECIFIC_DATE': '0', 'START_DATE': '2024-03-01',
+                               'PORT': '1433', 'RATIO': '0.5', 'CLAVE_PLAZA': '007', 'NAME': 'Plaza'},
+                              types={'SPECIFIC_DATE': parse_bool, 'CLAVE_PLAZA': str})
+    assert snapshot.DEBUG_MODE is True
+    assert snapshot['SPECIFIC_DATE'] is False
+    assert snapshot.START_DATE == datetime.date(2024, 3, 1)
+    assert snapshot.PORT == 1433 and snapshot.RATIO == 0.5
+    assert snapshot.CLAVE_PLAZA == '007' and snapshot.raw('PORT') == '1433'
+    assert list(snapshot) == ['DEBUG_MODE', 'SPECIFIC_DATE', 'START_DATE', 'PORT', 'RATIO',
+                              'CLAVE_PLAZA', 'NAME']
+    assert snapshot.as_environ()['DEBUG_MODE'] == 'True'
+    
+    # Leading zeros are never dropped by the inferred types
+    codes = ConfigSnapshot({'CLAVE_PLAZA': '007', 'DB_PASSWORD': '0123', 'OFFSET': '-5',
+                            'ZERO': '0', 'SIGNED': '+5', 'RATE': '00.5'})
+    assert codes.CLAVE_PLAZA == '007' and codes.DB_PASSWORD == '0123'
+    assert codes.OFFSET == -5 and codes.ZERO == 0
+    assert codes.SIGNED == '+5' and codes.RATE == '00.5'
+    
+    for change in (lambda: setattr(snapshot, 'PORT', 1), lambda: setattr(snapshot, 'NEW', 1)):
+        try:
+            change()
+            assert False, "snapshots are read-only"
+        except AttributeError:
+            pass
+    try:
+        snapshot.MISSING
+        assert False, "missing values raise AttributeError"
+    except AttributeError:
+        pass
+    
+    copy = pickle.loads(pickle.dumps(snapshot))
+    assert dict(copy) == dict(snapshot)
+    print("✅ Success! Snapshot values are typed and read-only")
+
+def test_config_server_protocol():
+    """Test pipelined requests, writes and locking of the config server"""
+    print("Testing the config server...")
+    import threading
+    import config_server
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env_file = os.path.join(tmp_dir, '.env.enc')
+        socket_path = os.path.join(tmp_dir, 'run', 'config.sock')
+        crypto = EnvCrypto("server_password")
+        assert crypto.set_env_values({'SQL_HOST': 'db.local', 'SQL_USER': 'sa', 'DEBUG': 'True'},
+                                     output_file=env_file)
+        
+        server = config_server.ConfigServer(env_file, socket_path=socket_path)
+        assert server.unlock("server_password")
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        try:
+            query = lambda *lines: config_server.query(list(lines), socket_path)
+            assert query('GET SQL_HOST', 'GET MISSING', 'LIST SQL_', 'SET NOTE two words') == \
+                ['OK db.local', 'MISS', 'OK SQL_HOST SQL_USER', 'OK']
+            assert crypto.get_env_value('NOTE', env_file) == 'two words'
+            
+            # Concurrent clients all get their own answers
+            results = []
+            def client(i):
+                results.append(query(f'SET K{i} {i}', f'GET K{i}') == ['OK', f'OK {i}'])
+            clients = [threading.Thread(target=client, args=(i,)) for i in range(8)]
+            for t in clients:
+                t.start()
+            for t in clients:
+                t.join()
+            assert results == [True] * 8
+            assert crypto.get_env_values(env_file)[0]['K7'] == '7'
+            
+            # Changes made by other programs are picked up
+            assert crypto.set_env_value('SQL_USER', 'admin', env_file)
+            assert query('GET SQL_USER', 'DEL DEBUG', 'DEL DEBUG') == ['OK admin', 'OK', 'MISS']
+            
+            assert query('LOCK', 'GET SQL_HOST') == ['OK', 'ERR locked']
+            assert not env_crypto._key_cache  # the derived key is gone too
+            assert query('UNLOCK wrong') == ['ERR unlock failed']
+            assert query('UNLOCK server_password', 'GET SQL_HOST') == ['OK', 'OK db.local']
+        finally:
+            config_server.query(['STOP'], socket_path)
+            thread.join(5)
+        assert not os.path.exists(socket_path)
+    print("✅ Success! The config server answers pipelined requests")
+
+def test_batch_operations():
+    """Test that batch scripts apply all operations with one write, or none"""
+    print("Testing batch operations...")
+    import json
+    import subprocess
+    import sys
+    import config_cli
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env_file = os.path.join(tmp_dir, '.env.enc')
+        crypto = EnvCrypto("batch_password")
+        assert crypto.set_env_values({'CLAVE_PLAZA': '01', 'OLD': 'x'}, output_file=env_file)
+        
+        with counting_calls(EnvCrypto, '_write_records') as writes:
+            # An invalid line rejects the whole batch
+            results, summary = config_cli.run_batch(crypto, ['set CLAVE_PLAZA 02', 'frobnicate X'], env_file)
+            assert summary == {'committed': False, 'line': 2, 'error': "unknown operation 'frobnicate'"}
+            assert not writes and crypto.get_env_value('CLAVE_PLAZA', env_file) == '01'
+            
+            script = ['# provisioning', 'set CLAVE_PLAZA 02', '{"op": "set", "key": "NAME", "value": "Plaza Sur"}',
+                      'get NAME', 'delete OLD', 'del MISSING', '']
+            results, summary = config_cli.run_batch(crypto, script, env_file)
+            assert summary == {'committed': True, 'changes': 3}
+            assert results[2] == {'line': 4, 'op': 'get', 'key': 'NAME', 'ok': True, 'value': 'Plaza Sur'}
+            assert [r.get('deleted') for r in results[3:]] == [True, False]
+            assert len(writes) == 1
+            
+            # Nothing to change means nothing to write
+            results, summary = config_cli.run_batch(crypto, ['get NAME', 'set NAME Plaza Sur'], env_file)
+            assert summary == {'committed': True, 'changes': 0} and len(writes) == 1
+        assert crypto.get_env_values(env_file)[0] == {'CLAVE_PLAZA': '02', 'NAME': 'Plaza Sur'}
+        
+        # The command line prints one JSON object per operation
+        cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config_cli.py')
+        completed = subprocess.run([sys.executable, cli, 'batch', '--password', 'batch_password'],
+                                   input='get CLAVE_PLAZA\n', capture_output=True, text=True, cwd=tmp_dir)
+        lines = [json.loads(line) for line in completed.stdout.splitlines()]
+        assert lines[0]['value'] == '02' and lines[-1]['committed'] and completed.returncode == 0
+        
+        # ...and exits with a failure status when the batch is rejected
+        completed = subprocess.run([sys.executable, cli, 'batch', '--password', 'batch_password'],
+                                   input='frobnicate X\n', capture_output=True, text=True, cwd=tmp_dir)
+        assert not json.loads(completed.stdout.splitlines()[-1])['committed'] and completed.returncode == 1
+    print("✅ Success! Batches are applied with a single write")
+
+def test_transaction_single_commit():
+    """Test staged changes, skipped writes and conflict detection"""
+    print("Testing transactions...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env_file = os.path.join(tmp_dir, '.env.enc')
+        crypto = EnvCrypto("tx_password")
+        assert crypto.set_env_values({'A': '1', 'B': '2', 'C': '3'}, output_file=env_file)
+        
+        with crypto.transaction(env_file) as tx:
+            tx['A'] = '10'
+            del tx['B']
+            tx.set('D', '4')
+            assert 'B' not in tx and tx['D'] == '4'
+            assert crypto.get_env_value('A', env_file) == '1'  # staged only
+        assert crypto.get_env_values(env_file) == ({'A': '10', 'C': '3', 'D': '4'}, ['A', 'C', 'D'])
+        
+        # Unchanged transactions do not touch the file
+        signature = env_crypto.file_signature(env_file)
+        with crypto.transaction(env_file) as tx:
+            tx['A'] = '10'
+        assert env_crypto.file_signature(env_file) == signature
+        
+        # An exception discards the staged changes
+        try:
+            with crypto.transaction(env_file) as tx:
+                tx['A'] = 'lost'
+                raise RuntimeError("abort")
+        except RuntimeError:
+            pass
+        assert crypto.get_env_value('A', env_file) == '10'
+        
+        # A write by someone else in the meantime is detected
+        try:
+            with crypto.transaction(env_file) as tx:
+                tx['C'] = 'mine'
+                assert EnvCrypto("tx_password").set_env_value('C', 'theirs', env_file)
+            assert False, "the conflict should be detected"
+        except env_crypto.ConcurrentModificationError:
+            pass
+        assert crypto.get_env_value('C', env_file) == 'theirs'
+    print("✅ Success! Transactions commit once")
+
+def _crash_during(step, write):
+    """Run a write in a child process that dies abruptly at one step of it"""
+    pid = os.fork()
+    if pid == 0:
+        def crash(current_step):
+            if current_step == step:
+                os._exit(17)  # no cleanup, like a power cut
+        env_crypto._crash_hook = crash
+        try:
+            write()
+        finally:
+            os._exit(0)
+    _, status = os.waitpid(pid, 0)
+    return os.WEXITSTATUS(status)
+
+def test_atomic_writes_survive_crashes():
+    """Test that a crash at any step of a write leaves a readable file"""
+    print("Testing crash-safe writes...")
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env_file = os.path.join(tmp_dir, '.env.enc')
+        key_file = os.path.join(tmp_dir, '.env.key')
+        crypto = EnvCrypto("crash_password")
+        old_values = {'SQL_ENABLED': 'False', 'CLAVE_PLAZA': '01'}
+        new_values = {'SQL_ENABLED': 'True', 'CLAVE_PLAZA': '02'}
+        assert crypto.set_env_values(old_values, output_file=env_file)
+        with env_crypto.atomic_write(key_file) as f:
+            f.write(b'old key')
+        
+        expected = {'before_fsync': old_values, 'before_rename': old_values,
+                    'before_dir_fsync': new_values}
+        for step, values in expected.items():
+            assert crypto.set_env_values(old_values, output_file=env_file)
+            assert _crash_during(step, lambda: crypto.set_env_values(new_values, output_file=env_file)) == 17
+            assert EnvCrypto("crash_password").get_env_values(env_file)[0] == values, step
+        
+        # A group of writes is replaced together, or not at all
+        def write_group():
+            with env_crypto.group_commit():
+                crypto.set_env_values(new_values, output_file=env_file)
+                with env_crypto.atomic_write(key_file) as f:
+                    f.write(b'new key')
+        assert crypto.set_env_values(old_values, output_file=env_file)
+        assert _crash_during('before_rename', write_group) == 17
+        assert EnvCrypto("crash_password").get_env_values(env_file)[0] == old_values
+        with open(key_file, 'rb') as f:
+            assert f.read() == b'old key'
+        
+        def lock_is_free():
+            fd = os.open(env_file + env_crypto.LOCK_SUFFIX, os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                return False
+            finally:
+                os.close(fd)
+        
+        with env_crypto.group_commit():
+            crypto.set_env_values(new_values, output_file=env_file)
+            crypto.set_env_values({'ONLY': 'last write'}, output_file=env_file)
+            # Other writers wait until the renames are done
+            assert not lock_is_free()
+            # Read-modify-write would miss the pending rewrite, so it is refused
+            for change in (lambda: crypto.set_env_value('LOST', '1', env_file),
+                           lambda: crypto.transaction(env_file).begin()):
+                try:
+                    change()
+                    assert False, "a read-modify-write inside a group should be refused"
+                except RuntimeError:
+                    pass
+        assert lock_is_free()
+        assert EnvCrypto("crash_password").get_env_values(env_file)[0] == {'ONLY': 'last write'}
+        
+        # Temporary files of crashed writers are never mistaken for the config
+        assert EnvCrypto("crash_password").get_env_value('ONLY', env_file) == 'last write'
+        assert os.stat(env_file).st_mode & 0o777 == 0o600
+    print("✅ Success! Crashes never leave a torn file")
+
+def test_concurrent_writers_lose_no_updates():
+    """Test that writers in several processes never overwrite each other's changes"""
+    print("Testing concurrent writers...")
+    
+    writers, rounds = 4, 8
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env_file = os.path.join(tmp_dir, '.env.enc')
+        crypto = EnvCrypto("stress_password")
+        assert crypto.set_env_values({'COUNTER': '0'}, output_file=env_file)
+        version = env_crypto.read_version(env_file)
+        
+        def increment(tx):
+            tx['COUNTER'] = str(int(tx['COUNTER']) + 1)
+        
+        def write(worker):
+            crypto = EnvCrypto("stress_password")
+            for i in range(rounds):
+                # Journal appends on distinct keys, read-modify-write on a shared one
+                assert crypto.set_env_value(f"WORKER_{worker}_{i}", str(i), env_file)
+                crypto.run_transaction(increment, env_file, retries=100)
+        
+        def read():
+            crypto = EnvCrypto("stress_password")
+            for _ in range(writers * rounds):
+                env_dict, _ = crypto.get_env_values(env_file)
+                assert crypto.password_valid and 'COUNTER' in env_dict
+        
+        pids = []
+        for target in [read] + [lambda worker=worker: write(worker) for worker in range(writers)]:
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    target()
+                    os._exit(0)
+                except BaseException:
+                    traceback.print_exc()
+                    os._exit(1)
+            pids.append(pid)
+        for pid in pids:
+            _, status = os.waitpid(pid, 0)
+            assert os.WEXITSTATUS(status) == 0
+        
+        env_dict, _ = EnvCrypto("stress_password").get_env_values(env_file)
+        assert env_dict['COUNTER'] == str(writers * rounds)
+        for worker in range(writers):
+            for i in range(rounds):
+                assert env_dict[f"WORKER_{worker}_{i}"] == str(i)
+        assert env_crypto.read_version(env_file)[0] > version[0]
+    print("✅ Success! Concurrent writers lose no updates")
+
+def test_config_menu_session_cache():
+    """Test that the config menu only decrypts again after another program wrote"""
+    print("Testing the config menu session cache...")
+    from config_menu import ConfigMenu
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        menu = ConfigMenu()
+        menu.password = "menu_password"
+        menu.env_file = os.path.join(tmp_dir, '.env.enc')
+        menu.key_file = os.path.join(tmp_dir, '.env.key')
+        assert EnvCrypto("menu_password").set_env_values({'A': '1', 'B': '2'}, output_file=menu.env_file)
+        
+        assert menu.load_config()
+        with counting_calls(menu.crypto, 'get_env_values') as reads:
+            # Navigating     and saving works on the values in memory
+            assert menu.load_config() and menu.load_config()
+            assert menu.save_change(lambda: menu.crypto.set_env_value('C', '3', menu.env_file),
+                                    lambda: menu.set_cached_value('C', '3'))
+            assert menu.save_change(lambda: menu.crypto.delete_env_value('A', menu.env_file),
+                                    lambda: menu.delete_cached_value('A'))
+            assert menu.load_config() and reads == []
+            assert (menu.env_values, menu.key_order) == ({'B': '2', 'C': '3'}, ['B', 'C'])
+            
+            # A write by another program is picked up on the next load
+            assert EnvCrypto("menu_password").set_env_value('B', 'theirs', menu.env_file)
+            assert menu.load_config() and len(reads) == 1
+            assert menu.env_values == {'B': 'theirs', 'C': '3'}
+            
+            # ...and a save on top of it does not paper over it
+            assert EnvCrypto("menu_password").set_env_value('D', '4', menu.env_file)
+            assert menu.save_change(lambda: menu.crypto.set_env_value('C', '30', menu.env_file),
+                                    lambda: menu.set_cached_value('C', '30'))
+            assert menu.load_config() and len(reads) == 2
+            assert menu.env_values == {'B': 'theirs', 'C': '30', 'D': '4'}
+    print("✅ Success! The config menu keeps its values for the session")
+
+def test_config_menu_write_behind():
+    """Test that menu edits are collected and written once"""
+    print("Testing write-behind editing in the config menu...")
+    from config_menu import ConfigMenu
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        menu = ConfigMenu()
+        menu.password = "menu_password"
+        menu.env_file = os.path.join(tmp_dir, '.env.enc')
+        menu.key_file = os.path.join(tmp_dir, '.env.key')
+        assert EnvCrypto("menu_password").set_env_values({'A': '1', 'B': '2'}, output_file=menu.env_file)
+        assert menu.load_config()
+        
+        with counting_calls(menu.crypto, '_write_records') as writes:
+            for i in range(20):
+                menu.stage_value(f"STATION_{i}", str(i))
+            menu.stage_value('A', None)
+            assert writes == [] and EnvCrypto("menu_password").get_env_value('A', menu.env_file) == '1'
+            
+            # Another program's write is merged with the pending edits, not lost
+            assert EnvCrypto("menu_password").set_env_value('B', 'theirs', menu.env_file)
+            assert menu.load_config() and 'A' not in menu.env_values and menu.env_values['B'] == 'theirs'
+            assert menu.save_changes() and len(writes) == 1 and menu.dirty == {}
+            env_dict, _ = EnvCrypto("menu_password").get_env_values(menu.env_file)
+            assert env_dict == menu.env_values and len(env_dict) == 21 and env_dict['B'] == 'theirs'
+            assert menu.is_current()
+            
+            # The autosave thread writes after a quiet period, and shutdown flushes the rest
+            menu.autosave_delay = 0.2
+            menu.start_autosave()
+            menu.stage_value('B', 'autosaved')
+            deadline = time.monotonic() + 10
+            while menu.dirty and time.monotonic() < deadline:
+                time.sleep(0.05)
+            assert not menu.dirty and EnvCrypto("menu_password").get_env_value('B', menu.env_file) == 'autosaved'
+            menu.autosave_delay = 3600
+            menu.stage_value('C', 'on exit')
+            assert menu.shutdown() and len(writes) == 3
+            assert EnvCrypto("menu_password").get_env_value('C', menu.env_file) == 'on exit'
+        
+        # Edits survive a save without a crypto object (reset after a wrong password)
+        menu.stage_value('D', 'kept')
+        menu.crypto = None
+        assert not menu.save_changes(quiet=True) and menu.dirty == {'D': 'kept'}
+        assert menu.shutdown() and not menu.dirty
+        assert EnvCrypto("menu_password").get_env_value('D', menu.env_file) == 'kept'
+    print("✅ Success! Menu edits are written once")
+
+def test_config_menu_key_browser():
+    """Test searching and paging through keys in the config menu"""
+    print("Testing the config menu key browser...")
+    import builtins
+    from config_menu import ConfigMenu, KeyIndex, KEYS_PER_PAGE
+    
+    keys = [f"STATION_{i}_PORT" for i in range(20000)] + ['SQL_HOST', 'SQL_USER', 'MYSQL_HOST', 'SPECIFIC_DATE']
+    index = KeyIndex(keys)
+    # Prefix matches first, then substrings, then fuzzy matches, each in file order
+    assert index.search('sql') == ['SQL_HOST', 'SQL_USER', 'MYSQL_HOST']
+    assert index.search('SQLHST') == ['SQL_HOST', 'MYSQL_HOST']
+    assert index.search('st_19999') == ['STATION_19999_PORT']
+    assert index.search('station_1999')[:11] == ['STATION_1999_PORT'] + [f"STATION_1999{i}_PORT" for i in range(10)]
+    assert index.search('') == keys and index.search('zzz') == []
+    
+    # Queries that almost match long keys do not backtrack
+    long_keys = KeyIndex(['A' * 62 + str(i) for i in range(2000)])
+    start = time.perf_counter()
+    assert long_keys.search('a' * 30 + 'b') == []
+    assert time.perf_counter() - start < 1.0
+    
+    menu = ConfigMenu()
+    menu.clear_screen = lambda: None
+    menu.key_order = list(keys)
+    menu.env_values = dict.fromkeys(keys, '1')
+    answers = iter(['n', 'p', 'sqlhst', '2'])
+    original_input = builtins.input
+    builtins.input = lambda prompt='': next(answers)
+    try:
+        assert menu.browse_keys("Pick") == 'MYSQL_HOST'
+        answers = iter(['n', 'n', str(2 * KEYS_PER_PAGE + 1)])
+        assert menu.browse_keys("Pick") == keys[2 * KEYS_PER_PAGE]
+        answers = iter(['/n', 'c', '0'])
+        assert menu.browse_keys("Pick") is None
+    finally:
+        builtins.input = original_input
+    
+    # The index follows keys added or removed in the session
+    index = menu.key_index
+    menu.set_cached_value('SQL_PORT', '1433')
+    assert menu.search_keys('sql_') == ['SQL_HOST', 'SQL_USER', 'SQL_PORT', 'MYSQL_HOST']
+    assert menu.key_index is not index
+    menu.delete_cached_value('SQL_USER')
+    assert 'SQL_USER' not in menu.search_keys('sql')
+    print("✅ Success! Keys can be searched and paged")
+
+def _stat_mode(path):
+    """Permission bits of a file or directory"""
+    return os.stat(path).st_mode & 0o777
+
+def test_key_agent():
+    """Test that the key agent serves cached keys, expires them and refuses shared directories"""
+    print("Testing the key agent...")
+    import socket
+    import threading
+    import key_agent
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        socket_path = os.path.join(tmp_dir, 'agent', 'agent.sock')
+        os.environ['ENV_CRYPTO_AGENT_SOCK'] = socket_path
+        agent = key_agent.KeyAgent(idle_ttl=0.5)
+        thread = threading.Thread(target=agent.run, daemon=True)
+        thread.start()
+        try:
+            assert _stat_mode(os.path.dirname(socket_path)) == 0o700
+            assert key_agent.status() == 'OK keys=0 idle_ttl=0.5'
+            
+            # derive_key hands new keys to the agent and asks it before running PBKDF2
+            salt = os.urandom(16)
+            key = env_crypto.derive_key("agent_password", salt, 1000)
+            key_id = env_crypto.agent_key_id("agent_password", salt, 1000)
+            assert key_agent.get_key(key_id) == key
+            env_crypto.clear_key_cache()
+            assert key_agent.put_key(key_id, b'served-by-the-agent')
+            assert env_crypto.derive_key("agent_password", salt, 1000) == b'served-by-the-agent'
+            env_crypto.clear_key_cache()
+            
+            # Idle keys expire
+            time.sleep(0.7)
+            assert key_agent.get_key(key_id) is None
+            
+            assert key_agent.put_key('a', b'1') and key_agent.put_key('b', b'2')
+            assert key_agent.forget_key('a') and key_agent.get_key('a') is None
+            assert key_agent.lock() and key_agent.get_key('b') is None
+        finally:
+            key_agent.stop()
+            thread.join(5)
+            del os.environ['ENV_CRYPTO_AGENT_SOCK']
+        assert not os.path.exists(socket_path)
+        
+        # A socket in a directory other users can reach is never used, nor served from
+        shared_dir = os.path.join(tmp_dir, 'shared')
+        os.mkdir(shared_dir, 0o755)
+        os.chmod(shared_dir, 0o755)
+        fake_path = os.path.join(shared_dir, 'agent.sock')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as fake:
+            fake.bind(fake_path)
+            fake.listen(1)
+            assert key_agent.send_requests(['GET x'], fake_path) is None
+        try:
+            key_agent.KeyAgent(socket_path=os.path.join(shared_dir, 'other.sock'))
+            assert False, "a shared socket directory should be refused"
+        except PermissionError:
+            pass
+        assert _stat_mode(shared_dir) == 0o755
+    print("✅ Success! The key agent caches keys privately")
+
 if __name__ == "__main__":
     test_encryption_decryption()
+    test_key_cache()
+    test_header_and_legacy_files()
+    test_password_change_rewraps_data_key()
+    test_verify_password_reads_header_only()
+    test_single_key_lookup_reads_one_record()
+    test_journal_appends_and_compaction()
+    test_record_keys_and_values_round_trip()
+    test_fernet_files_migrate_to_aead()
+    test_streaming_uses_bounded_memory()
+    test_parallel_chunks_keep_order()
+    test_lazy_environ_loads_on_first_miss()
+    test_startup_cache_skips_unchanged_files()
+    test_env_watcher_applies_changes()
+    test_selective_loading()
+    test_shared_memory_snapshot()
+    test_async_loading()
+    test_config_snapshot_types()
+    test_config_server_protocol()
+    test_batch_operations()
+    test_transaction_single_commit()
+    test_atomic_writes_survive_crashes()
+    test_concurrent_writers_lose_no_updates()
+    test_config_menu_session_cache()
+    test_config_menu_write_behind()
+    test_config_menu_key_browser()
+    test_key_agent()